@@ -1,51 +1,88 @@
 import sys
 import os
-import queue
-import logging
 import re
-import json
 import time
-from datetime import datetime
+import queue
+import threading
+from contextlib import contextmanager
 from PyQt6.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout,
-                             QTextEdit, QPushButton, QComboBox, QLabel, QSplitter, QPlainTextEdit)
-from PyQt6.QtCore import Qt, QThread, pyqtSignal, QRect, QSize
-from PyQt6.QtGui import QPainter, QColor
-from playwright.sync_api import sync_playwright
-
-WORKDIR = os.path.dirname(os.path.abspath(__file__))
-SESSION_DIR = os.path.join(WORKDIR, "applog", "session")
-TMP_DIR = os.path.join(WORKDIR, "tmp1")
-LOG_DIR = os.path.join(WORKDIR, "log1")
-
-for d in [SESSION_DIR, TMP_DIR, LOG_DIR]:
-    os.makedirs(d, exist_ok=True)
-
-log_filename = os.path.join(LOG_DIR, f"clwt_system_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
-file_handler = logging.FileHandler(log_filename, encoding='utf-8')
-file_handler.setLevel(logging.DEBUG)
-file_formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
-file_handler.setFormatter(file_formatter)
-
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-logger.addHandler(file_handler)
-logger.addHandler(logging.StreamHandler(sys.stdout))
-
-def cleanup_old_files():
-    logger.info("システム: 古いキャッシュとログファイルのクリーンアップを実行します...")
-    now = time.time()
-    expiry_time = now - 604800
-    deleted_count = 0
-    for directory in [TMP_DIR, LOG_DIR]:
-        if not os.path.exists(directory): continue
-        for filename in os.listdir(directory):
-            filepath = os.path.join(directory, filename)
-            if os.path.isfile(filepath):
-                if os.stat(filepath).st_mtime < expiry_time:
-                    try:
-                        os.remove(filepath)
-                        deleted_count += 1
-                    except: pass
+                             QTextEdit, QPushButton, QComboBox, QLabel, QSplitter, QPlainTextEdit,
+                             QLineEdit, QListWidget, QListWidgetItem, QTableWidget, QTableWidgetItem,
+                             QHeaderView, QCompleter, QAbstractItemView, QFileDialog)
+from PyQt6.QtCore import Qt, QThread, pyqtSignal, QRect, QSize, QTimer, QAbstractListModel, QModelIndex
+from PyQt6.QtGui import QPainter, QColor, QTextCursor, QSyntaxHighlighter, QTextCharFormat, QTextBlockUserData
+from clwt_backend import (BrowserWorker, METRICS_HTTP_PORT, CODE_BLOCK_START, CODE_BLOCK_END, logger, metrics, chat_cache, search_index,
+                          cleanup_old_files, build_chat_items, load_app_state, export_code_blocks)
+
+SYS_LOG_MAX_LINES = 2000
+# chat_log のドキュメントに置くのは末尾の CHAT_PAGE_TURNS 件前後まで。それより前は上へスクロールした時に読み込む
+CHAT_PAGE_TURNS = 200
+# chat_log のブロックの userState の下位4bitは行番号色 (発言者)。上位はコードブロックのハイライト状態
+ROLE_MASK = 0xF
+
+# コードブロックの簡易ハイライト。"## 言語名" の名前 (大文字) を aliases から引き、該当しない言語は数値だけを色付けする
+# blocks は複数行にまたがる区切り (開始, 終了, 色)。1言語あたり3種類まで
+HIGHLIGHT_STYLES = {
+    "marker": ("#808080", False),
+    "header": ("#dcdcaa", False),
+    "keyword": ("#569cd6", False),
+    "type": ("#4ec9b0", False),
+    "string": ("#ce9178", False),
+    "comment": ("#6a9955", True),
+    "number": ("#b5cea8", False),
+}
+CODE_LEXERS = [
+    {
+        "aliases": ("PYTHON", "PY", "PY3", "PYTHON3", "IPYTHON"),
+        "keywords": ("False", "None", "True", "and", "as", "assert", "async", "await", "break", "case", "class", "continue",
+                     "def", "del", "elif", "else", "except", "finally", "for", "from", "global", "if", "import", "in", "is",
+                     "lambda", "match", "nonlocal", "not", "or", "pass", "raise", "return", "self", "try", "while", "with", "yield"),
+        "types": ("bool", "bytes", "dict", "float", "int", "len", "list", "object", "print", "range", "set", "str", "super", "tuple", "type"),
+        "line_comment": "#",
+        "blocks": (('"""', '"""', "string"), ("'''", "'''", "string")),
+    },
+    {
+        "aliases": ("C", "CPP", "C++", "CXX", "CC", "H", "HPP", "JAVA", "JAVASCRIPT", "JS", "MJS", "TYPESCRIPT", "TS", "JSX", "TSX",
+                    "CSHARP", "C#", "CS", "GO", "GOLANG", "RUST", "RS", "KOTLIN", "KT", "SWIFT", "PHP", "DART", "SCALA", "OBJC"),
+        "keywords": ("async", "await", "break", "case", "catch", "class", "const", "continue", "default", "defer", "delete", "do",
+                     "else", "enum", "export", "extends", "false", "finally", "fn", "for", "func", "function", "go", "if", "impl",
+                     "implements", "import", "in", "instanceof", "interface", "let", "match", "mod", "mut", "namespace", "new", "nil",
+                     "null", "override", "package", "private", "protected", "pub", "public", "return", "static", "struct", "super",
+                     "switch", "this", "throw", "throws", "true", "try", "typeof", "use", "using", "val", "var", "void", "while", "yield"),
+        "types": ("any", "auto", "bool", "boolean", "byte", "char", "double", "f32", "f64", "float", "i32", "i64", "int", "isize",
+                  "long", "number", "Option", "Promise", "Result", "short", "size_t", "string", "String", "u8", "u32", "u64",
+                  "unsigned", "usize", "Vec"),
+        "line_comment": "//",
+        "blocks": (("/*", "*/", "comment"),),
+    },
+    {
+        "aliases": ("BASH", "SH", "SHELL", "ZSH", "CONSOLE", "TERMINAL", "POWERSHELL", "PS1", "BAT", "CMD", "DOCKERFILE", "MAKEFILE"),
+        "keywords": ("case", "cd", "do", "done", "echo", "elif", "else", "esac", "exit", "export", "fi", "for", "function", "if",
+                     "in", "local", "return", "set", "source", "sudo", "then", "unset", "until", "while"),
+        "line_comment": "#",
+    },
+    {
+        "aliases": ("SQL", "MYSQL", "POSTGRESQL", "PLSQL", "SQLITE"),
+        "keywords": ("alter", "and", "as", "begin", "by", "commit", "create", "default", "delete", "distinct", "drop", "exists",
+                     "foreign", "from", "group", "having", "in", "index", "inner", "insert", "into", "is", "join", "key", "left",
+                     "limit", "not", "null", "offset", "on", "or", "order", "outer", "primary", "references", "right", "rollback",
+                     "select", "set", "table", "union", "update", "values", "where"),
+        "ignore_case": True,
+        "line_comment": "--",
+        "blocks": (("/*", "*/", "comment"),),
+    },
+    {
+        "aliases": ("HTML", "XML", "XHTML", "SVG", "VUE"),
+        "tags": True,
+        "strings": r'"[^"]*"',
+        "blocks": (("<!--", "-->", "comment"),),
+    },
+    {
+        "aliases": ("JSON", "JSONC", "YAML", "YML", "TOML", "INI"),
+        "keywords": ("false", "no", "null", "true", "yes"),
+        "line_comment": "#",
+    },
+]
 
 class LineNumberArea(QWidget):
     def __init__(self, editor):
@@ -62,13 +99,14 @@ class CodeEditor(QPlainTextEdit):
     def __init__(self):
         super().__init__()
         self.lineNumberArea = LineNumberArea(self)
+        self.line_offset = 0
         self.blockCountChanged.connect(self.updateLineNumberAreaWidth)
         self.updateRequest.connect(self.updateLineNumberArea)
         self.updateLineNumberAreaWidth(0)
 
     def lineNumberAreaWidth(self):
         digits = 1
-        max_count = max(1, self.blockCount())
+        max_count = max(1, self.blockCount() + self.line_offset)
         while max_count >= 10:
             max_count /= 10
             digits += 1
@@ -101,8 +139,8 @@ class CodeEditor(QPlainTextEdit):
 
         while block.isValid() and top <= event.rect().bottom():
             if block.isVisible() and bottom >= event.rect().top():
-                number = str(blockNumber + 1)
-                state = block.userState()
+                number = str(blockNumber + 1 + self.line_offset)
+                state = block_role(block)
                 if state == 1:
                     color = QColor("#aaffaa") # ユーザ (薄い緑)
                 elif state == 2:
@@ -118,404 +156,518 @@ class CodeEditor(QPlainTextEdit):
             blockNumber += 1
 
 
-class PlaywrightWorker(QThread):
-    chat_signal = pyqtSignal(dict)
+def block_role(block):
+    state = block.userState()
+    return state & ROLE_MASK if state >= 0 else 0
+
+def set_block_role(block, role):
+    # ハイライト状態 (上位bit) を残したまま行番号色だけを書き換える
+    state = block.userState()
+    block.setUserState(role if state < 0 else (state & ~ROLE_MASK) | role)
+
+
+class CodeLexer:
+    # 1行分の字句を正規表現1本で読む。複数行コメント・文字列の途中で行が終わった場合は、その区切りの番号 (1〜3) を返す
+    def __init__(self, spec):
+        self.blocks = spec.get("blocks", ())
+        self.openers = tuple(start for start, _, _ in self.blocks)
+        parts = [f"(?P<block{index}>{re.escape(start)}.*?(?:{re.escape(end)}|$))" for index, (start, end, _) in enumerate(self.blocks)]
+        if spec.get("line_comment"):
+            parts.append(f"(?P<comment>{re.escape(spec['line_comment'])}.*)")
+        if spec.get("tags"):
+            parts.append(r"(?P<keyword></?[A-Za-z][\w:.-]*|/?>)")
+        if spec.get("strings", bool(spec)):
+            strings = spec.get("strings")
+            if not isinstance(strings, str): strings = r'"(?:[^"\\]|\\.)*"?|\'(?:[^\'\\]|\\.)*\'?'
+            parts.append(f"(?P<string>{strings})")
+        parts.append(r"(?P<number>\b(?:0[xX][0-9a-fA-F]+|\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)\b)")
+        for kind in ("keyword", "type"):
+            words = spec.get(kind + "s")
+            if words: parts.append(f"(?P<{kind}>\\b(?:{'|'.join(map(re.escape, words))})\\b)")
+        self.pattern = re.compile("|".join(parts), re.IGNORECASE if spec.get("ignore_case") else 0)
+
+    def scan(self, text, pending, spans):
+        # pending は前の行から続いている区切りの番号 (0は無し)。spans が None の場合は色付けせず、行末の状態だけを求める
+        position = 0
+        if pending:
+            _, end, kind = self.blocks[pending - 1]
+            close = text.find(end)
+            if close < 0:
+                if spans is not None: spans.append((0, len(text), kind))
+                return pending
+            position = close + len(end)
+            if spans is not None: spans.append((0, position, kind))
+            pending = 0
+        if spans is None and not any(opener in text for opener in self.openers):
+            return 0
+
+        for match in self.pattern.finditer(text, position):
+            kind = match.lastgroup
+            if kind.startswith("block"):
+                index = int(kind[5:])
+                start, end, kind = self.blocks[index]
+                token = match.group()
+                if len(token) < len(start) + len(end) or not token.endswith(end):
+                    pending = index + 1
+            if spans is not None: spans.append((match.start(), match.end() - match.start(), kind))
+        return pending
+
+
+class HighlightData(QTextBlockUserData):
+    # コードブロック内のブロックに付け、表示範囲で色付け済みかどうかを覚えておく
+    def __init__(self):
+        super().__init__()
+        self.formatted = False
+
+
+class CodeBlockHighlighter(QSyntaxHighlighter):
+    # chat_log のコードブロック区切り内を "## 言語名" ごとの簡易字句規則で色分けする。
+    # ブロックの userState は下位4bitが行番号色 (発言者)、その上がコード状態 (言語番号 << 2 | 複数行コメント・文字列の途中か)。
+    # 状態は全ブロックで求めるが色付けは表示範囲の前後だけで行い、範囲外で状態だけ求めたブロックは表示範囲に入った時に塗る。
+    # QSyntaxHighlighter は変更されたブロックから状態が変わらなくなるまでしか再計算しないため、ストリーミング中は末尾だけが対象になる
+    def __init__(self, editor):
+        super().__init__(editor.document())
+        self.editor = editor
+        self.view_first = 0
+        self.view_last = -1
+        self.lexers = [None, CodeLexer({})] + [CodeLexer(spec) for spec in CODE_LEXERS]
+        self.lexer_ids = {alias: index + 2 for index, spec in enumerate(CODE_LEXERS) for alias in spec["aliases"]}
+        self.formats = {}
+        for kind, (color, italic) in HIGHLIGHT_STYLES.items():
+            char_format = QTextCharFormat()
+            char_format.setForeground(QColor(color))
+            char_format.setFontItalic(italic)
+            self.formats[kind] = char_format
+        self.view_timer = QTimer(self)
+        self.view_timer.setSingleShot(True)
+        self.view_timer.setInterval(0)
+        self.view_timer.timeout.connect(self.highlight_viewport)
+        editor.updateRequest.connect(lambda rect, dy: self.view_timer.start())
+
+    def update_view_range(self):
+        # 表示中のブロックと、その上下1画面分を色付けの対象にする
+        editor = self.editor
+        lines = editor.viewport().height() // max(1, editor.fontMetrics().height()) + 1
+        first = editor.firstVisibleBlock().blockNumber()
+        self.view_first = max(0, first - lines)
+        self.view_last = first + lines * 2
+
+    def highlight_viewport(self):
+        self.update_view_range()
+        block = self.document().findBlockByNumber(self.view_first)
+        while block.isValid() and block.blockNumber() <= self.view_last:
+            data = block.userData()
+            if data is not None and not data.formatted:
+                self.rehighlightBlock(block)
+            block = block.next()
+
+    def to_utf16(self, text, spans):
+        # setFormat の位置は UTF-16 単位のため、BMP外の文字 (絵文字など) を含む行は位置を数え直す
+        offsets = [0]
+        for char in text:
+            offsets.append(offsets[-1] + (2 if ord(char) > 0xFFFF else 1))
+        return [(offsets[start], offsets[start + length] - offsets[start], kind) for start, length, kind in spans]
+
+    def highlightBlock(self, text):
+        previous = self.previousBlockState()
+        code = previous >> 4 if previous >= 0 else 0
+        current = self.currentBlockState()
+        role = current & ROLE_MASK if current >= 0 else 0
+        if code == 0 and text != CODE_BLOCK_START:
+            self.setCurrentBlockState(role)
+            data = self.currentBlockUserData()
+            if data is not None: data.formatted = True
+            return
+
+        number = self.currentBlock().blockNumber()
+        visible = self.view_first <= number <= self.view_last
+        if code == 0:
+            code = 1 << 2
+            if visible: self.setFormat(0, len(text), self.formats["marker"])
+        elif text == CODE_BLOCK_END:
+            code = 0
+            if visible: self.setFormat(0, len(text), self.formats["marker"])
+        elif code >> 2 == 1 and text.startswith("## ") and self.currentBlock().previous().text() == CODE_BLOCK_START:
+            code = self.lexer_ids.get(text[3:].strip().upper(), 1) << 2
+            if visible: self.setFormat(0, len(text), self.formats["header"])
+        else:
+            lexer_id, pending = code >> 2, code & 3
+            spans = [] if visible else None
+            pending = self.lexers[lexer_id].scan(text, pending, spans)
+            if spans and len(text.encode("utf-16-le")) != len(text) * 2:
+                spans = self.to_utf16(text, spans)
+            for start, length, kind in spans or ():
+                self.setFormat(start, length, self.formats[kind])
+            code = lexer_id << 2 | pending
+
+        data = self.currentBlockUserData()
+        if data is None:
+            data = HighlightData()
+            self.setCurrentBlockUserData(data)
+        data.formatted = visible
+        self.setCurrentBlockState(role | code << 4)
+
+
+class ChatLogView(CodeEditor):
+    # 表示内容は entries ([テキスト, 行番号色, ターン番号]) を正とし、ドキュメントには window_start 以降だけを置く。
+    # 下端で読んでいる間は末尾の CHAT_PAGE_TURNS 件前後に保ち、上端までスクロールするとその前の CHAT_PAGE_TURNS 件を先頭へ読み込む。
+    # 行番号は表示していない先頭部分の行数 (line_offset) を足した通し番号、行番号色はエントリごとに付け直すため、ページをまたいでも変わらない
+    # ストリーミング差分はバッファに溜め、表示フレーム(約16ms)ごとに1回だけ反映する。途中からの置き換えは回答の開始位置 (stream_origin) からの文字数で受け取る
+    ROLE_STATES = {"user": 1, "ai": 2}
+    STREAM_FLUSH_MS = 16
+
+    def __init__(self):
+        super().__init__()
+        self.setReadOnly(True)
+        self.entries = []
+        self.turn_entries = []
+        self.window_start = 0
+        self.line_starts = None
+        self.page_size = CHAT_PAGE_TURNS
+        self.updating = False
+        self.stream_origin = None
+        self.stream_buffer = []
+        self.stream_timer = QTimer(self)
+        self.stream_timer.setSingleShot(True)
+        self.stream_timer.setInterval(self.STREAM_FLUSH_MS)
+        self.stream_timer.timeout.connect(self.flush_stream)
+        self.verticalScrollBar().valueChanged.connect(self.on_scroll)
+        self.highlighter = CodeBlockHighlighter(self)
+
+    def clear_log(self):
+        self.stream_timer.stop()
+        self.stream_buffer.clear()
+        self.stream_origin = None
+        self.entries = []
+        self.turn_entries = []
+        self.line_starts = None
+        self.window_start = 0
+        self.line_offset = 0
+        with self.editing():
+            self.clear()
+
+    def make_entry(self, data, turn=None):
+        if turn is None: turn = data.get("turn")
+        return [data.get("text", "") + "\n", self.ROLE_STATES.get(data.get("role", "system"), 0), turn]
+
+    def register_entries(self, first):
+        for index in range(first, len(self.entries)):
+            if self.entries[index][2] == len(self.turn_entries):
+                self.turn_entries.append(index)
+
+    def line_count(self, first, last):
+        return sum(entry[0].count("\n") for entry in self.entries[first:last])
+
+    def paint_entries(self, block_number, first, last):
+        # entries[first:last] を block_number から順に塗り、直後のブロック (挿入で分割されて状態を失う) も続くエントリの色に戻す
+        block = self.document().findBlockByNumber(block_number)
+        for text, state, _ in self.entries[first:last]:
+            for _ in range(text.count("\n")):
+                if not block.isValid(): return
+                set_block_role(block, state)
+                block = block.next()
+        if block.isValid():
+            if last < len(self.entries): set_block_role(block, self.entries[last][1])
+            elif last > first: set_block_role(block, self.entries[last - 1][1])
+
+    def insert_entries(self, cursor, first, last):
+        block_number = cursor.blockNumber()
+        cursor.beginEditBlock()
+        cursor.insertText("".join(entry[0] for entry in self.entries[first:last]))
+        cursor.endEditBlock()
+        self.paint_entries(block_number, first, last)
+
+    def render_window(self, start):
+        # ドキュメントを entries[start:] で作り直す
+        with self.editing():
+            self.window_start = start
+            self.line_offset = self.line_count(0, start)
+            self.clear()
+            self.insert_entries(QTextCursor(self.document()), start, len(self.entries))
+
+    def append_entries(self, entries):
+        self.flush_stream()
+        first = len(self.entries)
+        self.entries.extend(entries)
+        self.line_starts = None
+        self.register_entries(first)
+        with self.editing():
+            if len(self.entries) - self.window_start > self.page_size * 2 and (len(entries) >= self.page_size or self.is_at_bottom()):
+                # 大きな一括描画や下端で読んでいる場合は、末尾の1ページ分だけを置き直す
+                self.render_window(len(self.entries) - self.page_size)
+            else:
+                cursor = QTextCursor(self.document())
+                cursor.movePosition(QTextCursor.MoveOperation.End)
+                self.insert_entries(cursor, first, len(self.entries))
+                self.setTextCursor(cursor)
+            self.scroll_to_bottom()
+
+    def trim_window(self):
+        # 下端で読んでいる間にドキュメントが2ページ分を超えたら、先頭から1ページ分を捨てる
+        if len(self.entries) - self.window_start <= self.page_size * 2 or not self.is_at_bottom(): return
+        start = len(self.entries) - self.page_size
+        lines = self.line_count(self.window_start, start)
+        doc = self.document()
+        with self.editing():
+            cursor = QTextCursor(doc)
+            cursor.setPosition(doc.findBlockByNumber(lines).position(), QTextCursor.MoveMode.KeepAnchor)
+            cursor.removeSelectedText()
+            self.window_start = start
+            self.line_offset += lines
+            self.updateLineNumberAreaWidth(0)
+            self.scroll_to_bottom()
+
+    def load_older(self, start=None):
+        # 表示中の先頭より前のエントリをドキュメント先頭へ差し込み、見ていた位置がずれないようスクロール量を補正する
+        if self.window_start == 0: return
+        if start is None: start = self.window_start - self.page_size
+        start = max(0, start)
+        end = self.window_start
+        bar = self.verticalScrollBar()
+        layout = self.document().documentLayout()
+        with self.editing():
+            value = bar.value()
+            height = layout.documentSize().height()
+            self.insert_entries(QTextCursor(self.document()), start, end)
+            self.window_start = start
+            self.line_offset -= self.line_count(start, end)
+            self.updateLineNumberAreaWidth(0)
+            bar.setValue(value + round(layout.documentSize().height() - height))
+
+    @contextmanager
+    def editing(self):
+        # 自前の書き換え中に起きるスクロール位置の変化では、ページの読み込み・破棄を行わない
+        updating = self.updating
+        self.updating = True
+        try:
+            yield
+        finally:
+            self.updating = updating
+
+    def on_scroll(self, value):
+        if self.updating: return
+        if value == self.verticalScrollBar().minimum() and self.window_start > 0:
+            self.load_older()
+        elif self.is_at_bottom():
+            self.trim_window()
+
+    def scroll_to_bottom(self):
+        self.verticalScrollBar().setValue(self.verticalScrollBar().maximum())
+
+    def is_at_bottom(self):
+        bar = self.verticalScrollBar()
+        return bar.value() >= bar.maximum() - 4
+
+    def append_message(self, data):
+        self.append_entries([self.make_entry(data)])
+
+    def append_batch(self, items):
+        # 全ターンを1回のinsertTextで流し込み、行番号色はQTextBlock.next()で順に設定する
+        if not items: return
+        self.append_entries([self.make_entry(data) for data in items])
+
+    def start_stream(self, data):
+        self.append_message(data)
+        self.stream_origin = (len(self.entries) - 1, len(self.entries[-1][0]))
+
+    def append_stream(self, text):
+        self.stream_buffer.append(text)
+        if not self.stream_timer.isActive():
+            self.stream_timer.start()
+
+    def flush_stream(self):
+        if not self.stream_buffer: return
+        self.stream_timer.stop()
+        text = "".join(self.stream_buffer)
+        self.stream_buffer.clear()
+
+        state = 2 # AI
+        if self.entries and self.entries[-1][1] == state:
+            self.entries[-1][0] += text
+        else:
+            self.entries.append([text, state, None])
+        self.line_starts = None
+        follow = self.is_at_bottom()
+        with self.editing():
+            cursor = QTextCursor(self.document())
+            cursor.movePosition(QTextCursor.MoveOperation.End)
+            start_block = cursor.blockNumber()
+            cursor.insertText(text)
+            end_block = self.document().blockCount()
+
+            block = self.document().findBlockByNumber(start_block)
+            for _ in range(end_block - start_block):
+                set_block_role(block, state)
+                block = block.next()
+
+            # ユーザが上へスクロールして読んでいる間は追従しない
+            if follow:
+                self.scroll_to_bottom()
+
+    def replace_stream(self, offset, text):
+        # 回答の offset 文字目以降を text で置き換える (ページ側でマークダウンが描画し直された場合など)
+        self.flush_stream()
+        if self.stream_origin is None: return
+        index, base = self.stream_origin
+        entry = self.entries[index]
+        removed = entry[0][base + offset:]
+        entry[0] = entry[0][:base + offset] + text
+        self.line_starts = None
+        if index < self.window_start:
+            self.line_offset += text.count("\n") - removed.count("\n")
+            return
+        if index != len(self.entries) - 1:
+            self.render_window(self.window_start)
+            return
+
+        doc = self.document()
+        follow = self.is_at_bottom()
+        with self.editing():
+            cursor = QTextCursor(doc)
+            cursor.movePosition(QTextCursor.MoveOperation.End)
+            # QTextDocument の位置は UTF-16 単位で数える
+            position = cursor.position() - len(removed.encode("utf-16-le")) // 2
+            start_block = doc.findBlock(position).blockNumber()
+            cursor.setPosition(position, QTextCursor.MoveMode.KeepAnchor)
+            cursor.insertText(text)
+
+            block = doc.findBlockByNumber(start_block)
+            while block.isValid():
+                set_block_role(block, entry[1])
+                block = block.next()
+            if follow:
+                self.scroll_to_bottom()
+
+    def entry_line(self, index):
+        # entries[index] の先頭の通し行番号 (0始まり)。累積行数は entries が変わった後の最初の呼び出しでだけ作り直す
+        if self.line_starts is None:
+            starts = [0]
+            for text, _, _ in self.entries:
+                starts.append(starts[-1] + text.count("\n"))
+            self.line_starts = starts
+        return self.line_starts[index]
+
+    def scroll_to_turn(self, turn, line=0, last_line=None):
+        # ターン内の line 行目 (format_chat_item のテキスト上の行) を先頭に表示する。last_line を指定するとその行まで選択する
+        if not (0 <= turn < len(self.turn_entries)): return
+        index = self.turn_entries[turn]
+        if index < self.window_start:
+            self.load_older(index)
+        doc = self.document()
+        block_number = self.entry_line(index) - self.line_offset
+        with self.editing():
+            cursor = QTextCursor(doc.findBlockByNumber(block_number + line))
+            if last_line is not None:
+                end = doc.findBlockByNumber(block_number + last_line)
+                cursor = QTextCursor(end)
+                cursor.movePosition(QTextCursor.MoveOperation.EndOfBlock)
+                cursor.setPosition(doc.findBlockByNumber(block_number + line).position(), QTextCursor.MoveMode.KeepAnchor)
+            self.setTextCursor(cursor)
+            self.verticalScrollBar().setValue(self.verticalScrollBar().maximum())
+            self.ensureCursorVisible()
+
+    def apply_patch(self, patch):
+        if patch.get("base") != len(self.turn_entries):
+            # 表示中のターン構成が不明な場合は、差分を末尾へ追記する
+            for op in patch.get("ops", []):
+                for item in op.get("items", []):
+                    self.append_message(item)
+            return
+
+        self.flush_stream()
+        self.stream_origin = None
+        with self.editing():
+            self.apply_ops(patch.get("ops", []))
+            self.updateLineNumberAreaWidth(0)
+            self.scroll_to_bottom()
+
+    def apply_ops(self, ops):
+        doc = self.document()
+        self.line_starts = None
+        for op in ops:
+            start, end, items = op["start"], op["end"], op.get("items", [])
+            if start < len(self.turn_entries):
+                first = self.turn_entries[start]
+            elif self.turn_entries:
+                first = self.turn_entries[-1] + 1
+            else:
+                first = len(self.entries)
+            last = self.turn_entries[end - 1] + 1 if end > start else first
+            new_entries = [self.make_entry(item, start + k) for k, item in enumerate(items)]
+            delta = len(new_entries) - (last - first)
+
+            if last <= self.window_start and first < self.window_start:
+                # 表示していない範囲だけの変更は、エントリと行番号のずれのみ反映する
+                self.line_offset += sum(entry[0].count("\n") for entry in new_entries) - self.line_count(first, last)
+                self.window_start += delta
+                self.entries[first:last] = new_entries
+            elif first < self.window_start:
+                self.entries[first:last] = new_entries
+                self.render_window(first)
+            else:
+                block_number = self.line_count(self.window_start, first)
+                old_count = self.line_count(first, last)
+                self.entries[first:last] = new_entries
+                cursor = QTextCursor(doc.findBlockByNumber(block_number))
+                if old_count:
+                    cursor.setPosition(doc.findBlockByNumber(block_number + old_count).position(), QTextCursor.MoveMode.KeepAnchor)
+                    cursor.removeSelectedText()
+                self.insert_entries(cursor, first, first + len(new_entries))
+
+            self.turn_entries[start:end] = [first + k for k in range(len(new_entries))]
+            # 後続のターンはエントリ位置とエントリ側のターン番号 (register_entries が参照する) の両方を付け直す
+            for turn in range(start + len(new_entries), len(self.turn_entries)):
+                self.turn_entries[turn] += delta
+                self.entries[self.turn_entries[turn]][2] = turn
+
+
+class PlaywrightWorker(QThread, BrowserWorker):
+    # GUI用: BrowserWorker をQThread上で動かし、UIへはQtのシグナルで通知する
+    chat_batch_signal = pyqtSignal(list)
+    chat_patch_signal = pyqtSignal(dict)
     stream_start_signal = pyqtSignal(dict)
     stream_signal = pyqtSignal(str)
+    stream_patch_signal = pyqtSignal(dict)
     sys_signal = pyqtSignal(dict)
     history_list_signal = pyqtSignal(list)
 
     def __init__(self, msg_queue):
-        super().__init__()
-        self.msg_queue = msg_queue
-        self.is_running = True
-        self.timeout_ms = 300000
-        self.current_chat_id = "new_chat"
-
-    def emit_sys_line(self, text):
-        logger.info(text)
-        self.sys_signal.emit({"type": "line", "text": text})
-
-    def emit_sys_append(self, text):
-        self.sys_signal.emit({"type": "append", "text": text})
-
-    def get_chat_id(self, url):
-        match = re.search(r'/c/([a-zA-Z0-9-]+)', url)
-        return match.group(1) if match else "new_chat"
-
-    def compress_text(self, text):
-        if not text: return ""
-        return re.sub(r'\n{3,}', '\n\n', text.strip())
-
-    def send_chat_data(self, data_list):
-        for item in data_list:
-            role = item.get('role', 'unknown')
-            content = self.compress_text(item.get('text', ''))
-            if role == 'user':
-                self.chat_signal.emit({"role": "user", "text": f"\nユーザ:\n{content}\n"})
-            elif role == 'assistant':
-                self.chat_signal.emit({"role": "ai", "text": f"\nAI:\n{content}\n"})
-            else:
-                self.chat_signal.emit({"role": "system", "text": f"\n不明:\n{content}\n"})
-
-    def fetch_sidebar_history(self, page):
-        self.emit_sys_line("システム: 最新の履歴リストの同期を試みます")
-        js_code = """
-        () => {
-            const links = document.querySelectorAll('nav a[href^="/c/"]');
-            return Array.from(links).slice(0, 50).map(a => {
-                let title = a.innerText.split('\\n')[0].trim();
-                return {title: title, url: a.href};
-            });
-        }
-        """
-        history_data = []
-        for attempt in range(20):
-            if not self.is_running: return
-            try:
-                history_data = page.evaluate(js_code)
-                if history_data and len(history_data) > 0:
-                    self.emit_sys_append(" 完了\n")
-                    break
-            except Exception as e: pass
-            self.emit_sys_append(".")
-            page.wait_for_timeout(3000)
+        super().__init__(msg_queue=msg_queue)
 
-        if history_data:
-            self.history_list_signal.emit(history_data)
-            self.emit_sys_line(f"システム: {len(history_data)}件の履歴リストを同期しました。")
-        else:
-            self.emit_sys_line("システムエラー: 規定回数リトライしましたが、履歴リストを取得できませんでした。")
-
-    def scrape_current_chat(self, page):
-        # 実DOMからの直接抽出と退避による、改行・言語の絶対保持ロジック
-        js_code = """
-        () => {
-            const articles = document.querySelectorAll('article[data-testid^="conversation-turn"]');
-
-            const container = document.createElement('div');
-            container.style.position = 'absolute';
-            container.style.left = '-9999px';
-            container.style.width = '1000px';
-            container.style.whiteSpace = 'pre-wrap';
-            document.body.appendChild(container);
-
-            const results = Array.from(articles).map(a => {
-                const roleEl = a.querySelector('[data-message-author-role]');
-                const role = roleEl ? roleEl.getAttribute('data-message-author-role') : 'unknown';
-
-                // ★超重要：画面にマウント済みの実要素(a)からコードを直接抽出し退避させる★
-                const originalPres = Array.from(a.querySelectorAll('pre'));
-                const preTexts = originalPres.map(pre => {
-                    let lang = '';
-                    const codeEl = pre.querySelector('code');
-
-                    if (codeEl && codeEl.className) {
-                        const match = codeEl.className.match(/language-([a-zA-Z0-9_\\-]+)/);
-                        if (match) lang = match[1].toUpperCase();
-                    }
-                    if (!lang) {
-                        const headerSpan = pre.querySelector('.flex.items-center span, .bg-token-main-surface-secondary span');
-                        if (headerSpan && headerSpan.textContent) {
-                            lang = headerSpan.textContent.trim().toUpperCase();
-                        }
-                    }
-
-                    // 実画面のinnerTextを使うため、ブラウザが計算した完璧な改行が保持される
-                    let text = pre.innerText || pre.textContent;
-
-                    // Copy codeボタン等の混入ノイズを消去
-                    text = text.replace(/^(Copy code|コピー)\\s*/i, '').trim();
-                    if (lang && lang !== 'CODE' && lang !== 'TEXT' && lang !== 'PLAINTEXT') {
-                        const langRegex = new RegExp('^' + lang + '\\\\s*', 'i');
-                        text = text.replace(langRegex, '').trim();
-                        lang = '## ' + lang + '\\n';
-                    } else {
-                        lang = '';
-                    }
-
-                    return '\\n========コードブロック箇所ここから========\\n' + lang + text + '\\n========コードブロック箇所ここまで========\\n';
-                });
-
-                const targetEl = roleEl ? roleEl : a;
-                const clone = targetEl.cloneNode(true);
-
-                // clone側のpreをプレースホルダに置き換える
-                clone.querySelectorAll('pre').forEach((pre, idx) => {
-                    const marker = document.createElement('div');
-                    marker.innerText = `___CODE_BLOCK_${idx}___`;
-                    pre.replaceWith(marker);
-                });
-
-                // リスト改行の保護
-                clone.querySelectorAll('ol').forEach(ol => {
-                    let i = 1;
-                    Array.from(ol.children).forEach(child => {
-                        if (child.tagName === 'LI') {
-                            const p = child.querySelector('p');
-                            (p ? p : child).prepend(document.createTextNode(i + '. '));
-                            i++;
-                        }
-                    });
-                });
-                clone.querySelectorAll('ul').forEach(ul => {
-                    Array.from(ul.children).forEach(child => {
-                        if (child.tagName === 'LI') {
-                            const p = child.querySelector('p');
-                            (p ? p : child).prepend(document.createTextNode('・ '));
-                        }
-                    });
-                });
-
-                const wrapperDiv = document.createElement('div');
-                wrapperDiv.appendChild(clone);
-                container.appendChild(wrapperDiv);
-
-                return { role: role, element: wrapperDiv, codes: preTexts };
-            });
-
-            // コンテナで計算された本文テキストと、退避させた完璧なコードテキストを合体
-            const finalData = results.map(item => {
-                let text = item.element.innerText;
-                item.codes.forEach((codeStr, idx) => {
-                    text = text.replace(`___CODE_BLOCK_${idx}___`, codeStr);
-                });
-                return { role: item.role, text: text };
-            });
-
-            document.body.removeChild(container);
-            return finalData;
-        }
-        """
-        try:
-            return page.evaluate(js_code)
-        except Exception as e:
-            logger.debug(f"JS Bulk Evaluate Error: {e}")
-            return []
-
-    def sync_history_fast(self, page, url, force_web=False):
-        self.current_chat_id = self.get_chat_id(url)
-        cache_path = os.path.join(TMP_DIR, f"{self.current_chat_id}.json")
-
-        cached_data = []
-        if not force_web and os.path.exists(cache_path) and self.current_chat_id != "new_chat":
-            try:
-                with open(cache_path, "r", encoding="utf-8") as f:
-                    cached_data = json.load(f)
-                if cached_data:
-                    self.emit_sys_line("システム: ローカルキャッシュを展開しました。")
-                    self.chat_signal.emit({"role": "system", "text": "----------------------------------------\n【履歴同期】"})
-                    self.send_chat_data(cached_data)
-                    self.chat_signal.emit({"role": "system", "text": "----------------------------------------\n"})
-            except Exception as e:
-                logger.error(f"Cache Load Error: {e}")
-
-        if self.current_chat_id != "new_chat":
-            self.emit_sys_line("システム: ブラウザ側のDOM同期を待機中 (取得漏れ防止のため下へスクロール中...)")
-            dom_ready = False
-            last_count = -1
-            stable_polls = 0
-
-            try:
-                page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
-            except: pass
-
-            for attempt in range(40):
-                if not self.is_running: return
-                try:
-                    count = page.locator('article[data-testid^="conversation-turn"]').count()
-                    if count > 0:
-                        self.emit_sys_append(f" [検知:{count}件]")
-                        if count == last_count:
-                            stable_polls += 1
-                            if stable_polls >= 4:
-                                self.emit_sys_append(" 安定化確認\n")
-                                dom_ready = True
-                                break
-                        else:
-                            stable_polls = 0
-                            page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
-                        last_count = count
-                    else:
-                        self.emit_sys_append(".")
-                except Exception as e:
-                    if "closed" in str(e).lower() or "target" in str(e).lower():
-                        raise e
-                page.wait_for_timeout(1000)
-
-            if not dom_ready:
-                self.emit_sys_append(" タイムアウト\n")
-                self.emit_sys_line("システム: DOM同期がタイムアウトしました。取得できた状態までで進行します。")
+    def run(self):
+        BrowserWorker.run(self)
 
-        try:
-            self.emit_sys_line("システム: コンテキストを超高速一括解析中...")
-            current_data = self.scrape_current_chat(page)
-
-            if not cached_data:
-                if current_data:
-                    if not force_web:
-                        self.chat_signal.emit({"role": "system", "text": "----------------------------------------\n【履歴同期 (Web)】"})
-                    self.send_chat_data(current_data)
-                    if not force_web:
-                        self.chat_signal.emit({"role": "system", "text": "----------------------------------------\n"})
-            else:
-                diff_len = len(current_data) - len(cached_data)
-                if diff_len > 0:
-                    new_items = current_data[-diff_len:]
-                    self.emit_sys_line(f"システム: Web側との差分({diff_len}件)を追記します。")
-                    self.send_chat_data(new_items)
+class HistoryListModel(QAbstractListModel):
+    # history_combo 用のモデル。数万件でもアイテムオブジェクトを作らず、受け取ったリストを直接参照する
+    NEW_CHAT = {"title": "【新規チャットを作成】", "url": "https://chatgpt.com/"}
 
-            if self.current_chat_id != "new_chat":
-                with open(cache_path, "w", encoding="utf-8") as f:
-                    json.dump(current_data, f, ensure_ascii=False, indent=2)
+    def __init__(self):
+        super().__init__()
+        self.items = [self.NEW_CHAT]
+        self.rows_by_url = {self.NEW_CHAT["url"]: 0}
 
-            self.emit_sys_line("システム: コンテキスト完全同期完了。")
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.items)
 
-        except Exception as e:
-            self.emit_sys_line(f"システムエラー: 高速同期に失敗しました。詳細: {e}")
-            raise e
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid(): return None
+        item = self.items[index.row()]
+        if role in (Qt.ItemDataRole.DisplayRole, Qt.ItemDataRole.EditRole):
+            return item["title"]
+        if role in (Qt.ItemDataRole.UserRole, Qt.ItemDataRole.ToolTipRole):
+            return item["url"]
+        return None
 
-    def run(self):
-        while self.is_running:
-            browser_context = None
-            try:
-                with sync_playwright() as p:
-                    self.emit_sys_line("システム: バックグラウンドブラウザを起動中...")
-                    browser_context = p.chromium.launch_persistent_context(
-                        user_data_dir=SESSION_DIR,
-                        headless=False,
-                        args=["--disable-blink-features=AutomationControlled", "--no-sandbox"],
-                        no_viewport=True
-                    )
-
-                    page = browser_context.pages[0] if browser_context.pages else browser_context.new_page()
-                    page.set_default_navigation_timeout(self.timeout_ms)
-                    page.set_default_timeout(self.timeout_ms)
-
-                    self.emit_sys_line("システム: ChatGPTへ接続しています...")
-                    page.goto("https://chatgpt.com/", wait_until="domcontentloaded")
-
-                    self.emit_sys_line("システム: 初期アクセス完了。")
-                    self.fetch_sidebar_history(page)
-                    self.sync_history_fast(page, page.url)
-
-                    while self.is_running:
-                        try:
-                            msg = self.msg_queue.get(timeout=1)
-                            if not isinstance(msg, dict): continue
-                            msg_type = msg.get("type")
-
-                            if msg_type == "QUIT":
-                                break
-
-                            elif msg_type == "FETCH_SIDEBAR":
-                                self.fetch_sidebar_history(page)
-
-                            elif msg_type == "RELOAD_DELETE":
-                                url = msg.get("url")
-                                if not url: url = "https://chatgpt.com/"
-                                self.emit_sys_line(f"システム: キャッシュを削除してリロードを実行中... ({url})")
-                                chat_id = self.get_chat_id(url)
-                                path = os.path.join(TMP_DIR, f"{chat_id}.json")
-                                if os.path.exists(path):
-                                    try: os.remove(path)
-                                    except: pass
-                                page.reload(wait_until="domcontentloaded")
-                                self.sync_history_fast(page, url, force_web=True)
-
-                            elif msg_type == "RELOAD_SIMPLE":
-                                url = msg.get("url")
-                                if not url: url = "https://chatgpt.com/"
-                                self.emit_sys_line(f"システム: 単純リロードを実行中... ({url})")
-                                page.reload(wait_until="domcontentloaded")
-                                self.sync_history_fast(page, url, force_web=True)
-
-                            elif msg_type == "CLEAR_CACHE":
-                                self.emit_sys_line("システム: tmp1内の全キャッシュをクリア中...")
-                                count = 0
-                                for filename in os.listdir(TMP_DIR):
-                                    filepath = os.path.join(TMP_DIR, filename)
-                                    if os.path.isfile(filepath):
-                                        try:
-                                            os.remove(filepath)
-                                            count += 1
-                                        except: pass
-                                self.emit_sys_line(f"システム: キャッシュクリア完了。{count}件削除しました。")
-                                self.fetch_sidebar_history(page)
-
-                            elif msg_type == "NAVIGATE":
-                                url = msg.get("url")
-                                if not url: url = "https://chatgpt.com/"
-                                self.emit_sys_line(f"システム: 指定URLへ移動中... ({url})")
-                                page.goto(url, wait_until="domcontentloaded")
-                                self.sync_history_fast(page, url)
-
-                            elif msg_type == "SEND":
-                                text = msg.get("text")
-                                self.emit_sys_line("システム: メッセージ送信中...")
-
-                                page.fill('#prompt-textarea', text)
-                                page.wait_for_timeout(500)
-                                page.keyboard.press('Enter')
-
-                                self.emit_sys_line("システム: AIの応答を待機中")
-                                page.wait_for_timeout(3000)
-
-                                last_text = ""
-                                stable_count = 0
-                                self.stream_start_signal.emit({"role": "ai", "text": "\nAI:\n"})
-
-                                for _ in range(600):
-                                    if not self.is_running: break
-                                    page.wait_for_timeout(1000)
-                                    self.emit_sys_append(".")
-                                    assistant_messages = page.locator('[data-message-author-role="assistant"]').all()
-                                    if not assistant_messages: continue
-
-                                    try:
-                                        raw_current_text = assistant_messages[-1].inner_text(timeout=1000)
-                                    except: continue
-
-                                    current_text = self.compress_text(raw_current_text)
-
-                                    if current_text != last_text:
-                                        diff = current_text[len(last_text):]
-                                        if diff:
-                                            self.stream_signal.emit(diff)
-                                        last_text = current_text
-                                        stable_count = 0
-                                    else:
-                                        if current_text: stable_count += 1
-
-                                    if stable_count >= 10:
-                                        self.stream_signal.emit("\n\n")
-                                        self.emit_sys_append(" 完了\n")
-                                        self.emit_sys_line("システム: 回答完了。最新のキャッシュを構築します...")
-                                        if self.current_chat_id != "new_chat":
-                                            updated_data = self.scrape_current_chat(page)
-                                            cache_path = os.path.join(TMP_DIR, f"{self.current_chat_id}.json")
-                                            with open(cache_path, "w", encoding="utf-8") as f:
-                                                json.dump(updated_data, f, ensure_ascii=False, indent=2)
-                                        break
-
-                        except queue.Empty:
-                            continue
-                        except Exception as inner_e:
-                            if "closed" in str(inner_e).lower() or "target" in str(inner_e).lower():
-                                raise inner_e
-                            else:
-                                self.emit_sys_line(f"システムエラー(ループ内): {inner_e}")
-
-                    if not self.is_running:
-                        self.emit_sys_line("システム: 終了処理を実行中。プロセスの完全終了を待機しています...")
-                        if browser_context: browser_context.close()
-                        break
-
-            except Exception as e:
-                if not self.is_running: break
-                self.emit_sys_line(f"【警告】ブラウザとの接続が切断されました。({e})")
-                self.emit_sys_line("システム: 5秒後にブラウザの再起動を試みます...")
-                time.sleep(5)
+    def set_items(self, history_data):
+        self.beginResetModel()
+        self.items = [self.NEW_CHAT] + list(history_data)
+        self.rows_by_url = {}
+        for row, item in enumerate(self.items):
+            self.rows_by_url.setdefault(item["url"], row)
+        self.endResetModel()
+
+    def row_of_url(self, url):
+        return self.rows_by_url.get(url, -1)
 
 
 class CustomInputArea(QTextEdit):
@@ -584,6 +736,17 @@ class ChatGPTLightWeightTerminal(QWidget):
         self.history_combo.setEditable(True)
         self.history_combo.setPlaceholderText("履歴リストから選ぶか、URLを直接入力")
         self.history_combo.setSizeAdjustPolicy(QComboBox.SizeAdjustPolicy.AdjustToMinimumContentsLengthWithIcon)
+        self.history_combo.setInsertPolicy(QComboBox.InsertPolicy.NoInsert)
+        self.history_model = HistoryListModel()
+        self.history_combo.setModel(self.history_model)
+        self.history_combo.view().setUniformItemSizes(True)
+        # 入力した文字列を含むタイトルで全履歴を絞り込む
+        self.history_completer = QCompleter(self.history_model, self)
+        self.history_completer.setFilterMode(Qt.MatchFlag.MatchContains)
+        self.history_completer.setCaseSensitivity(Qt.CaseSensitivity.CaseInsensitive)
+        self.history_completer.setMaxVisibleItems(15)
+        self.history_completer.popup().setUniformItemSizes(True)
+        self.history_combo.setCompleter(self.history_completer)
         nav_layout.addWidget(self.history_combo, stretch=1)
 
         self.nav_btn = QPushButton("移動")
@@ -592,11 +755,68 @@ class ChatGPTLightWeightTerminal(QWidget):
 
         main_layout.addLayout(nav_layout)
 
+        search_layout = QHBoxLayout()
+        self.search_box = QLineEdit()
+        self.search_box.setPlaceholderText("キャッシュ全文検索 (全チャット横断・ブラウザ通信なし)")
+        self.search_box.setStyleSheet("background-color: #2d2d2d; color: #ffffff; padding: 5px; border: 1px solid #444; border-radius: 4px;")
+        self.search_box.returnPressed.connect(self.handle_search)
+        search_layout.addWidget(self.search_box, stretch=1)
+
+        self.search_btn = QPushButton("検索")
+        self.search_btn.clicked.connect(self.handle_search)
+        search_layout.addWidget(self.search_btn)
+
+        self.code_btn = QPushButton("コード一覧")
+        self.code_btn.setCheckable(True)
+        self.code_btn.toggled.connect(self.toggle_code_panel)
+        search_layout.addWidget(self.code_btn)
+        main_layout.addLayout(search_layout)
+
+        self.search_results = QListWidget()
+        self.search_results.setMaximumHeight(160)
+        self.search_results.setStyleSheet("background-color: #252526; border: 1px solid #444;")
+        self.search_results.itemActivated.connect(self.handle_search_open)
+        self.search_results.hide()
+        main_layout.addWidget(self.search_results)
+
+        # 検索DBに索引済みのコードブロック一覧。行の選択 (ダブルクリック/Enter) でその位置へ移動する
+        self.code_panel = QWidget()
+        code_layout = QVBoxLayout(self.code_panel)
+        code_layout.setContentsMargins(0, 0, 0, 0)
+        code_toolbar = QHBoxLayout()
+        self.code_scope_combo = QComboBox()
+        self.code_scope_combo.addItems(["表示中のチャット", "全チャット"])
+        self.code_scope_combo.currentIndexChanged.connect(self.refresh_code_blocks)
+        code_toolbar.addWidget(self.code_scope_combo)
+        code_toolbar.addStretch(1)
+        for label, slot in (("更新", self.refresh_code_blocks), ("コピー", self.handle_code_copy), ("一括保存", self.handle_code_export)):
+            button = QPushButton(label)
+            button.clicked.connect(slot)
+            code_toolbar.addWidget(button)
+        code_layout.addLayout(code_toolbar)
+        self.code_table = QTableWidget(0, 5)
+        self.code_table.setHorizontalHeaderLabels(["チャット", "ターン", "言語", "行数", "先頭行"])
+        self.code_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.ResizeToContents)
+        self.code_table.horizontalHeader().setStretchLastSection(True)
+        self.code_table.verticalHeader().setVisible(False)
+        self.code_table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        self.code_table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.code_table.setStyleSheet("background-color: #252526; border: 1px solid #444;")
+        self.code_table.itemActivated.connect(self.handle_code_open)
+        code_layout.addWidget(self.code_table)
+        self.code_panel.setMaximumHeight(220)
+        self.code_panel.hide()
+        main_layout.addWidget(self.code_panel)
+        # 表示中のチャットが更新されたら、キャッシュの書き込み (索引の更新) を待ってから一覧を読み直す
+        self.code_refresh_timer = QTimer(self)
+        self.code_refresh_timer.setSingleShot(True)
+        self.code_refresh_timer.setInterval(1500)
+        self.code_refresh_timer.timeout.connect(self.refresh_code_blocks)
+
         self.splitter = QSplitter(Qt.Orientation.Vertical)
         main_layout.addWidget(self.splitter, stretch=1)
 
-        self.chat_log = CodeEditor()
-        self.chat_log.setReadOnly(True)
+        self.chat_log = ChatLogView()
         self.splitter.addWidget(self.chat_log)
 
         input_widget = QWidget()
@@ -637,6 +857,12 @@ class ChatGPTLightWeightTerminal(QWidget):
         self.send_btn.clicked.connect(self.handle_send)
         hbox.addWidget(self.send_btn)
 
+        self.stop_btn = QPushButton("停止")
+        self.stop_btn.setFixedWidth(80)
+        self.stop_btn.setStyleSheet("background-color: #a1260d;")
+        self.stop_btn.clicked.connect(self.handle_cancel)
+        hbox.addWidget(self.stop_btn)
+
         input_layout.addLayout(hbox)
         self.splitter.addWidget(input_widget)
 
@@ -647,10 +873,39 @@ class ChatGPTLightWeightTerminal(QWidget):
         self.sys_toggle_btn = QPushButton("▲ システムログを隠す")
         self.sys_toggle_btn.setStyleSheet("background-color: #333333; text-align: left; padding-left: 10px;")
         self.sys_toggle_btn.clicked.connect(self.toggle_sys_log)
-        self.sys_log_layout.addWidget(self.sys_toggle_btn)
-
-        self.sys_log = QTextEdit()
+        sys_header_layout = QHBoxLayout()
+        sys_header_layout.addWidget(self.sys_toggle_btn, stretch=1)
+
+        self.metrics_btn = QPushButton("計測")
+        self.metrics_btn.setStyleSheet("background-color: #333333;")
+        self.metrics_btn.setCheckable(True)
+        self.metrics_btn.toggled.connect(self.toggle_metrics)
+        sys_header_layout.addWidget(self.metrics_btn)
+        self.sys_log_layout.addLayout(sys_header_layout)
+
+        # 処理フェーズごとの所要時間 (p50/p95) 一覧。表示中のみ定期更新する
+        self.metrics_table = QTableWidget(0, 5)
+        self.metrics_table.setHorizontalHeaderLabels(["処理", "件数", "p50 (ms)", "p95 (ms)", "最大 (ms)"])
+        self.metrics_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+        self.metrics_table.verticalHeader().setVisible(False)
+        self.metrics_table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        self.metrics_table.setStyleSheet("background-color: #0d0d0d; color: #d4d4d4; font-family: monospace; font-size: 10pt;")
+        self.metrics_table.hide()
+        self.sys_log_layout.addWidget(self.metrics_table)
+        self.metrics_timer = QTimer(self)
+        self.metrics_timer.setInterval(2000)
+        self.metrics_timer.timeout.connect(self.refresh_metrics)
+
+        # 上限行数を超えた古い行はQt側で先頭から破棄される (リングバッファ)
+        self.sys_log = QPlainTextEdit()
         self.sys_log.setReadOnly(True)
+        self.sys_log.setMaximumBlockCount(SYS_LOG_MAX_LINES)
+        self.sys_log_pending = []
+        self.sys_log_line_open = False
+        self.sys_log_timer = QTimer(self)
+        self.sys_log_timer.setSingleShot(True)
+        self.sys_log_timer.setInterval(50)
+        self.sys_log_timer.timeout.connect(self.flush_sys_log)
         self.sys_log.setStyleSheet("background-color: #0d0d0d; color: #00ff00; font-family: monospace; font-size: 10pt;")
         self.sys_log.show()
         self.sys_log_layout.addWidget(self.sys_log)
@@ -662,17 +917,24 @@ class ChatGPTLightWeightTerminal(QWidget):
         self.splitter.setCollapsible(2, False)
         sys_log_widget.setMinimumHeight(35)
 
-        cleanup_old_files()
-
         self.msg_queue = queue.Queue()
         self.worker = PlaywrightWorker(self.msg_queue)
-        self.worker.chat_signal.connect(self.append_chat_log)
+        # 検索結果・コード一覧からキャッシュだけで表示中のチャット (ブラウザ側は移動していない)
+        self.cached_view_chat_id = None
+        self.worker.chat_batch_signal.connect(self.append_chat_batch)
+        self.worker.chat_patch_signal.connect(self.apply_chat_patch)
         self.worker.stream_start_signal.connect(self.append_chat_stream_start)
         self.worker.stream_signal.connect(self.append_chat_stream)
+        self.worker.stream_patch_signal.connect(self.apply_chat_stream_patch)
         self.worker.sys_signal.connect(self.append_sys_log)
         self.worker.history_list_signal.connect(self.update_history_combo)
+        self.restore_last_session()
         self.worker.start()
 
+        threading.Thread(target=search_index.backfill, args=(chat_cache,), daemon=True).start()
+        if METRICS_HTTP_PORT:
+            metrics.serve(METRICS_HTTP_PORT)
+
     def handle_mode_change(self, index):
         if index == 1:
             self.input_box.set_mode("browser")
@@ -690,107 +952,274 @@ class ChatGPTLightWeightTerminal(QWidget):
             self.sys_toggle_btn.setText("▲ システムログを隠す")
             self.splitter.setSizes([sizes[0] - 65, sizes[1], sizes[2] + 65])
 
+    def toggle_metrics(self, checked):
+        self.metrics_table.setVisible(checked)
+        if checked:
+            self.refresh_metrics()
+            self.metrics_timer.start()
+        else:
+            self.metrics_timer.stop()
+
+    def refresh_metrics(self):
+        rows = metrics.summary()
+        self.metrics_table.setRowCount(len(rows))
+        for row, (op, count, p50, p95, peak) in enumerate(rows):
+            values = [op, str(count), f"{p50:.1f}", f"{p95:.1f}", f"{peak:.1f}"]
+            for column, value in enumerate(values):
+                item = QTableWidgetItem(value)
+                if column > 0: item.setTextAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+                self.metrics_table.setItem(row, column, item)
+
     def handle_cache_clear(self):
-        self.chat_log.clear()
-        self.msg_queue.put({"type": "CLEAR_CACHE"})
+        self.cached_view_chat_id = None
+        self.chat_log.clear_log()
+        self.worker.submit({"type": "CLEAR_CACHE"})
 
     def handle_reload_delete(self):
         url = self.history_combo.currentData()
         if not url: url = self.history_combo.currentText().strip()
         if url:
-            self.chat_log.clear()
-            self.msg_queue.put({"type": "RELOAD_DELETE", "url": url})
+            self.cached_view_chat_id = None
+            self.chat_log.clear_log()
+            self.worker.submit({"type": "RELOAD_DELETE", "url": url})
 
     def handle_reload_simple(self):
         url = self.history_combo.currentData()
         if not url: url = self.history_combo.currentText().strip()
         if url:
-            self.chat_log.clear()
-            self.msg_queue.put({"type": "RELOAD_SIMPLE", "url": url})
+            self.cached_view_chat_id = None
+            self.chat_log.clear_log()
+            self.worker.submit({"type": "RELOAD_SIMPLE", "url": url})
 
     def handle_fetch_sidebar(self):
-        self.history_combo.clear()
-        self.history_combo.addItem("【新規チャットを作成】", "https://chatgpt.com/")
-        self.msg_queue.put({"type": "FETCH_SIDEBAR"})
+        # 索引済みのリストは残したまま、Web側の新しい分を取り込む
+        self.worker.submit({"type": "FETCH_SIDEBAR"})
 
     def update_history_combo(self, history_data):
-        self.history_combo.clear()
-        self.history_combo.addItem("【新規チャットを作成】", "https://chatgpt.com/")
-        for item in history_data:
-            self.history_combo.addItem(item["title"], item["url"])
+        # 起動時の索引からWeb側の最新リストへ差し替える際も、選択中のURL (または入力中の文字列) を維持する
+        selected = self.history_combo.currentData()
+        text = self.history_combo.currentText()
+        self.history_model.set_items(history_data)
+        row = self.history_model.row_of_url(selected) if selected else -1
+        if row >= 0:
+            self.history_combo.setCurrentIndex(row)
+        else:
+            self.history_combo.setCurrentIndex(-1)
+            self.history_combo.setEditText(text)
+
+    def restore_last_session(self):
+        # ブラウザ起動を待たずに、保存済みの履歴リストと最後に開いたチャットをtmp1から表示する。
+        # ワーカーはそのチャットを開いて差分だけを反映する
+        state = load_app_state()
+        try: history_data = search_index.history()
+        except Exception as e:
+            logger.error(f"Search Index Error: {e}")
+            history_data = []
+        if not history_data:
+            history_data = state.get("history") or []
+        if history_data:
+            self.update_history_combo(history_data)
+        last_url = state.get("last_url")
+        if not last_url: return
+        chat_id = self.worker.get_chat_id(last_url)
+        if chat_id == "new_chat" or not chat_cache.exists(chat_id): return
+        try:
+            turns = chat_cache.load(chat_id)
+        except Exception as e:
+            logger.error(f"Cache Load Error: {e}")
+            return
+        if not turns: return
+        self.chat_log.append_batch(build_chat_items(turns, title="【履歴同期】"))
+        index = self.history_model.row_of_url(last_url)
+        if index >= 0: self.history_combo.setCurrentIndex(index)
+        else: self.history_combo.setEditText(last_url)
+        self.worker.start_url = last_url
+        self.worker.cache_shown = chat_id
+        self.append_sys_log({"type": "line", "text": "システム: 前回のチャットをローカルキャッシュから表示しました。ブラウザ側と同期中..."})
 
     def handle_nav(self):
         url = self.history_combo.currentData()
         if not url: url = self.history_combo.currentText().strip()
 
         if url:
-            self.chat_log.clear()
-            self.msg_queue.put({"type": "NAVIGATE", "url": url})
+            self.cached_view_chat_id = None
+            self.chat_log.clear_log()
+            self.worker.submit({"type": "NAVIGATE", "url": url})
+
+    def handle_search(self):
+        query = self.search_box.text().strip()
+        self.search_results.clear()
+        if not query:
+            self.search_results.hide()
+            return
+        started = time.perf_counter()
+        results = search_index.search(query)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        for chat_id, turn, role, snippet, title in results:
+            label = "ユーザ" if role == "user" else "AI" if role == "assistant" else "不明"
+            line = " ".join(snippet.split())
+            item = QListWidgetItem(f"[{title or chat_id}] #{turn + 1} {label}: {line}")
+            item.setData(Qt.ItemDataRole.UserRole, (chat_id, turn))
+            self.search_results.addItem(item)
+        if not results:
+            self.search_results.addItem("一致するキャッシュはありません。")
+        self.search_results.show()
+        self.append_sys_log({"type": "line", "text": f"システム: キャッシュ検索 {len(results)}件 ({elapsed_ms:.1f}ms)"})
+
+    def handle_search_open(self, item):
+        hit = item.data(Qt.ItemDataRole.UserRole)
+        if not hit: return
+        chat_id, turn = hit
+        if self.show_cached_chat(chat_id):
+            self.chat_log.scroll_to_turn(turn)
+
+    def show_cached_chat(self, chat_id):
+        try:
+            turns = chat_cache.load(chat_id)
+        except Exception as e:
+            logger.error(f"Cache Load Error: {e}")
+            turns = []
+        if not turns:
+            self.append_sys_log({"type": "line", "text": "システムエラー: 該当チャットのキャッシュが見つかりません。"})
+            return False
+
+        self.chat_log.clear_log()
+        self.append_chat_batch(build_chat_items(turns, title="【キャッシュ表示】"))
+
+        self.history_combo.setEditText(f"https://chatgpt.com/c/{chat_id}")
+        self.cached_view_chat_id = chat_id
+        self.append_sys_log({"type": "line", "text": "システム: キャッシュから表示中です。送信前に「移動」でブラウザと同期してください。"})
+        return True
+
+    def displayed_chat_id(self):
+        # キャッシュ表示中は編集欄にURLだけが入り、選択中の項目とは一致しないため、URLが入力されていればそちらを優先する
+        text = self.history_combo.currentText().strip()
+        url = text if "/c/" in text else self.history_combo.currentData()
+        return self.worker.get_chat_id(url or "")
+
+    def toggle_code_panel(self, checked):
+        self.code_panel.setVisible(checked)
+        if checked: self.refresh_code_blocks()
+
+    def refresh_code_blocks(self):
+        if not self.code_panel.isVisible(): return
+        chat_id = None if self.code_scope_combo.currentIndex() == 1 else self.displayed_chat_id()
+        rows = []
+        if chat_id != "new_chat":
+            try: rows = search_index.code_blocks(chat_id)
+            except Exception as e: logger.error(f"Search Index Error: {e}")
+        self.code_table.setRowCount(len(rows))
+        for row, (block_id, block_chat_id, turn, lang, line_start, line_end, title, first_line) in enumerate(rows):
+            lines = line_end - line_start - (2 if lang else 1)
+            values = [title or block_chat_id, f"#{turn + 1}", lang or "-", str(lines), first_line]
+            for column, value in enumerate(values):
+                item = QTableWidgetItem(value)
+                if column == 0: item.setData(Qt.ItemDataRole.UserRole, (block_id, block_chat_id, turn, line_start, line_end))
+                self.code_table.setItem(row, column, item)
+
+    def code_rows(self, selected_only):
+        if selected_only:
+            rows = sorted({index.row() for index in self.code_table.selectedIndexes()})
+        else:
+            rows = range(self.code_table.rowCount())
+        return [self.code_table.item(row, 0).data(Qt.ItemDataRole.UserRole) for row in rows]
+
+    def handle_code_open(self, item):
+        block_id, chat_id, turn, line_start, line_end = self.code_table.item(item.row(), 0).data(Qt.ItemDataRole.UserRole)
+        # 表示中のチャットなら索引の行位置へそのまま移動し、別のチャットはキャッシュから表示してから移動する
+        if chat_id != self.displayed_chat_id() or turn >= len(self.chat_log.turn_entries):
+            if not self.show_cached_chat(chat_id): return
+        self.chat_log.scroll_to_turn(turn, line_start, line_end)
+
+    def handle_code_copy(self):
+        block_ids = [hit[0] for hit in self.code_rows(selected_only=True)]
+        if not block_ids: return
+        texts = search_index.code_block_texts(block_ids)
+        QApplication.clipboard().setText("\n\n".join(texts[block_id][4] for block_id in block_ids if block_id in texts))
+        self.append_sys_log({"type": "line", "text": f"システム: コードブロックを{len(block_ids)}件コピーしました。"})
+
+    def handle_code_export(self):
+        # 一覧に表示中のコードブロックを全て、1件1ファイルで書き出す
+        block_ids = [hit[0] for hit in self.code_rows(selected_only=False)]
+        if not block_ids: return
+        directory = QFileDialog.getExistingDirectory(self, "コードブロックの書き出し先")
+        if not directory: return
+        try:
+            count = export_code_blocks(block_ids, directory)
+        except OSError as e:
+            self.append_sys_log({"type": "line", "text": f"システムエラー: コードブロックを書き出せませんでした。({e})"})
+            return
+        self.append_sys_log({"type": "line", "text": f"システム: コードブロックを{count}件書き出しました。({directory})"})
 
     def handle_send(self):
         text = self.input_box.toPlainText().strip()
         if not text: return
+        # キャッシュ表示中のチャットとブラウザ側のチャットが異なる場合、送信先と表示先がずれるため送らない (入力は残す)
+        if self.cached_view_chat_id and self.cached_view_chat_id != self.worker.current_chat_id:
+            self.append_sys_log({"type": "line", "text": "システムエラー: 表示中のチャットはキャッシュ表示のため送信できません。「移動」でブラウザと同期してから送信してください。"})
+            return
         self.input_box.clear()
         self.append_chat_log({"role": "user", "text": f"ユーザ:\n{text}\n"})
-        self.msg_queue.put({"type": "SEND", "text": text})
+        self.worker.submit({"type": "SEND", "text": text})
 
-    def append_chat_log(self, data):
-        role_str = data.get("role", "system")
-        text = data.get("text", "")
-        if role_str == "user": state = 1
-        elif role_str == "ai": state = 2
-        else: state = 0
+    def handle_cancel(self):
+        # 実行中の送信待ち・移動・同期を中断し、ブラウザ側の生成も停止させる
+        self.worker.submit({"type": "CANCEL"})
 
-        cursor = self.chat_log.textCursor()
-        cursor.movePosition(cursor.MoveOperation.End)
-        start_block = cursor.blockNumber()
-        cursor.insertText(text + "\n")
-        end_block = self.chat_log.document().blockCount()
+    def append_chat_log(self, data):
+        self.chat_log.append_message(data)
 
-        doc = self.chat_log.document()
-        for i in range(start_block, end_block):
-            doc.findBlockByNumber(i).setUserState(state)
+    def append_chat_batch(self, items):
+        with metrics.span("render_batch", items=len(items)):
+            self.chat_log.append_batch(items)
+        if self.code_panel.isVisible(): self.code_refresh_timer.start()
 
-        self.chat_log.setTextCursor(cursor)
-        self.chat_log.verticalScrollBar().setValue(self.chat_log.verticalScrollBar().maximum())
+    def apply_chat_patch(self, patch):
+        with metrics.span("render_patch", ops=len(patch.get("ops", []))):
+            self.chat_log.apply_patch(patch)
+        if self.code_panel.isVisible(): self.code_refresh_timer.start()
 
     def append_chat_stream_start(self, data):
-        self.append_chat_log(data)
+        self.chat_log.start_stream(data)
 
     def append_chat_stream(self, text):
-        state = 2 # AI
-        cursor = self.chat_log.textCursor()
-        cursor.movePosition(cursor.MoveOperation.End)
-        start_block = cursor.blockNumber()
-        cursor.insertText(text)
-        end_block = self.chat_log.document().blockCount()
+        self.chat_log.append_stream(text)
 
-        doc = self.chat_log.document()
-        for i in range(start_block, end_block):
-            doc.findBlockByNumber(i).setUserState(state)
-
-        self.chat_log.setTextCursor(cursor)
-        self.chat_log.verticalScrollBar().setValue(self.chat_log.verticalScrollBar().maximum())
+    def apply_chat_stream_patch(self, patch):
+        self.chat_log.replace_stream(patch.get("offset", 0), patch.get("text", ""))
 
     def append_sys_log(self, data):
+        # 末尾が改行済みかどうかは自前で追跡し、ログ全文のコピーを避ける
         msg_type = data.get("type")
-        text = data.get("text")
-
-        cursor = self.sys_log.textCursor()
-        cursor.movePosition(cursor.MoveOperation.End)
+        text = data.get("text") or ""
 
         if msg_type == "line":
-            if self.sys_log.toPlainText() and not self.sys_log.toPlainText().endswith("\n"):
-                cursor.insertText("\n")
-            cursor.insertText(text)
+            if self.sys_log_line_open:
+                self.sys_log_pending.append("\n")
+                self.sys_log_line_open = False
+            self.sys_log_pending.append(text)
         elif msg_type == "append":
-            cursor.insertText(text)
+            self.sys_log_pending.append(text)
+        else:
+            return
+
+        if text:
+            self.sys_log_line_open = not text.endswith("\n")
+        if not self.sys_log_timer.isActive():
+            self.sys_log_timer.start()
 
-        self.sys_log.setTextCursor(cursor)
+    def flush_sys_log(self):
+        if not self.sys_log_pending: return
+        text = "".join(self.sys_log_pending)
+        self.sys_log_pending.clear()
+
+        cursor = QTextCursor(self.sys_log.document())
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        cursor.insertText(text)
         self.sys_log.verticalScrollBar().setValue(self.sys_log.verticalScrollBar().maximum())
 
     def closeEvent(self, event):
-        self.msg_queue.put({"type": "QUIT"})
+        self.worker.submit({"type": "QUIT"})
         self.worker.is_running = False
 
         if not self.worker.wait(3000):
@@ -798,6 +1227,7 @@ class ChatGPTLightWeightTerminal(QWidget):
             self.worker.terminate()
             self.worker.wait()
 
+        chat_cache.close()
         logger.info("システム: プロセスは正常に終了しました。")
         event.accept()
 
@@ -0,0 +1,75 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+
+# 通常モードと軽量モード (LEAN_MODE) のブラウザ起動時間・RSS・リクエスト数の比較
+# 使い方: python benchmarks/bench_browser.py --url https://chatgpt.com/ --settle 5
+# セッションを汚さないよう、モードごとに一時プロファイルで起動する
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from playwright.async_api import async_playwright
+from clwt_backend import browser_launch_options, block_lean_resources, process_tree_rss
+
+
+async def measure(p, url, lean, headless, settle):
+    profile = tempfile.mkdtemp(prefix="clwt_bench_")
+    options = browser_launch_options(lean, headless)
+
+    stats = {"requests": 0, "blocked": 0}
+
+    def on_finished(request):
+        stats["requests"] += 1
+
+    def on_failed(request):
+        if request.failure and "ERR_BLOCKED_BY_CLIENT" in request.failure:
+            stats["blocked"] += 1
+
+    started = time.perf_counter()
+    context = await p.chromium.launch_persistent_context(user_data_dir=profile, **options)
+    launched = time.perf_counter() - started
+    context.on("requestfinished", on_finished)
+    context.on("requestfailed", on_failed)
+
+    page = context.pages[0] if context.pages else await context.new_page()
+    if lean:
+        await block_lean_resources(context, page)
+    await page.goto(url, wait_until="domcontentloaded")
+    loaded = time.perf_counter() - started
+    # 2回目の読み込みはHTTPキャッシュが効くかどうかで差が出る (リクエストの横取りはキャッシュを無効にする)
+    reload_started = time.perf_counter()
+    await page.reload(wait_until="domcontentloaded")
+    reloaded = time.perf_counter() - reload_started
+    await page.wait_for_timeout(settle * 1000)
+    rss = process_tree_rss(profile)
+    await context.close()
+    return launched, loaded, reloaded, rss, stats
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="browser footprint benchmark")
+    parser.add_argument("--url", default="https://chatgpt.com/")
+    parser.add_argument("--settle", type=int, default=5, help="RSS計測前の待機秒数")
+    parser.add_argument("--headless", action="store_true", help="両モードともヘッドレスで比較する")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    headless = True if args.headless else None
+    print(f"{'mode':>8} {'launch':>8} {'loaded':>8} {'reload':>8} {'rss_mb':>8} {'requests':>9} {'blocked':>8}")
+    results = []
+    async with async_playwright() as p:
+        for name, lean in (("normal", False), ("lean", True)):
+            launched, loaded, reloaded, rss, stats = await measure(p, args.url, lean, headless, args.settle)
+            rss_mb = f"{rss / (1024 * 1024):.0f}" if rss is not None else "-"
+            print(f"{name:>8} {launched:>8.2f} {loaded:>8.2f} {reloaded:>8.2f} {rss_mb:>8} {stats['requests']:>9} {stats['blocked']:>8}")
+            results.append({"mode": name, "launch_s": launched, "loaded_s": loaded, "reload_s": reloaded, "rss_bytes": rss, **stats})
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+import argparse
+
+# ChatLogView の描画経路ベンチマーク (ブラウザ不要)
+# 使い方: python benchmarks/bench_render.py --turns 1000 10000
+if sys.platform != 'win32':
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyQt6.QtWidgets import QApplication
+from ChatgptLightWeightTerminal import ChatLogView
+from clwt_backend import format_chat_item
+
+
+def make_turns(count):
+    turns = []
+    for i in range(count):
+        if i % 2 == 0:
+            turns.append({"role": "user", "text": f"質問 {i}: この関数の計算量を教えてください。"})
+        else:
+            code = "\n".join(f"    total += values[{k}] * {k}" for k in range(8))
+            turns.append({"role": "assistant", "text": (
+                f"回答 {i}: 以下のように書けます。\n"
+                "\n========コードブロック箇所ここから========\n## PYTHON\n"
+                f"def calc(values):\n    total = 0\n{code}\n    return total"
+                "\n========コードブロック箇所ここまで========\n"
+                "計算量は O(n) です。"
+            )})
+    return turns
+
+
+def render_legacy(view, items):
+    # 変更前の append_chat_log 相当: 1件ごとにinsert・findBlockByNumber・末尾スクロール
+    for data in items:
+        state = view.ROLE_STATES.get(data.get("role", "system"), 0)
+        cursor = view.textCursor()
+        cursor.movePosition(cursor.MoveOperation.End)
+        start_block = cursor.blockNumber()
+        cursor.insertText(data.get("text", "") + "\n")
+        end_block = view.document().blockCount()
+        doc = view.document()
+        for i in range(start_block, end_block):
+            doc.findBlockByNumber(i).setUserState(state)
+        view.setTextCursor(cursor)
+        view.verticalScrollBar().setValue(view.verticalScrollBar().maximum())
+        QApplication.processEvents()
+
+
+def render_batch(view, items):
+    view.append_batch(items)
+    QApplication.processEvents()
+
+
+def measure(app, func, items):
+    view = ChatLogView()
+    view.resize(900, 600)
+    view.show()
+    app.processEvents()
+    started = time.perf_counter()
+    func(view, items)
+    elapsed = time.perf_counter() - started
+    blocks = view.document().blockCount()
+    view.close()
+    view.deleteLater()
+    app.processEvents()
+    return elapsed, blocks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="chat_log rendering benchmark")
+    parser.add_argument("--turns", type=int, nargs="+", default=[1000, 10000])
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+    print(f"{'turns':>8} {'path':>8} {'seconds':>10} {'blocks':>10}")
+    for count in args.turns:
+        items = []
+        for index, turn in enumerate(make_turns(count)):
+            data = format_chat_item(turn)
+            data["turn"] = index
+            items.append(data)
+        for name, func in (("legacy", render_legacy), ("batch", render_batch)):
+            elapsed, blocks = measure(app, func, items)
+            print(f"{count:>8} {name:>8} {elapsed:>10.3f} {blocks:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import os
+import sys
+import time
+import random
+import argparse
+
+# ストリーミング差分 (StreamNormalizer) の検証と計測。ページ側の回答テキストの変化を模した記録を再生する
+# 使い方: python benchmarks/bench_stream.py --chars 5000 20000
+# 記録の種類:
+#   append   : トークンの追記のみ (末尾の改行・空白が一時的に付いては消える)
+#   rerender : 追記の途中で、既に表示した部分のマークダウンが描画し直される (コード・リスト・強調の置き換え)
+#   truncate : 末尾が削られてから書き直される
+# 各ステップで差分を適用した結果が compress_text(全文) と一致することを確認し、毎回全文を整形する従来方式と時間を比べる
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clwt_backend import StreamNormalizer, compress_text
+
+
+def record_trace(kind, chars, seed=1):
+    # 全文の列を順に返す (記録全体を保持するとメモリが文字数の2乗になるため、同じ乱数列から毎回作り直す)
+    rnd = random.Random(seed)
+    words = ["関数", "高速化", "value", "total", "return", "ループ", "計算量", "O(n)", "キャッシュ", "`code`"]
+    text = ""
+    while len(text) < chars:
+        piece = rnd.choice(words) + rnd.choice([" ", " ", "", "\n", "\n\n", "\n\n\n\n"])
+        text += piece
+        # innerText は描画途中で末尾に空白や改行が付くことがある
+        yield text + rnd.choice(["", "", "\n", " \n\n\n"])
+        if kind == "rerender" and rnd.random() < 0.02 and len(text) > 40:
+            position = rnd.randrange(len(text) // 2, len(text) - 10)
+            text = text[:position] + rnd.choice(["**", "1. ", "\n\n\n", "```\n", "x"]) + text[position + 1:]
+            yield text
+        if kind == "truncate" and rnd.random() < 0.02 and len(text) > 40:
+            text = text[:len(text) - rnd.randrange(1, 30)]
+            yield text
+
+
+def replay(trace):
+    normalizer = StreamNormalizer()
+    out = ""
+    counts = {"append": 0, "replace": 0}
+    for raw in trace:
+        patch = normalizer.update(raw)
+        if not patch: continue
+        counts[patch["op"]] += 1
+        if patch["op"] == "append":
+            out += patch["text"]
+        else:
+            out = out[:patch["offset"]] + patch["text"]
+        assert out == compress_text(raw), f"mismatch after {sum(counts.values())} patches"
+    return counts
+
+
+def time_incremental(trace):
+    normalizer = StreamNormalizer()
+    started = time.perf_counter()
+    for raw in trace:
+        normalizer.update(raw)
+    return time.perf_counter() - started
+
+
+def time_legacy(trace):
+    last_text = ""
+    started = time.perf_counter()
+    for raw in trace:
+        current_text = compress_text(raw)
+        if current_text != last_text:
+            current_text[len(last_text):]
+            last_text = current_text
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="streaming normalizer check and benchmark")
+    parser.add_argument("--chars", type=int, nargs="+", default=[5000, 20000])
+    args = parser.parse_args()
+
+    print(f"{'chars':>8} {'trace':>9} {'steps':>7} {'append':>7} {'replace':>8} {'legacy(s)':>10} {'incr(s)':>8}")
+    for chars in args.chars:
+        for kind in ("append", "rerender", "truncate"):
+            counts = replay(record_trace(kind, chars))
+            legacy = time_legacy(record_trace(kind, chars))
+            incremental = time_incremental(record_trace(kind, chars))
+            steps = sum(1 for _ in record_trace(kind, chars))
+            print(f"{chars:>8} {kind:>9} {steps:>7} {counts['append']:>7} {counts['replace']:>8} {legacy:>10.3f} {incremental:>8.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+import os
+import sys
+import time
+import json
+import queue
+import argparse
+import tempfile
+import threading
+
+# PlaywrightWorker を実際に動かし、ローカルのChatGPT風ページに対する各処理の所要時間を計測する (ネットワーク不要)
+# 使い方: python benchmarks/bench_worker.py --turns 10 100 500
+# 計測項目:
+#   startup  : ワーカー起動からブラウザ起動・初期表示まで / 履歴リスト取得まで
+#   cold     : キャッシュ無しでのチャット移動 (ページ遷移・DOM待機または通信傍受・解析・保存)
+#   warm     : キャッシュ有りでのチャット移動 (キャッシュ展開・差分確認)
+#   render   : chat_log への一括描画 / 差分適用の時間
+#   send     : 送信から最初のトークンまで / 回答完了まで、ストリーミングのスループット
+#   memory   : ブラウザ全プロセスとアプリ本体のRSS
+# アプリのセッション・キャッシュ・検索DBには触れず、一時ディレクトリで実行する
+if sys.platform != 'win32':
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyQt6.QtWidgets import QApplication
+from PyQt6.QtCore import QTimer
+import ChatgptLightWeightTerminal as clwt
+import clwt_backend as backend
+from mock_chatgpt import MockChatGPTServer
+
+SYNC_DONE = "コンテキスト完全同期完了"
+LAUNCH_DONE = "初期アクセス完了"
+SEND_DONE = "回答完了"
+
+
+class Recorder:
+    # ワーカーのシグナルを時刻付きで記録し、計測スレッドから待ち合わせできるようにする
+    def __init__(self, view):
+        self.view = view
+        self.cond = threading.Condition()
+        self.events = []
+        self.render_ms = []
+
+    def mark(self, kind, value=None):
+        with self.cond:
+            self.events.append((time.perf_counter(), kind, value))
+            self.cond.notify_all()
+
+    def cursor(self):
+        with self.cond:
+            return len(self.events)
+
+    def wait_for(self, since, kind, contains=None, timeout=120):
+        deadline = time.perf_counter() + timeout
+        with self.cond:
+            while True:
+                for stamp, event_kind, value in self.events[since:]:
+                    if event_kind != kind: continue
+                    if contains is None or (isinstance(value, str) and contains in value):
+                        return stamp
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0: return None
+                self.cond.wait(remaining)
+
+    def on_sys(self, data):
+        if data.get("type") == "line":
+            self.mark("sys", data.get("text", ""))
+
+    def on_batch(self, items):
+        started = time.perf_counter()
+        self.view.append_batch(items)
+        self.render_ms.append(("batch", len(items), (time.perf_counter() - started) * 1000))
+        self.mark("batch", len(items))
+
+    def on_patch(self, patch):
+        started = time.perf_counter()
+        self.view.apply_patch(patch)
+        self.render_ms.append(("patch", len(patch.get("ops", [])), (time.perf_counter() - started) * 1000))
+        self.mark("patch", len(patch.get("ops", [])))
+
+    def on_stream_start(self, data):
+        self.view.start_stream(data)
+        self.mark("stream_start")
+
+    def on_stream(self, text):
+        self.view.append_stream(text)
+        self.mark("token", len(text))
+
+    def on_stream_patch(self, patch):
+        self.view.replace_stream(patch["offset"], patch["text"])
+        self.mark("stream_patch", patch["offset"])
+
+    def first(self, since, kinds):
+        with self.cond:
+            for stamp, kind, value in self.events[since:]:
+                if kind in kinds: return stamp
+        return None
+
+    def chars_between(self, start, end):
+        with self.cond:
+            return sum(value for stamp, kind, value in self.events if kind == "token" and start <= stamp <= end)
+
+
+def self_rss():
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def elapsed(start, end):
+    return None if start is None or end is None else end - start
+
+
+def run_scenario(worker, recorder, server, sizes, timeout):
+    results = {"startup": {}, "sizes": []}
+
+    cursor = recorder.cursor()
+    started = time.perf_counter()
+    worker.start()
+    launched = recorder.wait_for(cursor, "sys", LAUNCH_DONE, timeout)
+    sidebar = recorder.wait_for(cursor, "sidebar", timeout=timeout)
+    synced = recorder.wait_for(cursor, "sys", SYNC_DONE, timeout)
+    results["startup"] = {
+        "launch_goto": elapsed(started, launched),
+        "sidebar": elapsed(started, sidebar),
+        "initial_sync": elapsed(started, synced),
+    }
+
+    for turns in sizes:
+        url = server.chat_url(turns)
+        row = {"turns": turns}
+        for phase in ("cold", "warm"):
+            if phase == "warm":
+                # 一度別ページへ移動してから戻り、キャッシュ経由の同期を計測する
+                cursor = recorder.cursor()
+                worker.submit({"type": "NAVIGATE", "url": server.base_url + "/"})
+                recorder.wait_for(cursor, "sys", SYNC_DONE, timeout)
+            render_before = len(recorder.render_ms)
+            cursor = recorder.cursor()
+            started = time.perf_counter()
+            worker.submit({"type": "NAVIGATE", "url": url})
+            done = recorder.wait_for(cursor, "sys", SYNC_DONE, timeout)
+            first_paint = recorder.first(cursor, ("batch", "patch"))
+            row[f"{phase}_sync"] = elapsed(started, done)
+            row[f"{phase}_first_paint"] = elapsed(started, first_paint)
+            row[f"{phase}_render_ms"] = sum(ms for _, _, ms in recorder.render_ms[render_before:])
+
+        cursor = recorder.cursor()
+        started = time.perf_counter()
+        worker.submit({"type": "SEND", "text": f"ベンチマーク送信 ({turns}ターン)"})
+        first_token = recorder.wait_for(cursor, "token", timeout=timeout)
+        done = recorder.wait_for(cursor, "sys", SEND_DONE, timeout)
+        row["send_first_token"] = elapsed(started, first_token)
+        row["send_total"] = elapsed(started, done)
+        stream_time = elapsed(first_token, done)
+        chars = recorder.chars_between(first_token or 0, done or 0)
+        row["stream_chars_per_sec"] = chars / stream_time if stream_time else None
+
+        browser_rss = backend.process_tree_rss(backend.SESSION_DIR)
+        app_rss = self_rss()
+        row["browser_rss_mb"] = browser_rss / (1024 * 1024) if browser_rss else None
+        row["app_rss_mb"] = app_rss / (1024 * 1024) if app_rss else None
+        results["sizes"].append(row)
+
+    return results
+
+
+def format_value(value, digits=2):
+    if value is None: return "-"
+    if isinstance(value, float): return f"{value:.{digits}f}"
+    return str(value)
+
+
+def print_results(results):
+    startup = results["startup"]
+    print("startup: " + " / ".join(f"{key} {format_value(value)}s" for key, value in startup.items()))
+    columns = [
+        ("turns", "turns", 0), ("cold_sync", "cold(s)", 2), ("warm_first_paint", "warm_paint(s)", 2), ("warm_sync", "warm(s)", 2),
+        ("cold_render_ms", "render_cold(ms)", 1), ("warm_render_ms", "render_warm(ms)", 1),
+        ("send_first_token", "first_tok(s)", 2), ("send_total", "send(s)", 2),
+        ("stream_chars_per_sec", "chars/s", 0), ("browser_rss_mb", "browser(MB)", 0), ("app_rss_mb", "app(MB)", 0),
+    ]
+    print(" ".join(f"{title:>16}" for _, title, _ in columns))
+    for row in results["sizes"]:
+        print(" ".join(f"{format_value(row.get(key), digits):>16}" for key, _, digits in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PlaywrightWorker benchmark against a local mock ChatGPT page")
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--dom", action="store_true", help="通信傍受を使わずDOM解析で同期する")
+    parser.add_argument("--lean", action="store_true", help="軽量モードで起動する")
+    parser.add_argument("--headed", action="store_true", help="ブラウザを表示して実行する")
+    parser.add_argument("--prefetch", action="store_true", help="先読みタブを有効にする (既定は無効)")
+    parser.add_argument("--stream-chunks", type=int, default=200)
+    parser.add_argument("--stream-interval", type=int, default=20, help="擬似ストリーミングの追記間隔(ms)")
+    parser.add_argument("--timeout", type=int, default=180)
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="clwt_bench_worker_")
+    cache_dir = os.path.join(workdir, "tmp1")
+    os.makedirs(cache_dir)
+    # ワーカーの処理は clwt_backend のモジュール変数を参照するため、そちらを差し替える
+    backend.SESSION_DIR = os.path.join(workdir, "session")
+    backend.STATE_PATH = os.path.join(workdir, "state.json")
+    backend.chat_cache = backend.ChatCache(cache_dir, backend.CACHE_BUDGET_BYTES)
+    backend.search_index = backend.SearchIndex(os.path.join(workdir, "search_index.db"))
+    backend.chat_cache.on_evict = backend.search_index.remove
+    backend.chat_cache.on_write = backend.index_cached_turns
+    backend.NETWORK_CAPTURE = not args.dom
+    backend.LEAN_MODE = args.lean
+    if not args.prefetch: backend.PREFETCH_TABS = 0
+
+    server = MockChatGPTServer(
+        args.turns, capture=not args.dom,
+        stream_chunks=args.stream_chunks, stream_interval_ms=args.stream_interval,
+    ).start()
+
+    app = QApplication(sys.argv)
+    view = clwt.ChatLogView()
+    view.resize(900, 600)
+    recorder = Recorder(view)
+
+    worker = clwt.PlaywrightWorker(queue.Queue())
+    worker.start_url = server.base_url + "/"
+    worker.headless = not args.headed
+    worker.sys_signal.connect(recorder.on_sys)
+    worker.chat_batch_signal.connect(recorder.on_batch)
+    worker.chat_patch_signal.connect(recorder.on_patch)
+    worker.stream_start_signal.connect(recorder.on_stream_start)
+    worker.stream_signal.connect(recorder.on_stream)
+    worker.stream_patch_signal.connect(recorder.on_stream_patch)
+    worker.history_list_signal.connect(lambda items: recorder.mark("sidebar", len(items)))
+
+    results = {}
+
+    def scenario():
+        try:
+            results.update(run_scenario(worker, recorder, server, args.turns, args.timeout))
+        finally:
+            worker.submit({"type": "QUIT"})
+            worker.wait(10000)
+            app.quit()
+
+    QTimer.singleShot(0, lambda: threading.Thread(target=scenario, daemon=True).start())
+    app.exec()
+    server.stop()
+
+    if results:
+        results["options"] = {"capture": not args.dom, "lean": args.lean, "prefetch": args.prefetch}
+        print_results(results)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
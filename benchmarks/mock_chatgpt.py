@@ -0,0 +1,239 @@
+import re
+import json
+import html
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# ベンチマーク用のChatGPT風ローカルページ (ネットワーク不要)
+# - /c/<id> : N ターンの会話 (コードブロック・リストを含む) とサイドバー、入力欄
+# - /backend-api/conversation/<id> : 同じ会話の JSON (ページ読み込み時に fetch される)
+# - 入力欄で Enter を押すと、停止ボタンを出しながら回答を少しずつ追記する擬似ストリーミングを行う
+# 会話IDの末尾12桁がターン数を表す (例: 00000000-0000-0000-0000-000000000100 は100ターン)
+
+
+def conversation_id(turns):
+    return f"00000000-0000-0000-0000-{turns:012d}"
+
+
+def turn_count(chat_id):
+    return int(chat_id.rsplit("-", 1)[-1])
+
+
+def make_turn(index):
+    if index % 2 == 0:
+        return {"role": "user", "paragraphs": [f"質問 {index}: 次の関数を高速化する方法を教えてください。"], "code": None, "items": []}
+    code = "\n".join([
+        "def calc(values):",
+        "    total = 0",
+        *[f"    total += values[{k}] * {k}" for k in range(6)],
+        "    return total",
+    ])
+    return {
+        "role": "assistant",
+        "paragraphs": [f"回答 {index}: ループを減らすと速くなります。", "計算量は O(n) のままです。"],
+        "code": ("python", code),
+        "items": ["不要なコピーを避ける", "組み込み関数を使う", "結果をキャッシュする"],
+    }
+
+
+def turn_html(index, turn):
+    role = turn["role"]
+    body = f"<p>{html.escape(turn['paragraphs'][0])}</p>"
+    if turn["code"]:
+        lang, code = turn["code"]
+        body += (
+            f'<pre><div class="flex items-center"><span>{lang}</span></div>'
+            f'<code class="language-{lang}">{html.escape(code)}</code></pre>'
+        )
+    if turn["items"]:
+        body += "<ul>" + "".join(f"<li>{html.escape(item)}</li>" for item in turn["items"]) + "</ul>"
+    for paragraph in turn["paragraphs"][1:]:
+        body += f"<p>{html.escape(paragraph)}</p>"
+    return (
+        f'<article data-testid="conversation-turn-{index}">'
+        f'<div data-message-author-role="{role}" data-message-id="msg-{index}"><div class="markdown">{body}</div></div>'
+        f'</article>'
+    )
+
+
+def turn_markdown(turn):
+    text = turn["paragraphs"][0]
+    if turn["code"]:
+        lang, code = turn["code"]
+        text += f"\n\n```{lang}\n{code}\n```"
+    if turn["items"]:
+        text += "\n\n" + "\n".join(f"- {item}" for item in turn["items"])
+    for paragraph in turn["paragraphs"][1:]:
+        text += "\n\n" + paragraph
+    return text
+
+
+def conversation_json(chat_id):
+    count = turn_count(chat_id)
+    mapping = {"root": {"id": "root", "message": None, "parent": None, "children": []}}
+    parent = "root"
+    for index in range(count):
+        turn = make_turn(index)
+        node_id = f"msg-{index}"
+        mapping[node_id] = {
+            "id": node_id,
+            "parent": parent,
+            "children": [],
+            "message": {
+                "id": node_id,
+                "author": {"role": turn["role"]},
+                "recipient": "all",
+                "create_time": 1700000000 + index,
+                "content": {"content_type": "text", "parts": [turn_markdown(turn)]},
+                "metadata": {},
+            },
+        }
+        mapping[parent]["children"].append(node_id)
+        parent = node_id
+    return {"title": f"ベンチマーク {count}ターン", "current_node": parent, "mapping": mapping}
+
+
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title>
+<style>
+body {{ font-family: sans-serif; display: flex; margin: 0; }}
+nav {{ width: 240px; }}
+main {{ flex: 1; padding: 8px; }}
+pre {{ white-space: pre; }}
+</style></head>
+<body>
+<nav>{sidebar}</nav>
+<main>
+<div id="thread">{turns}</div>
+<div id="composer"><textarea id="prompt-textarea"></textarea><div id="controls"></div></div>
+</main>
+<script>
+const CONFIG = {config};
+if (CONFIG.chatId && CONFIG.capture) {{
+    fetch('/backend-api/conversation/' + CONFIG.chatId).then(r => r.json()).catch(() => null);
+}}
+let turnIndex = document.querySelectorAll('article[data-testid^="conversation-turn"]').length;
+const thread = document.getElementById('thread');
+const controls = document.getElementById('controls');
+
+const addTurn = (role) => {{
+    const article = document.createElement('article');
+    article.setAttribute('data-testid', 'conversation-turn-' + turnIndex);
+    const roleEl = document.createElement('div');
+    roleEl.setAttribute('data-message-author-role', role);
+    roleEl.setAttribute('data-message-id', 'msg-' + turnIndex);
+    const body = document.createElement('div');
+    body.className = 'markdown';
+    roleEl.appendChild(body);
+    article.appendChild(roleEl);
+    thread.appendChild(article);
+    turnIndex++;
+    return body;
+}};
+
+const respond = (text) => {{
+    const userBody = addTurn('user');
+    userBody.textContent = text;
+    setTimeout(() => {{
+        const stop = document.createElement('button');
+        stop.setAttribute('data-testid', 'stop-button');
+        stop.textContent = 'stop';
+        let timer = null;
+        stop.onclick = () => {{ clearInterval(timer); stop.remove(); }};
+        controls.appendChild(stop);
+
+        const p = document.createElement('p');
+        addTurn('assistant').appendChild(p);
+        let sent = 0;
+        timer = setInterval(() => {{
+            p.textContent += 'トークン' + sent + ' ';
+            sent++;
+            if (sent >= CONFIG.streamChunks) {{
+                clearInterval(timer);
+                stop.remove();
+            }}
+        }}, CONFIG.streamIntervalMs);
+    }}, CONFIG.firstTokenMs);
+}};
+
+document.getElementById('prompt-textarea').addEventListener('keydown', (e) => {{
+    if (e.key === 'Enter' && !e.shiftKey) {{
+        e.preventDefault();
+        const value = e.target.value;
+        e.target.value = '';
+        if (value) respond(value);
+    }}
+}});
+</script>
+</body></html>
+"""
+
+
+class MockChatGPTServer:
+    def __init__(self, sizes, capture=True, stream_chunks=200, stream_interval_ms=20, first_token_ms=300):
+        self.sizes = list(sizes)
+        self.config = {
+            "capture": capture,
+            "streamChunks": stream_chunks,
+            "streamIntervalMs": stream_interval_ms,
+            "firstTokenMs": first_token_ms,
+        }
+        self.server = None
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def chat_url(self, turns):
+        return f"{self.base_url}/c/{conversation_id(turns)}"
+
+    def render_page(self, chat_id):
+        sidebar = "".join(
+            f'<a href="/c/{conversation_id(n)}">ベンチマーク {n}ターン</a>' for n in self.sizes
+        )
+        turns = ""
+        if chat_id:
+            turns = "".join(turn_html(i, make_turn(i)) for i in range(turn_count(chat_id)))
+        config = dict(self.config, chatId=chat_id)
+        return PAGE_TEMPLATE.format(
+            title="ChatGPT (mock)", sidebar=sidebar, turns=turns, config=json.dumps(config)
+        )
+
+    def start(self):
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def send_body(self, body, content_type):
+                data = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                match = re.fullmatch(r"/backend-api/conversation/([0-9a-f-]+)", path)
+                if match:
+                    self.send_body(json.dumps(conversation_json(match.group(1)), ensure_ascii=False), "application/json")
+                    return
+                match = re.fullmatch(r"/c/([0-9a-f-]+)", path)
+                if match or path == "/":
+                    self.send_body(owner.render_page(match.group(1) if match else None), "text/html; charset=utf-8")
+                    return
+                self.send_error(404)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
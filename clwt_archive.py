@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+# サイドバー索引の全チャットをGUIなしで巡回し、tmp1 のキャッシュと検索索引へ保存する (PyQt6 不要)
+# 使い方: python clwt_archive.py --tabs 3
+# - 進捗は applog/archive_state.json に1件ごとに記録し、中断しても次回は残りから再開する
+# - サイドバーは更新順に並ぶため、前回の並びから動いていないチャットは最新とみなして読み込まない
+# - GUIと同じブラウザセッション (applog/session) を使うため、GUIの起動中は実行できない
+import clwt_backend
+from clwt_backend import BrowserWorker, WORKDIR, logger, metrics, chat_cache, search_index
+
+ARCHIVE_STATE_PATH = os.path.join(WORKDIR, "applog", "archive_state.json")
+ARCHIVE_TABS = 3
+
+
+def stale_prefix(order, previous):
+    # 末尾から見て前回と同じ相対順が続く範囲は未更新とみなし、それより前 (新規・更新されて先頭へ来た分) の件数を返す
+    positions = {chat_id: i for i, chat_id in enumerate(previous)}
+    count = len(order)
+    last = len(previous)
+    while count > 0:
+        position = positions.get(order[count - 1])
+        if position is None or position >= last: break
+        last = position
+        count -= 1
+    return count
+
+
+class ChatArchiver(BrowserWorker):
+    def __init__(self, tabs=ARCHIVE_TABS, limit=None, force=False, restart=False, refresh_sidebar=True, state_path=ARCHIVE_STATE_PATH):
+        super().__init__()
+        self.tabs = max(1, tabs)
+        self.limit = limit
+        self.force = force
+        self.restart = restart
+        self.refresh_sidebar = refresh_sidebar
+        self.state_path = state_path
+        self.state = {}
+        self.urls = {}
+        self.total = 0
+        self.saved = 0
+        self.failed = 0
+
+    def schedule_prefetch(self, history_data):
+        # 全件を自前のタブで巡回するため、GUI用の先読みは行わない
+        pass
+
+    def load_state(self):
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        if not isinstance(state, dict): state = {}
+        state.setdefault("order", [])
+        state.setdefault("archived", {})
+        state.setdefault("pending", [])
+        if self.restart: state["pending"] = []
+        self.state = state
+
+    def save_state(self):
+        tmp_path = self.state_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.state, f, ensure_ascii=False)
+            os.replace(tmp_path, self.state_path)
+        except OSError as e:
+            logger.error(f"Archive State Save Error: {e}")
+
+    def plan(self, history_data):
+        # 前回の中断分 + 新規・更新されたチャット + キャッシュが無い (未保存・追い出し済み) チャットを、サイドバーの順に並べる
+        order = []
+        for item in history_data:
+            chat_id = self.get_chat_id(item.get("url", ""))
+            if chat_id == "new_chat" or chat_id in self.urls: continue
+            self.urls[chat_id] = item["url"]
+            order.append(chat_id)
+
+        archived = self.state["archived"]
+        resumed = [chat_id for chat_id in self.state["pending"] if chat_id not in archived or self.force]
+        if self.force:
+            targets = set(order)
+        else:
+            targets = set(order[:stale_prefix(order, self.state["order"])])
+            targets.update(chat_id for chat_id in order if chat_id not in archived or not chat_cache.exists(chat_id))
+        targets.update(resumed)
+        planned = [chat_id for chat_id in order if chat_id in targets]
+        planned += [chat_id for chat_id in resumed if chat_id not in self.urls]
+
+        if resumed:
+            self.emit_sys_line(f"システム: 前回中断した一括保存を再開します。(残り:{len(resumed)}件)")
+        self.emit_sys_line(f"システム: 保存対象 {len(planned)}件 / 索引 {len(order)}件 (最新のためスキップ: {len(order) - len(targets & set(order))}件)")
+        # 並びは計画を立てた時点で確定させる。途中で中断した分や --limit で後回しにした分は pending に残り、次回必ず読み込む
+        self.state["order"] = order
+        self.state["pending"] = planned
+        self.save_state()
+        return planned if self.limit is None else planned[:self.limit]
+
+    async def archive_tab(self, pending):
+        page = await self.open_page()
+        try:
+            while self.is_running:
+                try: chat_id = pending.get_nowait()
+                except asyncio.QueueEmpty: return
+                await self.archive_chat(page, chat_id)
+        finally:
+            try: await page.close()
+            except: pass
+
+    async def archive_chat(self, page, chat_id):
+        url = self.urls.get(chat_id) or f"https://chatgpt.com/c/{chat_id}"
+        self.captured.pop(chat_id, None)
+        try:
+            with metrics.span("archive", chat_id=chat_id) as span:
+                await page.goto(url, wait_until="domcontentloaded")
+                turns = await self.read_chat_turns(page, chat_id)
+                span["turns"] = len(turns)
+        except Exception as e:
+            if "closed" in str(e).lower() or "target" in str(e).lower():
+                raise e
+            turns = None
+            logger.debug(f"Archive Error ({chat_id}): {e}")
+        finally:
+            self.captured.pop(chat_id, None)
+
+        if not turns:
+            # 失敗したチャットは pending に残し、次回の実行で読み直す
+            self.failed += 1
+            self.emit_sys_line(f"システムエラー: [{self.saved + self.failed}/{self.total}] {chat_id} を取得できませんでした。")
+            return
+        self.persist_turns(chat_id, turns)
+        self.state["archived"][chat_id] = {"turns": len(turns), "at": time.time()}
+        self.state["pending"].remove(chat_id)
+        self.save_state()
+        self.saved += 1
+        self.emit_sys_line(f"システム: [{self.saved + self.failed}/{self.total}] {chat_id} を保存しました。({len(turns)}件)")
+
+    async def run_async(self):
+        from playwright.async_api import async_playwright
+        self.loop = asyncio.get_running_loop()
+        self.load_state()
+        started = time.perf_counter()
+        async with async_playwright() as p:
+            self.emit_sys_line("システム: バックグラウンドブラウザを起動中..." + (" (軽量モード)" if clwt_backend.LEAN_MODE else ""))
+            browser_context = await self.launch_browser(p)
+            try:
+                self.page = await self.open_page(reuse=True)
+                with metrics.span("goto", url=self.start_url):
+                    await self.page.goto(self.start_url, wait_until="domcontentloaded")
+                if self.refresh_sidebar:
+                    await self.fetch_sidebar_history()
+                planned = self.plan(search_index.history())
+                self.total = len(planned)
+
+                pending = asyncio.Queue()
+                for chat_id in planned:
+                    pending.put_nowait(chat_id)
+                await asyncio.gather(*(self.archive_tab(pending) for _ in range(min(self.tabs, len(planned)))))
+            finally:
+                self.save_state()
+                chat_cache.close()
+                await browser_context.close()
+        self.emit_sys_line(f"システム: 一括保存完了。(保存:{self.saved}件 / 失敗:{self.failed}件 / {time.perf_counter() - started:.1f}秒)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CLWT headless archiver: sync every indexed chat to the local cache")
+    parser.add_argument("--tabs", type=int, default=ARCHIVE_TABS, help="同時に読み込むタブ数")
+    parser.add_argument("--limit", type=int, help="今回保存する最大件数")
+    parser.add_argument("--force", action="store_true", help="最新とみなせるチャットも全て読み直す")
+    parser.add_argument("--restart", action="store_true", help="前回中断した分を破棄して計画し直す")
+    parser.add_argument("--no-sidebar", action="store_true", help="サイドバーを読まず、保存済みの索引だけを使う")
+    parser.add_argument("--dom", action="store_true", help="通信傍受を使わずDOM解析で同期する")
+    parser.add_argument("--lean", action="store_true", help="軽量モードで起動する")
+    parser.add_argument("--headless", action="store_true", help="ブラウザを表示せずに実行する (ログイン済みセッションが前提)")
+    args = parser.parse_args()
+
+    if args.dom: clwt_backend.NETWORK_CAPTURE = False
+    if args.lean: clwt_backend.LEAN_MODE = True
+    archiver = ChatArchiver(
+        tabs=args.tabs, limit=args.limit, force=args.force,
+        restart=args.restart, refresh_sidebar=not args.no_sidebar,
+    )
+    if args.headless: archiver.headless = True
+    try:
+        asyncio.run(archiver.run_async())
+    except KeyboardInterrupt:
+        logger.info("システム: 中断しました。次回の実行で残りから再開します。")
+        return 130
+    return 1 if archiver.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
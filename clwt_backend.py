@@ -0,0 +1,2312 @@
+import sys
+import os
+import queue
+import logging
+import logging.handlers
+import atexit
+import shutil
+import re
+import json
+import time
+import hashlib
+import gzip
+import zlib
+import difflib
+import sqlite3
+import threading
+import asyncio
+import bisect
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+# CLWT のうち PyQt6 に依存しない部分 (設定・ログ・計測・キャッシュ・検索索引・ブラウザ操作)。
+# GUI (ChatgptLightWeightTerminal.py) とヘッドレスの一括保存 (clwt_archive.py) の両方から使う。
+# playwright はワーカー内で遅延importし、ウィンドウ表示を待たせない
+
+WORKDIR = os.path.dirname(os.path.abspath(__file__))
+SESSION_DIR = os.path.join(WORKDIR, "applog", "session")
+TMP_DIR = os.path.join(WORKDIR, "tmp1")
+LOG_DIR = os.path.join(WORKDIR, "log1")
+SEARCH_DB_PATH = os.path.join(WORKDIR, "applog", "search_index.db")
+STATE_PATH = os.path.join(WORKDIR, "applog", "state.json")
+
+STOP_BUTTON_SELECTOR = 'button[data-testid="stop-button"]'
+PREFETCH_TABS = 3
+CACHE_BUDGET_BYTES = 200 * 1024 * 1024
+CACHE_COMPRESS_LEVEL = 6
+# キャッシュの保存は書き込みスレッドで行う。最初の保存から CACHE_WRITE_DELAY_SEC 待ち、その間の保存をまとめて書く
+CACHE_WRITE_DELAY_SEC = 0.5
+# ページ自身が取得する会話JSONを傍受して履歴を読む (取れない場合はDOM解析へフォールバック)
+NETWORK_CAPTURE = True
+CAPTURE_WAIT_SEC = 10
+CONVERSATION_API_RE = re.compile(r"/backend-api/conversation/([0-9a-fA-F-]{8,})/?(?:\?.*)?$")
+# 軽量モード: 画像は起動フラグで読み込まず、フォント/メディアと計測系URLはCDPのURL遮断 (Network.setBlockedURLs) で止め、
+# Chromiumを省資源フラグで起動する。リクエストごとの横取り (route) はHTTPキャッシュを無効にするため使わない
+# (ヘッドレスはログイン済みセッションが前提。初回ログイン時は LEAN_HEADLESS = False で起動すること)
+LEAN_MODE = False
+LEAN_HEADLESS = True
+# 遮断するリソース種別 (CDPの ResourceType 名)。該当するリクエストだけをCDPの Fetch で止め、それ以外は横取りしない
+LEAN_BLOCK_RESOURCE_TYPES = ["Image", "Media", "Font", "TextTrack", "Ping", "CSPViolationReport"]
+# "*" をワイルドカードとするURLパターン
+LEAN_BLOCK_URL_PATTERNS = [
+    "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*",
+    "*intercom.io*", "*intercomcdn.io*", "*sentry.io*", "*datadoghq.com*", "*browser-intake-*",
+    "*/ces/v1/*", "*/v1/rgstr*", "*featureassets.org*",
+]
+BROWSER_ARGS = ["--disable-blink-features=AutomationControlled", "--no-sandbox"]
+LEAN_BROWSER_ARGS = [
+    "--disable-extensions", "--disable-background-networking", "--disable-component-update",
+    "--disable-default-apps", "--disable-sync", "--no-first-run", "--mute-audio",
+    "--disable-features=Translate,MediaRouter,OptimizationHints,AutofillServerCommunication",
+    "--renderer-process-limit=4", "--blink-settings=imagesEnabled=false",
+]
+# 処理フェーズ計測: 直近 METRICS_WINDOW 件で p50/p95 を集計する。
+# METRICS_HTTP_PORT を指定すると 127.0.0.1:<port>/metrics でPrometheus形式のテキストを公開する (None で無効)
+METRICS_WINDOW = 500
+# DOM安定判定: 会話ターン一覧が DOM_QUIET_MS の間変化しなければ読み込み完了とみなす
+TURN_SELECTOR = 'article[data-testid^="conversation-turn"]'
+DOM_QUIET_MS = 500
+DOM_POLL_MS = 100
+DOM_BACKOFF_MAX_MS = 2000
+DOM_STABLE_TIMEOUT_SEC = 40
+# サイドバー索引: 既知のチャットが SIDEBAR_OVERLAP 件連続したら、それ以降は前回から変化なしとみなして読み込みを止める
+SIDEBAR_LINK_SELECTOR = 'nav a[href^="/c/"]'
+SIDEBAR_OVERLAP = 5
+SIDEBAR_PAGE_TIMEOUT_MS = 3000
+SIDEBAR_FIRST_TIMEOUT_MS = 60000
+# 取込中のリスト更新 (索引の読み直しとGUIのリスト差し替え) は SIDEBAR_EMIT_SEC に1回まで。取込の最後には必ず1回行う
+SIDEBAR_EMIT_SEC = 2.0
+METRICS_HTTP_PORT = None
+# ログ: ファイル/コンソールへの出力は専用スレッドで行う。LOG_MAX_BYTES ごとにローテーションし、古い世代はgzip圧縮する。
+# LOG_RATE_LIMITS は1秒あたりにそのレベルで記録する上限件数 (超過分は省略件数だけを残す)
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_COMPRESS_ROTATED = True
+LOG_RATE_LIMITS = {logging.DEBUG: 200, logging.INFO: 50}
+CODE_FENCE_RE = re.compile(r"^```[ \t]*([A-Za-z0-9_+#.\-]*)[^\n]*\n(.*?)^```[ \t]*$", re.MULTILINE | re.DOTALL)
+# 会話JSONのMarkdownを、描画後の innerText (DOM解析の結果) と同じ形へ寄せるための規則
+MARKDOWN_LIST_RE = re.compile(r"^([ \t]*)(?:([-*+])|(\d+)[.)])[ \t]+(.*)$")
+MARKDOWN_HEADING_RE = re.compile(r"^[ \t]{0,3}#{1,6}[ \t]+(.*?)(?:[ \t]+#+)?[ \t]*$")
+MARKDOWN_RULE_RE = re.compile(r"^[ \t]{0,3}([-*_])(?:[ \t]*\1){2,}[ \t]*$")
+MARKDOWN_INLINE_RES = [
+    (re.compile(r"!?\[([^\]]*)\]\([^)\s]*(?:\s+\"[^\"]*\")?\)"), r"\1"),
+    (re.compile(r"(\*\*|__)(?=\S)(.+?)(?<=\S)\1"), r"\2"),
+    (re.compile(r"~~(?=\S)(.+?)(?<=\S)~~"), r"\1"),
+    (re.compile(r"(?<![\w*])\*(?=[^\s*])(.+?)(?<=[^\s*])\*(?![\w*])"), r"\1"),
+    (re.compile(r"(?<![\w\\])_(?=[^\s_])(.+?)(?<=[^\s_])_(?!\w)"), r"\1"),
+    (re.compile(r"\\([\\`*_{}\[\]()#+\-.!~>|])"), r"\1"),
+]
+MARKDOWN_CODE_SPAN_RE = re.compile(r"(`+)(.+?)\1")
+# チャット表示でのコードブロック区切り行。開始行の次の行が "## 言語名" ならその言語のコード
+CODE_BLOCK_START = "========コードブロック箇所ここから========"
+CODE_BLOCK_END = "========コードブロック箇所ここまで========"
+# コードブロックを書き出す際の拡張子 ("## 言語名" の大文字名から引く。無い場合は txt)
+CODE_FILE_EXTENSIONS = {
+    "PYTHON": "py", "PY": "py", "JAVASCRIPT": "js", "JS": "js", "TYPESCRIPT": "ts", "TS": "ts", "JSX": "jsx", "TSX": "tsx",
+    "C": "c", "CPP": "cpp", "C++": "cpp", "CSHARP": "cs", "C#": "cs", "JAVA": "java", "GO": "go", "RUST": "rs", "KOTLIN": "kt",
+    "SWIFT": "swift", "PHP": "php", "RUBY": "rb", "BASH": "sh", "SH": "sh", "SHELL": "sh", "ZSH": "sh", "POWERSHELL": "ps1",
+    "BAT": "bat", "SQL": "sql", "HTML": "html", "XML": "xml", "CSS": "css", "JSON": "json", "YAML": "yaml", "YML": "yaml",
+    "TOML": "toml", "MARKDOWN": "md", "DOCKERFILE": "Dockerfile",
+}
+# 検索DBのスキーマ版 (PRAGMA user_version)。上げた場合、登録済みのターンはキャッシュから登録し直す
+SEARCH_SCHEMA_VERSION = 1
+
+for d in [SESSION_DIR, TMP_DIR, LOG_DIR]:
+    os.makedirs(d, exist_ok=True)
+
+log_stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+log_filename = os.path.join(LOG_DIR, f"clwt_system_{log_stamp}.log")
+metrics_filename = os.path.join(LOG_DIR, f"clwt_metrics_{log_stamp}.jsonl")
+
+
+class RateLimitFilter(logging.Filter):
+    # レベルごとに1秒あたりの件数を制限する。捨てた件数は、次の区間で最初に通った記録へ付記する
+    def __init__(self, limits):
+        super().__init__()
+        self.limits = limits
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        limit = self.limits.get(record.levelno)
+        if not limit: return True
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.setdefault(record.levelno, [now, 0, 0])
+            if now - window[0] >= 1.0:
+                dropped = window[2]
+                window[:] = [now, 0, 0]
+                if dropped:
+                    record.msg = f"{record.getMessage()} (直前の{dropped}件を省略)"
+                    record.args = None
+            if window[1] >= limit:
+                window[2] += 1
+                return False
+            window[1] += 1
+        return True
+
+
+def gzip_rotated_log(source, dest):
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+file_handler = logging.handlers.RotatingFileHandler(log_filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+file_handler.setLevel(logging.DEBUG)
+file_formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
+file_handler.setFormatter(file_formatter)
+if LOG_COMPRESS_ROTATED:
+    file_handler.namer = lambda name: name + ".gz"
+    file_handler.rotator = gzip_rotated_log
+
+# ブラウザのイベントループとUIスレッドはキューへ積むだけで戻り、書き込み・ローテーション・圧縮はリスナースレッドが行う
+log_queue = queue.Queue()
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.addFilter(RateLimitFilter(LOG_RATE_LIMITS))
+log_listener = logging.handlers.QueueListener(log_queue, file_handler, logging.StreamHandler(sys.stdout), respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(queue_handler)
+
+class MetricsFormatter(logging.Formatter):
+    # 計測値のレコード (msg が dict) を jsonl の1行にする
+    def format(self, record):
+        return json.dumps(record.msg, ensure_ascii=False, separators=(",", ":"))
+
+class Metrics:
+    # 処理フェーズごとの所要時間 (span) を log1/clwt_metrics_*.jsonl へ1行1件で記録し、操作ごとの分布を保持する
+    def __init__(self, path, window=METRICS_WINDOW):
+        self.path = path
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.totals = {}
+        self.server = None
+        # ファイルへの書き込みはログと同じくキューへ積むだけにし、整形と書き込みは専用のリスナースレッドが行う
+        self.queue = queue.Queue()
+        handler = logging.FileHandler(path, encoding="utf-8", delay=True)
+        handler.setFormatter(MetricsFormatter())
+        self.listener = logging.handlers.QueueListener(self.queue, handler)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+
+    def record(self, op, ms, **fields):
+        entry = {"ts": datetime.now().isoformat(timespec="milliseconds"), "op": op, "ms": round(ms, 3)}
+        entry.update(fields)
+        with self.lock:
+            self.samples.setdefault(op, deque(maxlen=self.window)).append(ms)
+            total = self.totals.setdefault(op, [0, 0.0])
+            total[0] += 1
+            total[1] += ms
+        self.queue.put_nowait(logging.makeLogRecord({"msg": entry}))
+
+    @contextmanager
+    def span(self, op, **fields):
+        # with metrics.span("scrape", chat_id=...) as fields: の形で使い、fields へ結果の件数等を追記できる
+        started = time.perf_counter()
+        try:
+            yield fields
+        except BaseException as e:
+            fields["error"] = type(e).__name__
+            raise
+        finally:
+            self.record(op, (time.perf_counter() - started) * 1000, **fields)
+
+    @staticmethod
+    def percentile(values, q):
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+    def summary(self):
+        # [(op, 件数, p50, p95, max)] をms単位で返す
+        with self.lock:
+            snapshot = {op: list(values) for op, values in self.samples.items() if values}
+            counts = {op: total[0] for op, total in self.totals.items()}
+        return [
+            (op, counts.get(op, len(values)), self.percentile(values, 0.5), self.percentile(values, 0.95), max(values))
+            for op, values in sorted(snapshot.items())
+        ]
+
+    def prometheus_text(self):
+        lines = [
+            "# HELP clwt_span_seconds Duration of CLWT pipeline phases (recent window for quantiles).",
+            "# TYPE clwt_span_seconds summary",
+        ]
+        with self.lock:
+            totals = {op: list(total) for op, total in self.totals.items()}
+        for op, count, p50, p95, _ in self.summary():
+            label = op.replace("\\", "\\\\").replace('"', '\\"')
+            lines.append(f'clwt_span_seconds{{op="{label}",quantile="0.5"}} {p50 / 1000:.6f}')
+            lines.append(f'clwt_span_seconds{{op="{label}",quantile="0.95"}} {p95 / 1000:.6f}')
+            lines.append(f'clwt_span_seconds_sum{{op="{label}"}} {totals[op][1] / 1000:.6f}')
+            lines.append(f'clwt_span_seconds_count{{op="{label}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        try:
+            self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        except OSError as e:
+            logger.error(f"Metrics Endpoint Error: {e}")
+            return
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info(f"システム: 計測値を http://127.0.0.1:{port}/metrics で公開しています。")
+
+metrics = Metrics(metrics_filename)
+
+def cleanup_old_files():
+    # tmp1 は ChatCache が容量上限とLRUで管理するため、ここでは古いログのみ削除する
+    logger.info("システム: 古いログファイルのクリーンアップを実行します...")
+    now = time.time()
+    expiry_time = now - 604800
+    deleted_count = 0
+    for directory in [LOG_DIR]:
+        if not os.path.exists(directory): continue
+        for filename in os.listdir(directory):
+            filepath = os.path.join(directory, filename)
+            if os.path.isfile(filepath):
+                if os.stat(filepath).st_mtime < expiry_time:
+                    try:
+                        os.remove(filepath)
+                        deleted_count += 1
+                    except: pass
+
+def compress_text(text):
+    if not text: return ""
+    return re.sub(r'\n{3,}', '\n\n', text.strip())
+
+def common_prefix_length(a, b):
+    # 先頭から一致する文字数。追記だけなら startswith の1回で済み、途中が変わった場合は未確定の範囲だけを切り出して二分探索する
+    if b.startswith(a): return len(a)
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a.startswith(b[low:mid], low): low = mid
+        else: high = mid - 1
+    return low
+
+class StreamNormalizer:
+    # ストリーミング中の回答テキストを compress_text と同じ規則で整形し、前回からの変更を差分として返す。
+    # 末尾の空白は次の文字が来るまで確定させず、確定した位置を (元テキストの位置, 出力の長さ) の区切りとして記録する。
+    # 追記は末尾だけを整形し、途中の書き換え (マークダウンの再描画など) は変更位置より前の区切りから整形し直す
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.raw = ""
+        self.checkpoints = [(0, 0)]
+
+    @property
+    def length(self):
+        return self.checkpoints[-1][1]
+
+    def update(self, raw, prefix=None):
+        # raw は現在の全文、prefix は前回の全文と一致する先頭の文字数 (分かっていれば)。
+        # 戻り値は {"op": "append", "text"} / {"op": "replace", "offset", "text"} (出力の offset 以降を text で置き換え) / None (表示上の変化なし)
+        if prefix is None: prefix = common_prefix_length(self.raw, raw)
+        self.raw = raw
+        op = "append"
+        if prefix < self.checkpoints[-1][0]:
+            del self.checkpoints[bisect.bisect_right(self.checkpoints, (prefix, float("inf"))):]
+            op = "replace"
+        raw_end, offset = self.checkpoints[-1]
+
+        tail = raw[raw_end:]
+        keep = len(tail.rstrip())
+        text = tail[:keep]
+        if offset == 0: text = text.lstrip()
+        text = re.sub(r'\n{3,}', '\n\n', text)
+        if keep:
+            self.checkpoints.append((raw_end + keep, offset + len(text)))
+        if op == "replace":
+            return {"op": "replace", "offset": offset, "text": text}
+        return {"op": "append", "text": text} if text else None
+
+    def splice(self, offset, text):
+        # 前回の全文の offset 以降を text に置き換えた内容で update する (ページ内監視からの通知用)
+        return self.update(self.raw[:offset] + text, offset)
+
+def extract_code_blocks(item):
+    # format_chat_item の表示テキスト上で、コードブロックの行位置 (区切り行を含む0始まり)・言語・本文を取り出す
+    lines = format_chat_item(item)["text"].split("\n")
+    blocks = []
+    start = None
+    for number, line in enumerate(lines):
+        if start is None:
+            if line == CODE_BLOCK_START: start = number
+        elif line == CODE_BLOCK_END:
+            body = lines[start + 1:number]
+            lang = ""
+            if body and body[0].startswith("## "):
+                lang = body[0][3:].strip().upper()
+                body = body[1:]
+            code = "\n".join(body)
+            blocks.append({
+                "lang": lang, "line_start": start, "line_end": number, "code": code,
+                "h": hashlib.sha1(code.encode("utf-8")).hexdigest()[:16],
+            })
+            start = None
+    return blocks
+
+def format_chat_item(item):
+    role = item.get('role', 'unknown')
+    content = compress_text(item.get('text', ''))
+    if role == 'user':
+        return {"role": "user", "text": f"\nユーザ:\n{content}\n"}
+    elif role == 'assistant':
+        return {"role": "ai", "text": f"\nAI:\n{content}\n"}
+    else:
+        return {"role": "system", "text": f"\n不明:\n{content}\n"}
+
+def browser_launch_options(lean=None, headless=None):
+    if lean is None: lean = LEAN_MODE
+    if headless is None: headless = LEAN_HEADLESS if lean else False
+    options = {"headless": headless, "args": BROWSER_ARGS + (LEAN_BROWSER_ARGS if lean else [])}
+    if headless:
+        options["viewport"] = {"width": 1280, "height": 900}
+    else:
+        options["no_viewport"] = True
+    return options
+
+async def block_lean_resources(context, page):
+    # ページごとのCDPセッションでURL遮断とリソース種別の遮断を設定する (いずれもセッションを切り離すまで有効)。
+    # スタイルシートはDOM解析(innerText)の改行計算に必要なため遮断しない
+    async def fail(event):
+        try: await session.send("Fetch.failRequest", {"requestId": event["requestId"], "errorReason": "BlockedByClient"})
+        except Exception as e: logger.debug(f"Lean blocking error: {e}")
+
+    try:
+        session = await context.new_cdp_session(page)
+        await session.send("Network.enable")
+        await session.send("Network.setBlockedURLs", {"urls": LEAN_BLOCK_URL_PATTERNS})
+        if LEAN_BLOCK_RESOURCE_TYPES:
+            session.on("Fetch.requestPaused", lambda event: asyncio.ensure_future(fail(event)))
+            await session.send("Fetch.enable", {"patterns": [{"resourceType": kind} for kind in LEAN_BLOCK_RESOURCE_TYPES]})
+    except Exception as e:
+        logger.debug(f"Lean blocking error: {e}")
+
+def process_tree_rss(marker):
+    # コマンドラインに marker を含むプロセスとその子孫のRSS合計 (バイト)。/proc の無い環境では None
+    if not os.path.isdir("/proc"): return None
+    children = {}
+    rss = {}
+    roots = []
+    marker_bytes = marker.encode()
+    for name in os.listdir("/proc"):
+        if not name.isdigit(): continue
+        pid = int(name)
+        try:
+            with open(f"/proc/{pid}/stat", "rb") as f:
+                ppid = int(f.read().rsplit(b")", 1)[1].split()[1])
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                if marker_bytes in f.read(): roots.append(pid)
+            with open(f"/proc/{pid}/status", encoding="utf-8", errors="ignore") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss[pid] = int(line.split()[1]) * 1024
+                        break
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(pid)
+
+    seen = set()
+    stack = list(roots)
+    while stack:
+        pid = stack.pop()
+        if pid in seen: continue
+        seen.add(pid)
+        stack.extend(children.get(pid, []))
+    if not seen: return None
+    return sum(rss.get(pid, 0) for pid in seen)
+
+def build_chat_items(data_list, title=None):
+    items = []
+    if title:
+        items.append({"role": "system", "text": f"----------------------------------------\n{title}"})
+    for index, item in enumerate(data_list):
+        data = format_chat_item(item)
+        data["turn"] = index
+        items.append(data)
+    if title:
+        items.append({"role": "system", "text": "----------------------------------------\n"})
+    return items
+
+state_lock = threading.Lock()
+
+def load_app_state():
+    try:
+        with open(STATE_PATH, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        return state if isinstance(state, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def save_app_state(**updates):
+    # 次回起動時にブラウザを待たず表示するため、履歴リストと最後に開いたチャットを保存する
+    with state_lock:
+        state = load_app_state()
+        state.update(updates)
+        tmp_path = STATE_PATH + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f, ensure_ascii=False)
+            os.replace(tmp_path, STATE_PATH)
+        except OSError as e:
+            logger.error(f"State Save Error: {e}")
+
+def turn_hash(turn):
+    payload = f"{turn.get('role', '')}\0{turn.get('text', '')}"
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+def render_markdown_inline(text):
+    # 強調・取り消し線・リンク・エスケープの記号を外す。インラインコードの中身はそのまま残す
+    # split の結果は [本文, バッククォート, コード, 本文, ...] の繰り返し
+    pieces = MARKDOWN_CODE_SPAN_RE.split(text)
+    for i in range(0, len(pieces), 3):
+        for pattern, replacement in MARKDOWN_INLINE_RES:
+            pieces[i] = pattern.sub(replacement, pieces[i])
+    return "".join(piece.strip() if i % 3 == 2 else piece for i, piece in enumerate(pieces) if i % 3 != 1)
+
+def render_markdown_lines(text):
+    # コードフェンス以外の部分を、DOM解析 (scrape_current_chat) の表記に合わせて描画後のテキストへ変換する。
+    # 見出し・引用の記号は外し、箇条書きは "・ "、番号付きリストはリストごとに1から振り直した "N. " にする (どちらも字下げ無し)
+    lines = []
+    counters = {}
+    in_list = False
+    for line in text.split("\n"):
+        match = MARKDOWN_LIST_RE.match(line)
+        if match:
+            in_list = True
+            depth = len(match.group(1).expandtabs(4))
+            for key in [key for key in counters if key > depth]: del counters[key]
+            if match.group(2):
+                counters.pop(depth, None)
+                prefix = "・ "
+            else:
+                counters[depth] = counters.get(depth, 0) + 1
+                prefix = f"{counters[depth]}. "
+            lines.append(prefix + render_markdown_inline(match.group(4)))
+            continue
+        if line.strip() and not line[:1].isspace():
+            counters.clear()
+            in_list = False
+        if MARKDOWN_RULE_RE.match(line):
+            lines.append("")
+            continue
+        heading = MARKDOWN_HEADING_RE.match(line)
+        if heading:
+            line = heading.group(1)
+        else:
+            line = re.sub(r"^[ \t]{0,3}(?:>[ \t]?)+", "", line)
+        lines.append(render_markdown_inline(line.strip() if in_list else line))
+    return "\n".join(lines)
+
+def markdown_to_turn_text(text):
+    # 会話JSONのMarkdownを、DOM解析と同じ表記 (コードブロック区切り形式・描画後の本文) へ変換する
+    def replace(match):
+        lang = match.group(1).upper()
+        code = match.group(2).rstrip("\n")
+        header = f"## {lang}\n" if lang and lang not in ("CODE", "TEXT", "PLAINTEXT") else ""
+        return f"\n{CODE_BLOCK_START}\n{header}{code}\n{CODE_BLOCK_END}\n"
+    parts = []
+    position = 0
+    for match in CODE_FENCE_RE.finditer(text):
+        parts.append(render_markdown_lines(text[position:match.start()]))
+        parts.append(replace(match))
+        position = match.end()
+    parts.append(render_markdown_lines(text[position:]))
+    return "".join(parts).strip()
+
+def normalize_conversation(data):
+    # /backend-api/conversation/<id> のJSONを、DOM解析と同じ {role, text, id} のターン列へ変換する
+    mapping = data.get("mapping") or {}
+    node_id = data.get("current_node")
+    chain = []
+    if node_id in mapping:
+        # 表示中の枝だけを採用するため、現在ノードから親をたどる
+        seen = set()
+        while node_id and node_id in mapping and node_id not in seen:
+            seen.add(node_id)
+            chain.append(mapping[node_id])
+            node_id = mapping[node_id].get("parent")
+        chain.reverse()
+    else:
+        chain = sorted(mapping.values(), key=lambda n: (n.get("message") or {}).get("create_time") or 0)
+
+    turns = []
+    for node in chain:
+        message = node.get("message")
+        if not message: continue
+        role = (message.get("author") or {}).get("role")
+        if role not in ("user", "assistant"): continue
+        if message.get("recipient", "all") != "all": continue
+        metadata = message.get("metadata") or {}
+        if metadata.get("is_visually_hidden_from_conversation"): continue
+
+        content = message.get("content") or {}
+        content_type = content.get("content_type")
+        if content_type in ("text", "multimodal_text"):
+            text = "\n".join(part for part in content.get("parts") or [] if isinstance(part, str))
+        elif content_type == "code":
+            text = f"```{content.get('language') or ''}\n{content.get('text', '')}\n```"
+        else:
+            continue
+        text = markdown_to_turn_text(text)
+        if not text: continue
+
+        # 同じ発言者の連続メッセージ (途中で分割された回答等) は1ターンにまとめる
+        if turns and turns[-1]["role"] == role and role == "assistant":
+            turns[-1]["text"] += "\n\n" + text
+            continue
+        turns.append({"role": role, "text": text, "id": message.get("id", "")})
+    return turns
+
+def diff_turn_hashes(old_hashes, new_hashes):
+    # 変更/挿入/削除されたターン範囲を (tag, i1, i2, j1, j2) で返す。後方から適用できるよう逆順
+    matcher = difflib.SequenceMatcher(None, old_hashes, new_hashes, autojunk=False)
+    return [op for op in reversed(matcher.get_opcodes()) if op[0] != "equal"]
+
+class ChatCache:
+    # tmp1/<chat_id>.jsonl.gz: 1行目がヘッダ、以降はターンレコード({"i":n,...})と操作レコード({"op":...})の追記ログ
+    # 同じiのレコードは後勝ち。1ターン追加は1行の追記で済む
+    # 途中のターンの挿入/削除は {"op":"splice"} でずらし、続くターンレコードで埋める
+    # 追記は1回の保存ごとにgzipメンバーを連結する (gzipは連結されたメンバーを1つのストリームとして読める)
+    # 容量は CACHE_BUDGET_BYTES を上限に、最終アクセス時刻のLRUで古いチャットから追い出す
+    # save() は書き込み待ちに積むだけで戻り、書き込みスレッドが同じチャットへの保存を最新の1回にまとめて書く。
+    # 書き込み待ち・書き込み中のチャットは load()/exists() がメモリ上の内容を返す
+    FORMAT_VERSION = 1
+    RECORD_PREFIX = re.compile(r'^\{"i":(\d+),')
+    INDEX_FILENAME = ".cache_index.json"
+    INDEX_FLUSH_SEC = 60
+
+    def __init__(self, directory, budget_bytes=None):
+        self.directory = directory
+        self.budget_bytes = budget_bytes
+        self.disk_hashes = {}
+        self.line_counts = {}
+        self.lock = threading.RLock()
+        self.entries = None
+        self.index_dirty = False
+        self.index_flushed = 0.0
+        self.on_evict = None
+        self.on_write = None
+        self.pending_lock = threading.Condition()
+        self.pending = OrderedDict()
+        self.writing = {}
+        self.generation = 0
+        self.writer = None
+        self.closing = False
+
+    def path(self, chat_id):
+        return os.path.join(self.directory, f"{chat_id}.jsonl.gz")
+
+    def plain_path(self, chat_id):
+        return os.path.join(self.directory, f"{chat_id}.jsonl")
+
+    def legacy_path(self, chat_id):
+        return os.path.join(self.directory, f"{chat_id}.json")
+
+    def index_path(self):
+        return os.path.join(self.directory, self.INDEX_FILENAME)
+
+    def exists(self, chat_id):
+        if self.unwritten(chat_id) is not None: return True
+        with self.lock:
+            return chat_id in self.load_index()
+
+    def load_index(self):
+        # {chat_id: {"size": bytes, "atime": 最終アクセス}} をアクセス順 (古い順) に保持する。
+        # 起動後の初回だけ保存済みインデックスとディレクトリ一覧を突き合わせ、以降はメモリ上で完結させる
+        if self.entries is not None: return self.entries
+        saved = {}
+        try:
+            with open(self.index_path(), "r", encoding="utf-8") as f:
+                saved = json.load(f).get("entries", {})
+        except (OSError, ValueError, AttributeError):
+            pass
+
+        entries = {}
+        for filename in os.listdir(self.directory):
+            if filename.startswith("."): continue
+            for ext in (".jsonl.gz", ".jsonl", ".json"):
+                if filename.endswith(ext):
+                    chat_id = filename[:-len(ext)]
+                    break
+            else:
+                continue
+            try: stat = os.stat(os.path.join(self.directory, filename))
+            except OSError: continue
+            entry = entries.setdefault(chat_id, {"size": 0, "atime": saved.get(chat_id, {}).get("atime", stat.st_mtime)})
+            entry["size"] += stat.st_size
+
+        self.entries = OrderedDict(sorted(entries.items(), key=lambda item: item[1]["atime"]))
+        self.index_dirty = set(saved) != set(entries)
+        return self.entries
+
+    def flush_index(self, force=False):
+        with self.lock:
+            if not self.index_dirty or self.entries is None: return
+            now = time.time()
+            if not force and now - self.index_flushed < self.INDEX_FLUSH_SEC: return
+            tmp_path = self.index_path() + ".tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"entries": self.entries}, f, separators=(",", ":"))
+                os.replace(tmp_path, self.index_path())
+                self.index_dirty = False
+                self.index_flushed = now
+            except OSError as e:
+                logger.error(f"Cache Index Save Error: {e}")
+
+    def touch(self, chat_id, size=None):
+        entries = self.load_index()
+        entry = entries.setdefault(chat_id, {"size": 0, "atime": 0})
+        entry["atime"] = time.time()
+        if size is not None: entry["size"] = size
+        entries.move_to_end(chat_id)
+        self.index_dirty = True
+
+    def total_bytes(self):
+        with self.lock:
+            return sum(entry["size"] for entry in self.load_index().values())
+
+    def enforce_budget(self, keep=()):
+        # 上限を超えた分だけ、最後にアクセスされたのが最も古いチャットから削除する (keep は今回書いたチャット)
+        if not self.budget_bytes: return []
+        entries = self.load_index()
+        total = sum(entry["size"] for entry in entries.values())
+        evicted = []
+        for chat_id in list(entries):
+            if total <= self.budget_bytes: break
+            if chat_id in keep: continue
+            total -= entries[chat_id]["size"]
+            self.remove_files(chat_id)
+            evicted.append(chat_id)
+        if evicted:
+            logger.info(f"システム: キャッシュ容量上限のため{len(evicted)}件を削除しました ({total // 1024}KB)")
+            if self.on_evict:
+                for chat_id in evicted:
+                    try: self.on_evict(chat_id)
+                    except Exception as e: logger.error(f"Cache Evict Error ({chat_id}): {e}")
+        return evicted
+
+    def encode_record(self, index, turn):
+        record = {"i": index, "h": turn["h"], "role": turn.get("role", "unknown"), "text": turn.get("text", "")}
+        for key in ("id", "sig"):
+            if turn.get(key): record[key] = turn[key]
+        return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+    def read_log(self, chat_id, path, start=0):
+        turns = []
+        lines = 0
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline() or "{}")
+            if header.get("clwt_cache") != self.FORMAT_VERSION:
+                raise ValueError(f"unsupported cache header: {header}")
+            try:
+                for line in f:
+                    if not line.strip(): continue
+                    lines += 1
+                    match = self.RECORD_PREFIX.match(line)
+                    if match:
+                        index = int(match.group(1))
+                        # start未満のターンはJSONを展開せずプレースホルダのみ置く
+                        record = None if index < start else json.loads(line)
+                        if index < len(turns):
+                            turns[index] = record
+                        elif index == len(turns):
+                            turns.append(record)
+                        else:
+                            raise ValueError(f"record index gap at {index}")
+                    else:
+                        op = json.loads(line)
+                        if op.get("op") == "truncate":
+                            del turns[op["n"]:]
+                        elif op.get("op") == "splice":
+                            turns[op["at"]:op["at"] + op["del"]] = [None] * op["ins"]
+            except (ValueError, EOFError, OSError, zlib.error) as e:
+                # 書き込み途中で途切れた末尾行・末尾メンバーなどは、そこまでの内容で打ち切る
+                # 以降の追記が読めなくならないよう、次回保存時に全体を書き直させる
+                logger.warning(f"Cache Record Error ({chat_id}): {e}")
+                lines = sys.maxsize
+        return turns, lines
+
+    def unwritten(self, chat_id):
+        with self.pending_lock:
+            turns = self.pending.get(chat_id)
+            return turns if turns is not None else self.writing.get(chat_id)
+
+    def load(self, chat_id, start=0, touch=True):
+        turns = self.unwritten(chat_id)
+        if turns is not None:
+            if touch:
+                with self.lock: self.touch(chat_id)
+            return [dict(turn) for turn in turns[start:]]
+        return self.read_disk(chat_id, start, touch)
+
+    def read_disk(self, chat_id, start=0, touch=True):
+        with self.lock, metrics.span("cache_load", chat_id=chat_id, start=start):
+            path = self.path(chat_id)
+            if not os.path.exists(path):
+                turns = self.migrate(chat_id)
+                if turns and touch: self.touch(chat_id)
+                return turns[start:]
+
+            turns, lines = self.read_log(chat_id, path, start)
+            result = turns[start:]
+            if any(record is None for record in result):
+                if start > 0:
+                    return self.read_disk(chat_id, touch=touch)[start:]
+                logger.warning(f"Cache Record Error ({chat_id}): incomplete splice")
+                turns = result = [record for record in turns if record is not None]
+
+            for record in result:
+                record.pop("i", None)
+            if start == 0:
+                self.disk_hashes[chat_id] = [t["h"] for t in turns]
+                self.line_counts[chat_id] = lines
+            if touch:
+                self.touch(chat_id)
+                self.flush_index()
+            return result
+
+    def migrate(self, chat_id):
+        # 非圧縮の .jsonl と、さらに古い .json 形式を圧縮形式へ変換する
+        plain = self.plain_path(chat_id)
+        legacy = self.legacy_path(chat_id)
+        if os.path.exists(plain):
+            source = plain
+            turns = [t for t in self.read_log(chat_id, plain)[0] if t is not None]
+            for turn in turns: turn.pop("i", None)
+        elif os.path.exists(legacy):
+            source = legacy
+            with open(legacy, "r", encoding="utf-8") as f:
+                turns = json.load(f)
+        else:
+            return []
+        self.rewrite(chat_id, turns)
+        try: os.remove(source)
+        except: pass
+        logger.info(f"システム: 旧形式キャッシュを変換しました ({chat_id})")
+        return turns
+
+    def rewrite(self, chat_id, turns):
+        for turn in turns:
+            turn.setdefault("h", turn_hash(turn))
+        header = {"clwt_cache": self.FORMAT_VERSION, "chat_id": chat_id, "created": datetime.now().isoformat(timespec="seconds")}
+        path = self.path(chat_id)
+        tmp_path = path + ".tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=CACHE_COMPRESS_LEVEL) as f:
+            f.write(json.dumps(header, separators=(",", ":")) + "\n")
+            f.writelines(self.encode_record(i, turn) for i, turn in enumerate(turns))
+        os.replace(tmp_path, path)
+        self.disk_hashes[chat_id] = [t["h"] for t in turns]
+        self.line_counts[chat_id] = len(turns)
+        self.touch(chat_id, os.path.getsize(path))
+
+    def save(self, chat_id, turns):
+        # 呼び出し元 (ブラウザのイベントループ) はディスクを待たない
+        turns = list(turns)
+        for turn in turns:
+            turn.setdefault("h", turn_hash(turn))
+        with self.pending_lock:
+            self.pending[chat_id] = turns
+            self.pending.move_to_end(chat_id)
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.write_loop, name="ChatCacheWriter", daemon=True)
+                self.writer.start()
+            self.pending_lock.notify_all()
+
+    def write_loop(self):
+        while True:
+            with self.pending_lock:
+                while not self.pending and not self.closing:
+                    self.pending_lock.wait()
+                if self.closing: return
+            # 回答完了直後の保存と先読みの保存などが続けて来た場合に1回の書き込みへまとめる
+            time.sleep(CACHE_WRITE_DELAY_SEC)
+            self.flush_pending()
+
+    def flush_pending(self):
+        with self.pending_lock:
+            batch = list(self.pending.items())
+            self.writing.update(self.pending)
+            self.pending.clear()
+            generation = self.generation
+        if not batch: return
+
+        written = []
+        with metrics.span("cache_flush", chats=len(batch)):
+            for chat_id, turns in batch:
+                with self.lock:
+                    # 書き込み前に削除・クリアされた分は書かない
+                    with self.pending_lock:
+                        if self.writing.get(chat_id) is not turns: continue
+                    try:
+                        with metrics.span("cache_save", chat_id=chat_id, turns=len(turns)):
+                            self.write_turns(chat_id, turns)
+                        written.append((chat_id, turns))
+                    except Exception as e:
+                        logger.error(f"Cache Save Error ({chat_id}): {e}")
+                    with self.pending_lock:
+                        if self.writing.get(chat_id) is turns: del self.writing[chat_id]
+            with self.lock:
+                self.enforce_budget(keep={chat_id for chat_id, _ in batch})
+                self.flush_index()
+
+        with self.pending_lock:
+            self.pending_lock.notify_all()
+            if generation != self.generation: return
+        if self.on_write:
+            for chat_id, turns in written:
+                try: self.on_write(chat_id, turns)
+                except Exception as e: logger.error(f"Cache Write Hook Error ({chat_id}): {e}")
+
+    def close(self):
+        # 終了時: 書き込みスレッドを止め、残りを書き出してからインデックスを保存する
+        with self.pending_lock:
+            self.closing = True
+            self.pending_lock.notify_all()
+            writer = self.writer
+        if writer is not None: writer.join()
+        with self.pending_lock:
+            self.writer = None
+            self.closing = False
+        self.flush_pending()
+        self.flush_index(force=True)
+
+    def write_turns(self, chat_id, turns):
+        if chat_id not in self.disk_hashes:
+            if self.exists(chat_id):
+                try: self.read_disk(chat_id, touch=False)
+                except Exception as e: logger.warning(f"Cache Load Error ({chat_id}): {e}")
+        old_hashes = self.disk_hashes.get(chat_id)
+        if old_hashes is None or not os.path.exists(self.path(chat_id)):
+            self.rewrite(chat_id, turns)
+            return
+
+        new_hashes = [t["h"] for t in turns]
+        lines = []
+        for tag, i1, i2, j1, j2 in diff_turn_hashes(old_hashes, new_hashes):
+            if i2 - i1 != j2 - j1:
+                if j1 == j2 and i2 == len(old_hashes):
+                    op = {"op": "truncate", "n": i1}
+                else:
+                    op = {"op": "splice", "at": i1, "del": i2 - i1, "ins": j2 - j1}
+                if not (i1 == i2 == len(old_hashes)):
+                    lines.append(json.dumps(op, separators=(",", ":")) + "\n")
+            for k in range(j2 - j1):
+                lines.append(self.encode_record(i1 + k, turns[j1 + k]))
+        if not lines:
+            self.touch(chat_id)
+            return
+
+        line_count = self.line_counts.get(chat_id, 0) + len(lines)
+        if line_count > len(turns) * 2 + 16:
+            self.rewrite(chat_id, turns)
+            return
+
+        # 追記分は1つのgzipメンバーとしてメモリ上で圧縮し、1回の write で書く。
+        # 途中で落ちても壊れるのは末尾のメンバーだけで、read_log がそこまでで打ち切り次回の保存で書き直す
+        path = self.path(chat_id)
+        data = gzip.compress("".join(lines).encode("utf-8"), compresslevel=CACHE_COMPRESS_LEVEL)
+        with open(path, "ab") as f:
+            f.write(data)
+        self.disk_hashes[chat_id] = new_hashes
+        self.line_counts[chat_id] = line_count
+        self.touch(chat_id, os.path.getsize(path))
+
+    def remove_files(self, chat_id):
+        self.disk_hashes.pop(chat_id, None)
+        self.line_counts.pop(chat_id, None)
+        if self.entries is not None and self.entries.pop(chat_id, None) is not None:
+            self.index_dirty = True
+        for path in (self.path(chat_id), self.plain_path(chat_id), self.legacy_path(chat_id)):
+            if os.path.exists(path):
+                try: os.remove(path)
+                except: pass
+
+    def discard_unwritten(self, chat_id=None):
+        with self.pending_lock:
+            if chat_id is None:
+                self.pending.clear()
+                self.writing.clear()
+                self.generation += 1
+            else:
+                self.pending.pop(chat_id, None)
+                self.writing.pop(chat_id, None)
+
+    def delete(self, chat_id):
+        self.discard_unwritten(chat_id)
+        with self.lock:
+            self.remove_files(chat_id)
+            self.flush_index(force=True)
+
+    def clear(self):
+        self.discard_unwritten()
+        with self.lock:
+            self.disk_hashes.clear()
+            self.line_counts.clear()
+            self.entries = OrderedDict()
+            self.index_dirty = False
+            count = 0
+            for filename in os.listdir(self.directory):
+                filepath = os.path.join(self.directory, filename)
+                if os.path.isfile(filepath):
+                    try:
+                        os.remove(filepath)
+                        if not filename.startswith("."): count += 1
+                    except: pass
+            return count
+
+chat_cache = ChatCache(TMP_DIR, CACHE_BUDGET_BYTES)
+
+class SearchIndex:
+    # 全キャッシュ横断のFTS5全文検索インデックス。接続はスレッドごとに持つ
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.trigram = True
+
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.ensure_schema(conn)
+            self.local.conn = conn
+        return conn
+
+    def ensure_schema(self, conn):
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS turns (id INTEGER PRIMARY KEY, chat_id TEXT NOT NULL, turn INTEGER NOT NULL, role TEXT, h TEXT);
+            CREATE INDEX IF NOT EXISTS turns_chat ON turns (chat_id, turn);
+            CREATE TABLE IF NOT EXISTS chats (chat_id TEXT PRIMARY KEY, title TEXT);
+        """)
+        # サイドバー索引用の列 (旧スキーマからの追加)。last_seen の降順がサイドバーの並び順になる
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(chats)")}
+        for column, decl in (("url", "TEXT"), ("last_seen", "REAL")):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE chats ADD COLUMN {column} {decl}")
+        conn.execute("CREATE INDEX IF NOT EXISTS chats_last_seen ON chats (last_seen)")
+        try:
+            # trigramトークナイザは分かち書きのない日本語にも部分一致で効く (SQLite 3.34以降)
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS turns_fts USING fts5(text, tokenize='trigram')")
+        except sqlite3.OperationalError:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS turns_fts USING fts5(text)")
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'turns_fts'").fetchone()
+        self.trigram = bool(row and "trigram" in row[0])
+        # コードブロック索引。ターン番号は turns 側を参照するため、並びが変わっても付け替え不要
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS code_blocks (
+                id INTEGER PRIMARY KEY, turn_id INTEGER NOT NULL, chat_id TEXT NOT NULL,
+                lang TEXT, line_start INTEGER, line_end INTEGER, h TEXT, code TEXT
+            );
+            CREATE INDEX IF NOT EXISTS code_blocks_turn ON code_blocks (turn_id);
+            CREATE INDEX IF NOT EXISTS code_blocks_chat ON code_blocks (chat_id);
+        """)
+        if conn.execute("PRAGMA user_version").fetchone()[0] < SEARCH_SCHEMA_VERSION:
+            # 旧版で登録したターンにはコードブロックが無いため、ターンの登録を消して backfill にキャッシュから登録し直させる
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                if conn.execute("PRAGMA user_version").fetchone()[0] < SEARCH_SCHEMA_VERSION:
+                    conn.execute("DELETE FROM turns_fts")
+                    conn.execute("DELETE FROM turns")
+                    conn.execute("DELETE FROM code_blocks")
+                    conn.execute(f"PRAGMA user_version = {SEARCH_SCHEMA_VERSION}")
+
+    def update(self, chat_id, turns):
+        # 内容ハッシュが一致する既存行はターン番号の付け替えのみ行い、FTSへの再登録は変化したターンだけにする
+        conn = self.connect()
+        with conn:
+            existing = {}
+            for row_id, turn, h in conn.execute("SELECT id, turn, h FROM turns WHERE chat_id = ?", (chat_id,)):
+                existing.setdefault(h, []).append((row_id, turn))
+
+            for i, t in enumerate(turns):
+                h = t.get("h") or turn_hash(t)
+                rows = existing.get(h)
+                if rows:
+                    row_id, turn = rows.pop()
+                    if turn != i:
+                        conn.execute("UPDATE turns SET turn = ? WHERE id = ?", (i, row_id))
+                    continue
+                cur = conn.execute("INSERT INTO turns (chat_id, turn, role, h) VALUES (?, ?, ?, ?)", (chat_id, i, t.get("role", "unknown"), h))
+                conn.execute("INSERT INTO turns_fts (rowid, text) VALUES (?, ?)", (cur.lastrowid, t.get("text", "")))
+                conn.executemany(
+                    "INSERT INTO code_blocks (turn_id, chat_id, lang, line_start, line_end, h, code) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(cur.lastrowid, chat_id, b["lang"], b["line_start"], b["line_end"], b["h"], b["code"]) for b in extract_code_blocks(t)]
+                )
+
+            stale = [(row_id,) for rows in existing.values() for row_id, _ in rows]
+            if stale:
+                conn.executemany("DELETE FROM turns WHERE id = ?", stale)
+                conn.executemany("DELETE FROM turns_fts WHERE rowid = ?", stale)
+                conn.executemany("DELETE FROM code_blocks WHERE turn_id = ?", stale)
+
+    def update_history(self, history_data, seen_at):
+        # サイドバーで上から順に見えたチャットほど新しい last_seen にする (同じ取得内では1件ごとに1μsずらす)
+        rows = []
+        for position, item in enumerate(history_data):
+            match = re.search(r'/c/([a-zA-Z0-9-]+)', item.get("url", ""))
+            if match: rows.append((match.group(1), item.get("title", ""), item["url"], seen_at - position * 1e-6))
+        conn = self.connect()
+        with conn:
+            conn.executemany(
+                "INSERT INTO chats (chat_id, title, url, last_seen) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET title = excluded.title, url = excluded.url, last_seen = excluded.last_seen",
+                rows
+            )
+
+    def history(self):
+        rows = self.connect().execute(
+            "SELECT chat_id, title, COALESCE(url, 'https://chatgpt.com/c/' || chat_id) FROM chats ORDER BY last_seen DESC"
+        )
+        return [{"title": title or chat_id, "url": url} for chat_id, title, url in rows]
+
+    def history_ids(self, before=None):
+        # before 指定時は、その時刻より前に確認したチャットのみ
+        if before is not None:
+            rows = self.connect().execute("SELECT chat_id FROM chats WHERE last_seen < ?", (before,))
+        else:
+            rows = self.connect().execute("SELECT chat_id FROM chats WHERE last_seen IS NOT NULL")
+        return {row[0] for row in rows}
+
+    def indexed_chat_ids(self):
+        return {row[0] for row in self.connect().execute("SELECT DISTINCT chat_id FROM turns")}
+
+    def remove(self, chat_id):
+        conn = self.connect()
+        with conn:
+            conn.execute("DELETE FROM turns_fts WHERE rowid IN (SELECT id FROM turns WHERE chat_id = ?)", (chat_id,))
+            conn.execute("DELETE FROM turns WHERE chat_id = ?", (chat_id,))
+            conn.execute("DELETE FROM code_blocks WHERE chat_id = ?", (chat_id,))
+
+    def clear(self):
+        conn = self.connect()
+        with conn:
+            conn.execute("DELETE FROM turns_fts")
+            conn.execute("DELETE FROM turns")
+            conn.execute("DELETE FROM code_blocks")
+
+    def code_blocks(self, chat_id=None, limit=2000):
+        # (id, chat_id, ターン番号, 言語, 開始行, 終了行, チャット名, 先頭行) の一覧。chat_id 指定時はそのチャットのみ、無指定時は新しいチャット順
+        base = """
+            SELECT b.id, b.chat_id, t.turn, b.lang, b.line_start, b.line_end, COALESCE(c.title, ''), substr(b.code, 1, 200)
+            FROM code_blocks b JOIN turns t ON t.id = b.turn_id
+            LEFT JOIN chats c ON c.chat_id = b.chat_id
+        """
+        conn = self.connect()
+        if chat_id:
+            rows = conn.execute(base + " WHERE b.chat_id = ? ORDER BY t.turn, b.line_start LIMIT ?", (chat_id, limit))
+        else:
+            rows = conn.execute(base + " ORDER BY c.last_seen DESC, b.chat_id, t.turn, b.line_start LIMIT ?", (limit,))
+        return [row[:7] + (row[7].strip().split("\n", 1)[0],) for row in rows]
+
+    def code_block_texts(self, block_ids):
+        # {id: (chat_id, ターン番号, 言語, ハッシュ, 本文)}
+        conn = self.connect()
+        result = {}
+        ids = list(block_ids)
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            rows = conn.execute(
+                f"SELECT b.id, b.chat_id, t.turn, b.lang, b.h, b.code FROM code_blocks b JOIN turns t ON t.id = b.turn_id "
+                f"WHERE b.id IN ({','.join('?' * len(chunk))})", chunk
+            )
+            for block_id, chat_id, turn, lang, h, code in rows:
+                result[block_id] = (chat_id, turn, lang, h, code)
+        return result
+
+    def search(self, query, limit=200):
+        query = query.strip()
+        if not query: return []
+        conn = self.connect()
+        base = """
+            SELECT t.chat_id, t.turn, t.role, {snippet}, COALESCE(c.title, '')
+            FROM turns_fts JOIN turns t ON t.id = turns_fts.rowid
+            LEFT JOIN chats c ON c.chat_id = t.chat_id
+            WHERE {where} LIMIT ?
+        """
+        try:
+            if len(query) >= 3 or not self.trigram:
+                phrase = '"' + query.replace('"', '""') + '"'
+                sql = base.format(snippet="snippet(turns_fts, 0, '【', '】', '…', 16)", where="turns_fts MATCH ? ORDER BY rank")
+                rows = conn.execute(sql, (phrase, limit)).fetchall()
+                if rows or self.trigram: return rows
+            # trigramは2文字以下に効かないため、LIKEによる全走査で補う
+            like = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            sql = base.format(snippet="turns_fts.text", where="turns_fts.text LIKE ? ESCAPE '\\'")
+            rows = conn.execute(sql, (like, limit)).fetchall()
+        except sqlite3.Error as e:
+            logger.debug(f"Search Error: {e}")
+            return []
+        results = []
+        for chat_id, turn, role, text, title in rows:
+            pos = text.lower().find(query.lower())
+            if pos < 0:
+                snippet = text[:80]
+            else:
+                head = max(0, pos - 40)
+                end = pos + len(query)
+                snippet = ("…" if head else "") + text[head:pos] + "【" + text[pos:end] + "】" + text[end:end + 40]
+            results.append((chat_id, turn, role, snippet, title))
+        return results
+
+    def backfill(self, cache):
+        # 既存キャッシュのうち未登録のものをバックグラウンドで登録する
+        try:
+            indexed = self.indexed_chat_ids()
+            with cache.lock:
+                chat_ids = list(cache.load_index())
+            for chat_id in chat_ids:
+                if chat_id in indexed: continue
+                try:
+                    # 登録のための読み込みはアクセスとみなさない (LRU順を崩さない)
+                    self.update(chat_id, cache.load(chat_id, touch=False))
+                    indexed.add(chat_id)
+                except Exception as e:
+                    logger.debug(f"Search Backfill Error ({chat_id}): {e}")
+        except Exception as e:
+            logger.error(f"Search Backfill Error: {e}")
+
+search_index = SearchIndex(SEARCH_DB_PATH)
+
+def export_code_blocks(block_ids, directory):
+    # 索引済みのコードブロックを1件1ファイルで書き出す。同じ内容 (ハッシュ) は1回だけ書き、書き出した件数を返す
+    os.makedirs(directory, exist_ok=True)
+    texts = search_index.code_block_texts(block_ids)
+    written = set()
+    for block_id in block_ids:
+        if block_id not in texts: continue
+        chat_id, turn, lang, h, code = texts[block_id]
+        if h in written: continue
+        written.add(h)
+        name = f"{chat_id[:8]}_t{turn + 1:04d}_{h[:8]}.{CODE_FILE_EXTENSIONS.get(lang, 'txt')}"
+        with open(os.path.join(directory, name), "w", encoding="utf-8") as f:
+            f.write(code + "\n")
+    return len(written)
+
+def index_cached_turns(chat_id, turns):
+    # ChatCache の書き込みスレッドから呼ばれ、書き込めたチャットの検索インデックスを更新する
+    try:
+        with metrics.span("index_update", chat_id=chat_id, turns=len(turns)):
+            search_index.update(chat_id, turns)
+    except Exception as e:
+        logger.error(f"Search Index Error: {e}")
+
+chat_cache.on_evict = search_index.remove
+chat_cache.on_write = index_cached_turns
+
+
+class Signal:
+    # pyqtSignal と同じ connect/emit だけを持つ同期シグナル。Qtを使わない実行ではスロットをその場で呼ぶ
+    def __set_name__(self, owner, name):
+        self.attr = f"_{name}_slots"
+
+    def __get__(self, obj, objtype=None):
+        if obj is None: return self
+        return BoundSignal(obj.__dict__.setdefault(self.attr, []))
+
+
+class BoundSignal:
+    def __init__(self, slots):
+        self.slots = slots
+
+    def connect(self, slot):
+        self.slots.append(slot)
+
+    def emit(self, *args):
+        for slot in list(self.slots):
+            slot(*args)
+
+
+class BrowserWorker:
+    # ブラウザ操作・同期・送信の本体。GUIでは PlaywrightWorker (QThread) がシグナルを pyqtSignal に差し替えて使う
+    chat_batch_signal = Signal()
+    chat_patch_signal = Signal()
+    stream_start_signal = Signal()
+    stream_signal = Signal()
+    stream_patch_signal = Signal()
+    sys_signal = Signal()
+    history_list_signal = Signal()
+
+    def __init__(self, msg_queue=None):
+        super().__init__()
+        self.msg_queue = msg_queue if msg_queue is not None else queue.Queue()
+        self.is_running = True
+        self.timeout_ms = 300000
+        self.current_chat_id = "new_chat"
+        self.current_turns = []
+        self.browser_context = None
+        self.page = None
+        self.prefetch_pages = OrderedDict()
+        self.prefetch_queue = deque()
+        self.prefetch_task = None
+        self.loop = None
+        self.wakeup = None
+        self.page_lock = None
+        self.tasks = set()
+        self.page_tasks = set()
+        self.sidebar_task = None
+        self.stream_done = None
+        self.stream_page = None
+        self.stream_text = StreamNormalizer()
+        self.browser_error = None
+        self.captured = {}
+        self.capture_waiters = {}
+        self.start_url = "https://chatgpt.com/"
+        self.headless = None
+        self.send_started = None
+        self.first_token_seen = False
+        self.cache_shown = None
+
+    def submit(self, msg):
+        # UIスレッドから呼ばれる。キューに積んでイベントループを起こす
+        self.msg_queue.put(msg)
+        loop = self.loop
+        if loop is not None:
+            try: loop.call_soon_threadsafe(self.wakeup.set)
+            except RuntimeError: pass
+
+    def emit_sys_line(self, text):
+        logger.info(text)
+        self.sys_signal.emit({"type": "line", "text": text})
+
+    def emit_sys_append(self, text):
+        self.sys_signal.emit({"type": "append", "text": text})
+
+    def get_chat_id(self, url):
+        match = re.search(r'/c/([a-zA-Z0-9-]+)', url)
+        return match.group(1) if match else "new_chat"
+
+    def send_chat_data(self, data_list, title=None):
+        # ターン一覧をまとめて1シグナルで送る (UI側で一括描画)
+        self.chat_batch_signal.emit(build_chat_items(data_list, title))
+
+    def send_chat_patch(self, cached_data, current_data):
+        # ハッシュ比較で変化したターン範囲のみをchat_logへ差し替え指示する
+        old_hashes = [t.get("h") or turn_hash(t) for t in cached_data]
+        new_hashes = [t.get("h") or turn_hash(t) for t in current_data]
+        ops = []
+        changed = inserted = removed = 0
+        for tag, i1, i2, j1, j2 in diff_turn_hashes(old_hashes, new_hashes):
+            ops.append({"start": i1, "end": i2, "items": [format_chat_item(t) for t in current_data[j1:j2]]})
+            common = min(i2 - i1, j2 - j1)
+            changed += common
+            inserted += (j2 - j1) - common
+            removed += (i2 - i1) - common
+        if ops:
+            self.emit_sys_line(f"システム: Web側との差分を反映します。(変更:{changed}件 / 追加:{inserted}件 / 削除:{removed}件)")
+            self.chat_patch_signal.emit({"base": len(cached_data), "ops": ops})
+
+    def remember_chat(self, chat_id):
+        if chat_id != "new_chat":
+            save_app_state(last_url=f"https://chatgpt.com/c/{chat_id}")
+
+    def persist_turns(self, chat_id, turns):
+        # キャッシュと検索インデックスへの書き込みは ChatCache の書き込みスレッドで行う
+        chat_cache.save(chat_id, turns)
+
+    async def on_response(self, response):
+        # コンテキスト全体(メイン/先読みタブ)のレスポンスから会話JSONだけを拾う
+        match = CONVERSATION_API_RE.search(response.url.split("#")[0])
+        if not match or response.status != 200: return
+        chat_id = match.group(1)
+        try:
+            turns = normalize_conversation(await response.json())
+        except Exception as e:
+            logger.debug(f"Conversation capture error ({chat_id}): {e}")
+            return
+        if not turns: return
+        self.captured[chat_id] = turns
+        logger.debug(f"Conversation captured from network: {chat_id} ({len(turns)}件)")
+        waiter = self.capture_waiters.pop(chat_id, None)
+        if waiter and not waiter.done():
+            waiter.set_result(turns)
+
+    async def wait_captured(self, chat_id, timeout=CAPTURE_WAIT_SEC):
+        # 傍受結果は1回使えばキャッシュへ保存されるため、返した時点で captured から外す
+        if not NETWORK_CAPTURE or chat_id == "new_chat": return None
+        if chat_id in self.captured: return self.captured.pop(chat_id)
+        if timeout <= 0: return None
+        waiter = self.capture_waiters.get(chat_id)
+        if waiter is None or waiter.done():
+            waiter = self.loop.create_future()
+            self.capture_waiters[chat_id] = waiter
+        try:
+            turns = await asyncio.wait_for(asyncio.shield(waiter), timeout=timeout)
+            self.captured.pop(chat_id, None)
+            return turns
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            if self.capture_waiters.get(chat_id) is waiter and not waiter.done():
+                del self.capture_waiters[chat_id]
+
+    async def fetch_sidebar_history(self):
+        # サイドバーを下へ遅延スクロールしながら会話リンクを列挙し、chat_id → タイトル/URL/最終確認時刻 を索引へ保存する。
+        # 2回目以降は既知のチャットが SIDEBAR_OVERLAP 件続いた所で打ち切り、リストの先頭 (新規・更新分) だけを取り込む。
+        # 送信や移動と並行して走るため、毎回その時点の前面タブ (self.page) を参照する。
+        # 取得したページごとに索引へ保存してリストを更新し、中断された場合は次回その取得の開始前に既知だったチャットまで読み直す
+        from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+        # 取得済み件数 (offset) 以降のリンクだけを返し、スクロールのたびに全件を往復させない
+        collect_js = """
+        (args) => Array.from(document.querySelectorAll(args.selector)).slice(args.offset).map(a => {
+            return {title: a.innerText.split('\\n')[0].trim(), url: a.href};
+        })
+        """
+        scroll_js = """
+        (selector) => {
+            let el = document.querySelector(selector);
+            while (el && el !== document.body) {
+                const style = getComputedStyle(el);
+                if ((style.overflowY === 'auto' || style.overflowY === 'scroll') && el.scrollHeight > el.clientHeight) break;
+                el = el.parentElement;
+            }
+            if (!el || el === document.body) return false;
+            if (el.scrollTop + el.clientHeight >= el.scrollHeight - 1) return false;
+            el.scrollTop = el.scrollHeight;
+            return true;
+        }
+        """
+        grow_js = "(args) => document.querySelectorAll(args.selector).length > args.count"
+
+        self.emit_sys_line("システム: 最新の履歴リストの同期を試みます")
+        started = time.perf_counter()
+        seen_at = time.time()
+        interrupted = load_app_state().get("sidebar_pending")
+        try: known = search_index.history_ids(before=interrupted - 1 if interrupted else None)
+        except Exception as e:
+            logger.error(f"Search Index Error: {e}")
+            known = set()
+
+        try:
+            await self.page.wait_for_selector(SIDEBAR_LINK_SELECTOR, state="attached", timeout=SIDEBAR_FIRST_TIMEOUT_MS)
+        except PlaywrightTimeoutError:
+            self.emit_sys_line("システムエラー: 履歴リストを取得できませんでした。(サイドバーが表示されていません)")
+            return
+
+        # 中断が続いた場合も、最初に中断された取得の開始時刻を残す
+        if not interrupted: save_app_state(sidebar_pending=seen_at)
+        collected = []
+        seen = set()
+        offset = 0
+        overlap = 0
+        pages = 0
+        added = 0
+        pending_emit = False
+        emitted_at = time.perf_counter()
+        finished = False
+        try:
+            while self.is_running:
+                batch = await self.page.evaluate(collect_js, {"selector": SIDEBAR_LINK_SELECTOR, "offset": offset})
+                offset += len(batch)
+                pages += 1
+                fresh = []
+                for item in batch:
+                    chat_id = self.get_chat_id(item.get("url", ""))
+                    if chat_id == "new_chat" or chat_id in seen: continue
+                    seen.add(chat_id)
+                    fresh.append(item)
+                    overlap = overlap + 1 if chat_id in known else 0
+                if fresh:
+                    new_count = sum(1 for item in fresh if self.get_chat_id(item["url"]) not in known)
+                    added += new_count
+                    try:
+                        search_index.update_history(fresh, seen_at - len(collected) * 1e-6)
+                    except Exception as e:
+                        logger.error(f"Search Index Error: {e}")
+                    collected.extend(fresh)
+                    pending_emit = pending_emit or new_count > 0
+                if pending_emit and time.perf_counter() - emitted_at >= SIDEBAR_EMIT_SEC:
+                    try:
+                        self.history_list_signal.emit(search_index.history())
+                    except Exception as e:
+                        logger.error(f"Search Index Error: {e}")
+                    pending_emit = False
+                    emitted_at = time.perf_counter()
+                # 既知のチャットへ追いついた・リストの末尾に達した場合は、最後まで取り込めたとみなす
+                finished = bool(known and overlap >= SIDEBAR_OVERLAP) or not await self.page.evaluate(scroll_js, SIDEBAR_LINK_SELECTOR)
+                if finished: break
+                try:
+                    await self.page.wait_for_function(grow_js, arg={"selector": SIDEBAR_LINK_SELECTOR, "count": offset}, timeout=SIDEBAR_PAGE_TIMEOUT_MS)
+                except PlaywrightTimeoutError:
+                    finished = True
+                    break
+                self.emit_sys_append(f" {len(collected)}")
+        except BaseException:
+            # 中断された場合も、それまでに取り込んだ分をリストへ反映してから抜ける
+            if pending_emit:
+                try: self.history_list_signal.emit(search_index.history())
+                except Exception as e: logger.error(f"Search Index Error: {e}")
+            raise
+
+        if finished: save_app_state(sidebar_pending=None)
+        metrics.record("sidebar", (time.perf_counter() - started) * 1000, count=len(collected), added=added, pages=pages, finished=finished)
+        if not collected:
+            self.emit_sys_line("システムエラー: 履歴リストを取得できませんでした。")
+            return
+        try:
+            history_data = search_index.history()
+        except Exception as e:
+            logger.error(f"Search Index Error: {e}")
+            history_data = collected
+        self.emit_sys_append(" 完了\n")
+        self.history_list_signal.emit(history_data)
+        self.schedule_prefetch(history_data)
+        self.emit_sys_line(f"システム: 履歴リストを同期しました。(確認:{len(collected)}件 / 新規:{added}件 / 索引:{len(history_data)}件)")
+
+    async def scrape_current_chat(self, page, cached_data=None):
+        # 実DOMからの直接抽出と退避による、改行・言語の絶対保持ロジック
+        # known(キャッシュ済みターンのid/sig)と一致するターンは直列化せずkeep指示のみ返す
+        js_code = """
+        (known) => {
+            const articles = document.querySelectorAll('article[data-testid^="conversation-turn"]');
+
+            // textContentはレイアウトを発生させないため、変更検知用の軽量シグネチャに使う
+            const signature = (str) => {
+                let h = 0x811c9dc5;
+                for (let i = 0; i < str.length; i++) {
+                    h ^= str.charCodeAt(i);
+                    h = Math.imul(h, 0x01000193);
+                }
+                return (h >>> 0).toString(16) + ':' + str.length;
+            };
+
+            let container = null;
+            const getContainer = () => {
+                if (!container) {
+                    container = document.createElement('div');
+                    container.style.position = 'absolute';
+                    container.style.left = '-9999px';
+                    container.style.width = '1000px';
+                    container.style.whiteSpace = 'pre-wrap';
+                    document.body.appendChild(container);
+                }
+                return container;
+            };
+
+            const results = Array.from(articles).map((a, index) => {
+                const roleEl = a.querySelector('[data-message-author-role]');
+                const role = roleEl ? roleEl.getAttribute('data-message-author-role') : 'unknown';
+                const id = (roleEl && roleEl.getAttribute('data-message-id')) || a.getAttribute('data-testid') || '';
+                const sig = signature(a.textContent || '');
+
+                // 会話JSONから取り込んだターンは sig を持たないため、メッセージidの一致だけで再利用し sig を補う
+                const prev = known[index];
+                if (prev && prev.id === id && (prev.sig === sig || (!prev.sig && id))) {
+                    return prev.sig ? { keep: index } : { keep: index, sig: sig };
+                }
+
+                // ★超重要：画面にマウント済みの実要素(a)からコードを直接抽出し退避させる★
+                const originalPres = Array.from(a.querySelectorAll('pre'));
+                const preTexts = originalPres.map(pre => {
+                    let lang = '';
+                    const codeEl = pre.querySelector('code');
+
+                    if (codeEl && codeEl.className) {
+                        const match = codeEl.className.match(/language-([a-zA-Z0-9_\\-]+)/);
+                        if (match) lang = match[1].toUpperCase();
+                    }
+                    if (!lang) {
+                        const headerSpan = pre.querySelector('.flex.items-center span, .bg-token-main-surface-secondary span');
+                        if (headerSpan && headerSpan.textContent) {
+                            lang = headerSpan.textContent.trim().toUpperCase();
+                        }
+                    }
+
+                    // 実画面のinnerTextを使うため、ブラウザが計算した完璧な改行が保持される
+                    let text = pre.innerText || pre.textContent;
+
+                    // Copy codeボタン等の混入ノイズを消去
+                    text = text.replace(/^(Copy code|コピー)\\s*/i, '').trim();
+                    if (lang && lang !== 'CODE' && lang !== 'TEXT' && lang !== 'PLAINTEXT') {
+                        const langRegex = new RegExp('^' + lang + '\\\\s*', 'i');
+                        text = text.replace(langRegex, '').trim();
+                        lang = '## ' + lang + '\\n';
+                    } else {
+                        lang = '';
+                    }
+
+                    return '\\n========コードブロック箇所ここから========\\n' + lang + text + '\\n========コードブロック箇所ここまで========\\n';
+                });
+
+                const targetEl = roleEl ? roleEl : a;
+                const clone = targetEl.cloneNode(true);
+
+                // clone側のpreをプレースホルダに置き換える
+                clone.querySelectorAll('pre').forEach((pre, idx) => {
+                    const marker = document.createElement('div');
+                    marker.innerText = `___CODE_BLOCK_${idx}___`;
+                    pre.replaceWith(marker);
+                });
+
+                // リスト改行の保護
+                clone.querySelectorAll('ol').forEach(ol => {
+                    let i = 1;
+                    Array.from(ol.children).forEach(child => {
+                        if (child.tagName === 'LI') {
+                            const p = child.querySelector('p');
+                            (p ? p : child).prepend(document.createTextNode(i + '. '));
+                            i++;
+                        }
+                    });
+                });
+                clone.querySelectorAll('ul').forEach(ul => {
+                    Array.from(ul.children).forEach(child => {
+                        if (child.tagName === 'LI') {
+                            const p = child.querySelector('p');
+                            (p ? p : child).prepend(document.createTextNode('・ '));
+                        }
+                    });
+                });
+
+                const wrapperDiv = document.createElement('div');
+                wrapperDiv.appendChild(clone);
+                getContainer().appendChild(wrapperDiv);
+
+                return { role: role, id: id, sig: sig, element: wrapperDiv, codes: preTexts };
+            });
+
+            // コンテナで計算された本文テキストと、退避させた完璧なコードテキストを合体
+            const finalData = results.map(item => {
+                if (!item.element) return item;
+                let text = item.element.innerText;
+                item.codes.forEach((codeStr, idx) => {
+                    text = text.replace(`___CODE_BLOCK_${idx}___`, codeStr);
+                });
+                return { role: item.role, text: text, id: item.id, sig: item.sig };
+            });
+
+            if (container) document.body.removeChild(container);
+            return finalData;
+        }
+        """
+        known = []
+        if cached_data:
+            known = [{"id": t.get("id"), "sig": t.get("sig")} for t in cached_data]
+
+        try:
+            results = await page.evaluate(js_code, known)
+        except Exception as e:
+            logger.debug(f"JS Bulk Evaluate Error: {e}")
+            if known: return await self.scrape_current_chat(page)
+            return []
+
+        turns = []
+        reused = 0
+        for item in results:
+            if "keep" in item:
+                index = item["keep"]
+                if not cached_data or index >= len(cached_data):
+                    # キャッシュとの対応が崩れた場合は全件走査にフォールバック
+                    logger.debug("Incremental scrape mismatch. Falling back to full scan.")
+                    return await self.scrape_current_chat(page)
+                turn = cached_data[index]
+                if "sig" in item: turn = {**turn, "sig": item["sig"]}
+                turns.append(turn)
+                reused += 1
+            else:
+                turns.append(item)
+
+        if known:
+            logger.debug(f"Incremental scrape: {len(turns) - reused} serialized / {reused} reused")
+        return turns
+
+    def on_stream_event(self, source, payload):
+        # ページ内MutationObserverからのpush通知 (expose_binding経由)
+        # 送信中以外の通知や、送信したページ以外 (移動で差し替わる前のタブ等) からの通知は捨てる
+        if not isinstance(payload, dict): return
+        if self.stream_done is None or source.get("page") is not self.stream_page: return
+        if "text" in payload:
+            self.emit_stream_patch(self.stream_text.splice(payload.get("offset", 0), payload["text"]))
+        if payload.get("done"):
+            logger.debug(f"Stream observer finished: reason={payload.get('reason')}")
+            if self.stream_done and not self.stream_done.done():
+                self.stream_done.set_result(payload.get("reason"))
+
+    def emit_stream_patch(self, patch):
+        # 追記は従来どおり stream_signal で文字列として、途中からの置き換えは stream_patch_signal で {offset, text} として通知する
+        if not patch: return
+        if patch["op"] == "append":
+            self.mark_first_token()
+            self.stream_signal.emit(patch["text"])
+        else:
+            self.stream_patch_signal.emit({"offset": patch["offset"], "text": patch["text"]})
+
+    def mark_first_token(self):
+        if self.send_started is not None and not self.first_token_seen:
+            self.first_token_seen = True
+            metrics.record("first_token", (time.perf_counter() - self.send_started) * 1000, chat_id=self.current_chat_id)
+
+    async def install_stream_observer(self, page):
+        # 送信前に既存のassistant要素数を記録し、新規要素のみを監視対象にする
+        # 整形前の innerText を前回と比べ、変わった位置 (offset) 以降だけを送る。整形は StreamNormalizer が行う
+        js_code = """
+        (opts) => {
+            if (typeof window.clwtStreamEvent !== 'function') return false;
+            const prev = window.__clwtStream;
+            if (prev) prev.stop();
+
+            const sel = '[data-message-author-role="assistant"]';
+            const st = {
+                baseline: document.querySelectorAll(sel).length,
+                sent: '', seen: false, done: false, sawGenerating: false,
+                flushTimer: null, settleTimer: null, idleTimer: null
+            };
+            const commonPrefix = (a, b) => {
+                if (b.startsWith(a)) return a.length;
+                const n = Math.min(a.length, b.length);
+                let i = 0;
+                while (i < n && a.charCodeAt(i) === b.charCodeAt(i)) i++;
+                return i;
+            };
+            const target = () => {
+                const els = document.querySelectorAll(sel);
+                return els.length > st.baseline ? els[els.length - 1] : null;
+            };
+            const generating = () => !!document.querySelector(opts.stopSelector);
+
+            const flush = () => {
+                st.flushTimer = null;
+                const el = target();
+                if (!el) return;
+                const text = el.innerText || '';
+                if (text !== st.sent) {
+                    const offset = commonPrefix(st.sent, text);
+                    st.sent = text;
+                    if (!st.seen && text.trim()) st.seen = true;
+                    window.clwtStreamEvent({offset: offset, text: text.slice(offset)});
+                }
+            };
+            const finish = (reason) => {
+                if (st.done) return;
+                flush();
+                st.done = true;
+                st.stop();
+                window.clwtStreamEvent({done: true, reason: reason});
+            };
+            const settle = () => {
+                st.settleTimer = null;
+                flush();
+                if (!st.seen) return;
+                if (generating()) { st.sawGenerating = true; return; }
+                // 停止ボタンを一度も検知できていない場合はidleタイマーに任せる
+                if (st.sawGenerating) finish('settled');
+            };
+
+            st.stop = () => {
+                st.observer.disconnect();
+                clearTimeout(st.flushTimer);
+                clearTimeout(st.settleTimer);
+                clearTimeout(st.idleTimer);
+            };
+            st.observer = new MutationObserver(() => {
+                if (st.done) return;
+                if (generating()) st.sawGenerating = true;
+                if (!st.flushTimer) st.flushTimer = setTimeout(flush, opts.flushMs);
+                clearTimeout(st.settleTimer);
+                st.settleTimer = setTimeout(settle, opts.settleMs);
+                clearTimeout(st.idleTimer);
+                st.idleTimer = setTimeout(() => { if (st.seen) finish('idle'); }, opts.idleMs);
+            });
+            st.observer.observe(document.body, {childList: true, subtree: true, characterData: true, attributes: true, attributeFilter: ['data-testid']});
+            window.__clwtStream = st;
+            return true;
+        }
+        """
+        try:
+            return await page.evaluate(js_code, {
+                "stopSelector": STOP_BUTTON_SELECTOR,
+                "flushMs": 30,
+                "settleMs": 1500,
+                "idleMs": 10000,
+            })
+        except Exception as e:
+            logger.debug(f"Stream observer install error: {e}")
+            return False
+
+    async def wait_stream_observer(self, page):
+        # 完了イベント(on_stream_eventのdone通知)を待つ。待機中も他のコマンドは処理され、キャンセルで即中断できる
+        try:
+            await asyncio.wait_for(asyncio.shield(self.stream_done), timeout=600)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def stop_stream(self, page):
+        try:
+            await page.evaluate("() => { if (window.__clwtStream) { window.__clwtStream.done = true; window.__clwtStream.stop(); } }")
+            if await page.locator(STOP_BUTTON_SELECTOR).count() > 0:
+                await page.click(STOP_BUTTON_SELECTOR, timeout=2000)
+        except Exception as e:
+            logger.debug(f"Stream stop error: {e}")
+
+    async def poll_stream_response(self, page):
+        stable_count = 0
+        for _ in range(600):
+            if not self.is_running: return False
+            await page.wait_for_timeout(1000)
+            self.emit_sys_append(".")
+            assistant_messages = await page.locator('[data-message-author-role="assistant"]').all()
+            if not assistant_messages: continue
+
+            try:
+                raw_current_text = await assistant_messages[-1].inner_text(timeout=1000)
+            except: continue
+
+            patch = self.stream_text.update(raw_current_text)
+            if patch:
+                self.emit_stream_patch(patch)
+                stable_count = 0
+            else:
+                if self.stream_text.length: stable_count += 1
+
+            if stable_count >= 10:
+                return True
+        return False
+
+    async def wait_dom_stable(self, page, quiet=False):
+        # 会話ターン一覧の変化をページ内のMutationObserverで監視し、DOM_QUIET_MS の間変化が無ければ安定とみなす。
+        # 監視を仕込めない場合は、間隔を倍々に伸ばす件数ポーリングで代替する。quiet=True (先読み) はログを出さない
+        from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+        js_code = """
+        (opts) => {
+            let st = window.__clwtQuiet;
+            if (!st || st.href !== location.href) {
+                if (st) st.observer.disconnect();
+                const now = performance.now();
+                st = { href: location.href, started: now, changed: now, count: -1, tail: -1 };
+                // 件数か末尾ターンの文字数が変わった時刻だけを記録する。件数が増えたら遅延読み込みのため下へスクロール
+                st.check = () => {
+                    const els = document.querySelectorAll(opts.selector);
+                    const tail = els.length ? (els[els.length - 1].textContent || '').length : -1;
+                    if (els.length !== st.count || tail !== st.tail) {
+                        if (els.length !== st.count) window.scrollTo(0, document.body.scrollHeight);
+                        st.count = els.length;
+                        st.tail = tail;
+                        st.changed = performance.now();
+                    }
+                };
+                st.observer = new MutationObserver(st.check);
+                st.observer.observe(document.body, {childList: true, subtree: true, characterData: true});
+                window.__clwtQuiet = st;
+                st.check();
+            }
+            const now = performance.now();
+            if (st.count > 0 && now - st.changed >= opts.quietMs) {
+                st.observer.disconnect();
+                window.__clwtQuiet = null;
+                return { count: st.count, waitedMs: Math.round(now - st.started) };
+            }
+            return false;
+        }
+        """
+        started = time.perf_counter()
+        deadline = started + DOM_STABLE_TIMEOUT_SEC
+        result = None
+        method = "observer"
+        retries = 0
+        while result is None and self.is_running:
+            remaining_ms = (deadline - time.perf_counter()) * 1000
+            if remaining_ms <= 0: break
+            try:
+                handle = await page.wait_for_function(
+                    js_code, arg={"selector": TURN_SELECTOR, "quietMs": DOM_QUIET_MS},
+                    polling=DOM_POLL_MS, timeout=remaining_ms
+                )
+                result = await handle.json_value()
+            except PlaywrightTimeoutError:
+                break
+            except Exception as e:
+                if "closed" in str(e).lower() or "target" in str(e).lower():
+                    raise e
+                # 遷移直後で実行コンテキストが入れ替わった場合などは数回やり直し、それでも駄目ならポーリングへ
+                retries += 1
+                if retries <= 3:
+                    await asyncio.sleep(DOM_POLL_MS / 1000)
+                    continue
+                logger.debug(f"DOM observer error, falling back to polling: {e}")
+                method = "backoff"
+                result = await self.poll_dom_backoff(page, deadline)
+        if not self.is_running: return False
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        count = result.get("count") if result else None
+        metrics.record("dom_stable", elapsed_ms, method=method, turns=count, ready=bool(result))
+        if result:
+            logger.debug(f"DOM stable: {count} turns in {elapsed_ms:.0f}ms ({method})")
+            if not quiet: self.emit_sys_append(f" [検知:{count}件] 安定化確認 ({elapsed_ms / 1000:.2f}秒)\n")
+        elif not quiet:
+            self.emit_sys_append(" タイムアウト\n")
+            self.emit_sys_line("システム: DOM同期がタイムアウトしました。取得できた状態までで進行します。")
+        return True
+
+    async def poll_dom_backoff(self, page, deadline):
+        # 件数が変わるたびに間隔を最短へ戻し、変化が無い間は倍々に伸ばす。DOM_QUIET_MS 以上同じ件数なら安定
+        delay = DOM_POLL_MS / 1000
+        last_count = -1
+        changed_at = time.perf_counter()
+        while self.is_running and time.perf_counter() < deadline:
+            try:
+                count = await page.locator(TURN_SELECTOR).count()
+            except Exception as e:
+                if "closed" in str(e).lower() or "target" in str(e).lower():
+                    raise e
+                count = -1
+            now = time.perf_counter()
+            if count != last_count:
+                last_count = count
+                changed_at = now
+                delay = DOM_POLL_MS / 1000
+                if count > 0:
+                    try: await page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
+                    except: pass
+            elif count > 0 and (now - changed_at) * 1000 >= DOM_QUIET_MS:
+                return {"count": count}
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, DOM_BACKOFF_MAX_MS / 1000)
+        return None
+
+    def schedule_prefetch(self, history_data):
+        self.prefetch_queue.clear()
+        for item in history_data[:PREFETCH_TABS]:
+            if self.get_chat_id(item.get("url", "")) != self.current_chat_id:
+                self.prefetch_queue.append(item["url"])
+        if self.prefetch_queue and (self.prefetch_task is None or self.prefetch_task.done()):
+            self.prefetch_task = self.spawn(self.prefetch_loop(), "先読み")
+
+    async def prefetch_loop(self):
+        # 裏タブで上位チャットを1件ずつ読み込みキャッシュへ反映する。メインタブの操作とは並行に進む
+        while self.prefetch_queue and self.is_running:
+            await self.prefetch_step()
+
+    async def prefetch_step(self):
+        if not self.prefetch_queue or not self.browser_context: return
+        url = self.prefetch_queue.popleft()
+        chat_id = self.get_chat_id(url)
+        if chat_id == "new_chat" or chat_id == self.current_chat_id: return
+
+        page = self.prefetch_pages.pop(chat_id, None)
+        started = time.perf_counter()
+        try:
+            if page is None:
+                page = await self.open_page()
+                self.captured.pop(chat_id, None)
+                await page.goto(url, wait_until="domcontentloaded")
+            turns = await self.read_chat_turns(page, chat_id)
+            if turns:
+                self.persist_turns(chat_id, turns)
+            await self.keep_prefetched_page(chat_id, page)
+            metrics.record("prefetch", (time.perf_counter() - started) * 1000, chat_id=chat_id, turns=len(turns))
+            logger.info(f"システム: 先読み完了 ({chat_id}: {len(turns)}件)")
+        except asyncio.CancelledError:
+            # 中断された場合は続きを後回しにしてタブだけ保持する
+            self.prefetch_queue.appendleft(url)
+            if page is not None: await self.keep_prefetched_page(chat_id, page)
+            raise
+        except Exception as e:
+            logger.debug(f"Prefetch Error ({chat_id}): {e}")
+            try: await page.close()
+            except: pass
+
+    async def read_chat_turns(self, page, chat_id):
+        # 裏タブで開いたチャットのターン列を、傍受した会話JSONか、キャッシュとの差分DOM解析 (DOMが先に安定した場合) で取得する
+        turns, _ = await self.wait_captured_or_dom(page, chat_id, quiet=True)
+        if turns: return turns
+        cached = []
+        if chat_cache.exists(chat_id):
+            try: cached = chat_cache.load(chat_id)
+            except Exception as e: logger.error(f"Cache Load Error: {e}")
+        return await self.scrape_current_chat(page, cached)
+
+    async def wait_captured_or_dom(self, page, chat_id, quiet=False):
+        # 会話JSONの傍受とDOM安定待ちを並行させ、先に揃った方を使う。(傍受したターン列 or None, DOM安定待ちの結果) を返す。
+        # 傍受が無い (再利用したタブ・HTTPキャッシュからの読み込み等) 場合も、DOMが安定した時点で待ちを終える
+        capture = self.loop.create_task(self.wait_captured(chat_id))
+        dom = self.loop.create_task(self.wait_dom_stable(page, quiet=quiet))
+        try:
+            done, _ = await asyncio.wait({capture, dom}, return_when=asyncio.FIRST_COMPLETED)
+            if capture in done and capture.result():
+                return capture.result(), True
+            ready = await dom
+            if capture.done() and capture.result():
+                return capture.result(), True
+            return None, ready
+        finally:
+            for task in (capture, dom):
+                task.cancel()
+            await asyncio.gather(capture, dom, return_exceptions=True)
+            # DOM解析を採用した場合、後から届いた傍受結果を次回の読み込みで使わないよう捨てる
+            self.captured.pop(chat_id, None)
+
+    async def keep_prefetched_page(self, chat_id, page):
+        self.prefetch_pages[chat_id] = page
+        self.prefetch_pages.move_to_end(chat_id)
+        while len(self.prefetch_pages) > PREFETCH_TABS:
+            _, old_page = self.prefetch_pages.popitem(last=False)
+            try: await old_page.close()
+            except: pass
+
+    async def take_prefetched_page(self, chat_id, current_page):
+        # 先読み済みタブを前面のメインタブと入れ替える。元のタブは最近使ったチャットとしてプールへ戻す
+        page = self.prefetch_pages.pop(chat_id, None)
+        if page is None: return None
+        if page.is_closed(): return None
+        if self.current_chat_id != "new_chat":
+            await self.keep_prefetched_page(self.current_chat_id, current_page)
+        else:
+            try: await current_page.close()
+            except: pass
+        await page.bring_to_front()
+        return page
+
+    async def sync_history_fast(self, page, url, force_web=False, wait_dom=True):
+        sync_started = time.perf_counter()
+        self.current_chat_id = self.get_chat_id(url)
+
+        cached_data = []
+        self.current_turns = []
+        if not force_web and self.current_chat_id != "new_chat" and chat_cache.exists(self.current_chat_id):
+            try:
+                cached_data = chat_cache.load(self.current_chat_id)
+                # 起動時にUIが前回のチャットをキャッシュから表示済みなら再送しない
+                if cached_data and self.cache_shown != self.current_chat_id:
+                    self.emit_sys_line("システム: ローカルキャッシュを展開しました。")
+                    self.send_chat_data(cached_data, title="【履歴同期】")
+            except Exception as e:
+                logger.error(f"Cache Load Error: {e}")
+        self.cache_shown = None
+
+        captured = None
+        if self.current_chat_id != "new_chat":
+            # 会話JSONが先に届けばDOM解析を省略し、DOMが先に安定すればJSONを待たずにDOM解析へ進む
+            if wait_dom:
+                self.emit_sys_line("システム: ブラウザ側のDOM同期と会話データの受信を待機中 (取得漏れ防止のため下へスクロール中...)")
+            with metrics.span("capture_wait", chat_id=self.current_chat_id) as span:
+                if wait_dom:
+                    captured, ready = await self.wait_captured_or_dom(page, self.current_chat_id)
+                else:
+                    captured, ready = await self.wait_captured(self.current_chat_id, 0), True
+                span["hit"] = bool(captured)
+            if captured:
+                self.emit_sys_line("システム: 通信から会話データを取得しました。DOM解析を省略します。")
+            elif not ready:
+                return
+            elif not wait_dom:
+                self.emit_sys_line("システム: 先読み済みタブを使用します。差分のみ確認します。")
+
+        try:
+            if captured:
+                current_data = captured
+            else:
+                self.emit_sys_line("システム: コンテキストを超高速一括解析中...")
+                with metrics.span("scrape", chat_id=self.current_chat_id) as span:
+                    current_data = await self.scrape_current_chat(page, cached_data)
+                    span["turns"] = len(current_data)
+            self.current_turns = current_data
+
+            if not cached_data:
+                if current_data:
+                    self.send_chat_data(current_data, title=None if force_web else "【履歴同期 (Web)】")
+            elif current_data:
+                self.send_chat_patch(cached_data, current_data)
+            else:
+                # 解析結果が空の場合は取得失敗とみなし、表示とキャッシュを保持する
+                self.emit_sys_line("システム: Web側のターンを取得できなかったため、キャッシュ表示を維持します。")
+                self.current_turns = cached_data
+
+            if self.current_chat_id != "new_chat" and current_data:
+                self.persist_turns(self.current_chat_id, current_data)
+            self.remember_chat(self.current_chat_id)
+
+            metrics.record("sync", (time.perf_counter() - sync_started) * 1000, chat_id=self.current_chat_id,
+                           source="network" if captured else "dom", turns=len(current_data), cached=len(cached_data))
+            self.emit_sys_line("システム: コンテキスト完全同期完了。")
+
+        except Exception as e:
+            self.emit_sys_line(f"システムエラー: 高速同期に失敗しました。詳細: {e}")
+            raise e
+
+    def run(self):
+        asyncio.run(self.run_async())
+
+    async def launch_browser(self, p):
+        # セッションを共有する永続コンテキストを起動し、軽量モードの遮断・ストリーム通知・通信傍受を仕込む
+        with metrics.span("browser_launch", lean=LEAN_MODE):
+            browser_context = await p.chromium.launch_persistent_context(
+                user_data_dir=SESSION_DIR,
+                **browser_launch_options(headless=self.headless)
+            )
+        if LEAN_MODE:
+            for page in browser_context.pages:
+                await block_lean_resources(browser_context, page)
+        await browser_context.expose_binding("clwtStreamEvent", self.on_stream_event)
+        if NETWORK_CAPTURE:
+            browser_context.on("response", self.on_response)
+        self.browser_context = browser_context
+        self.prefetch_pages.clear()
+        self.prefetch_queue.clear()
+        self.captured.clear()
+        self.capture_waiters.clear()
+        return browser_context
+
+    async def open_page(self, reuse=False):
+        context = self.browser_context
+        if reuse and context.pages:
+            page = context.pages[0]
+        else:
+            page = await context.new_page()
+            if LEAN_MODE: await block_lean_resources(context, page)
+        page.set_default_navigation_timeout(self.timeout_ms)
+        page.set_default_timeout(self.timeout_ms)
+        return page
+
+    def report_browser_footprint(self, elapsed):
+        # 起動から初期表示までの時間とブラウザ全プロセスのRSSを記録し、通常/軽量モードを比較できるようにする
+        rss = process_tree_rss(SESSION_DIR)
+        mode = "軽量" if LEAN_MODE else "通常"
+        memory = f"{rss / (1024 * 1024):.0f}MB" if rss is not None else "不明"
+        self.emit_sys_line(f"システム: ブラウザ起動計測 [{mode}] 初期表示まで {elapsed:.1f}秒 / RSS {memory}")
+
+    def spawn(self, coro, label=None, page_task=False):
+        task = self.loop.create_task(self.guard(coro, label))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        if page_task:
+            self.page_tasks.add(task)
+            task.add_done_callback(self.page_tasks.discard)
+        return task
+
+    async def guard(self, coro, label):
+        # タスク単位の例外処理。ブラウザ切断系のエラーだけはコマンドループへ伝えて再起動させる
+        try:
+            await coro
+        except asyncio.CancelledError:
+            if label and self.is_running: self.emit_sys_line(f"システム: {label}を中断しました。")
+            raise
+        except Exception as e:
+            if "closed" in str(e).lower() or "target" in str(e).lower():
+                if self.browser_error is None: self.browser_error = e
+                self.wakeup.set()
+            else:
+                self.emit_sys_line(f"システムエラー(ループ内): {e}")
+
+    def cancel_page_tasks(self):
+        for task in list(self.page_tasks):
+            task.cancel()
+
+    async def cancel_all_tasks(self):
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def start_sidebar_fetch(self):
+        if self.sidebar_task is None or self.sidebar_task.done():
+            self.sidebar_task = self.spawn(self.fetch_sidebar_history(), "履歴取込")
+
+    def dispatch(self, msg):
+        # 履歴取込とキャンセルは実行中の操作と並行に処理する。
+        # 移動/リロードは実行中のページ操作を中断して割り込み、送信は前の操作の完了を待って順に処理する
+        msg_type = msg.get("type")
+
+        if msg_type == "QUIT":
+            self.is_running = False
+
+        elif msg_type == "CANCEL":
+            # 送信中なら send_message が中断時に監視と生成を止める
+            self.cancel_page_tasks()
+
+        elif msg_type == "FETCH_SIDEBAR":
+            self.start_sidebar_fetch()
+
+        elif msg_type == "CLEAR_CACHE":
+            self.emit_sys_line("システム: tmp1内の全キャッシュをクリア中...")
+            count = chat_cache.clear()
+            search_index.clear()
+            self.emit_sys_line(f"システム: キャッシュクリア完了。{count}件削除しました。")
+            self.start_sidebar_fetch()
+
+        elif msg_type in ("NAVIGATE", "RELOAD_DELETE", "RELOAD_SIMPLE"):
+            self.cancel_page_tasks()
+            self.spawn(self.run_page_command(msg), "ページ操作", page_task=True)
+
+        elif msg_type == "SEND":
+            self.spawn(self.run_page_command(msg), "送信", page_task=True)
+
+    async def command_loop(self):
+        while self.is_running and self.browser_error is None:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                continue
+            self.wakeup.clear()
+            while self.is_running:
+                try:
+                    msg = self.msg_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(msg, dict): self.dispatch(msg)
+
+    async def run_page_command(self, msg):
+        async with self.page_lock:
+            msg_type = msg.get("type")
+            url = msg.get("url") or "https://chatgpt.com/"
+
+            if msg_type == "STARTUP":
+                # 履歴取込はページ操作のロックを持たずに並行して走らせ、初期表示の同期を待たせない
+                self.start_sidebar_fetch()
+                await self.sync_history_fast(self.page, self.page.url)
+
+            elif msg_type == "RELOAD_DELETE":
+                self.emit_sys_line(f"システム: キャッシュを削除してリロードを実行中... ({url})")
+                chat_cache.delete(self.get_chat_id(url))
+                self.captured.pop(self.get_chat_id(url), None)
+                with metrics.span("reload", url=url):
+                    await self.page.reload(wait_until="domcontentloaded")
+                await self.sync_history_fast(self.page, url, force_web=True)
+
+            elif msg_type == "RELOAD_SIMPLE":
+                self.emit_sys_line(f"システム: 単純リロードを実行中... ({url})")
+                self.captured.pop(self.get_chat_id(url), None)
+                with metrics.span("reload", url=url):
+                    await self.page.reload(wait_until="domcontentloaded")
+                await self.sync_history_fast(self.page, url, force_web=True)
+
+            elif msg_type == "NAVIGATE":
+                self.emit_sys_line(f"システム: 指定URLへ移動中... ({url})")
+                prefetched = await self.take_prefetched_page(self.get_chat_id(url), self.page)
+                if prefetched:
+                    self.page = prefetched
+                    await self.sync_history_fast(self.page, url, wait_dom=False)
+                else:
+                    self.captured.pop(self.get_chat_id(url), None)
+                    with metrics.span("goto", url=url):
+                        await self.page.goto(url, wait_until="domcontentloaded")
+                    await self.sync_history_fast(self.page, url)
+
+            elif msg_type == "SEND":
+                await self.send_message(self.page, msg.get("text"))
+
+    async def send_message(self, page, text):
+        self.emit_sys_line("システム: メッセージ送信中...")
+        self.stream_done = self.loop.create_future()
+        self.stream_page = page
+        self.stream_text.reset()
+        completed = False
+        try:
+            streaming = await self.install_stream_observer(page)
+
+            await page.fill('#prompt-textarea', text)
+            await page.wait_for_timeout(500)
+            await page.keyboard.press('Enter')
+            self.send_started = time.perf_counter()
+            self.first_token_seen = False
+
+            self.emit_sys_line("システム: AIの応答を待機中")
+            self.stream_start_signal.emit({"role": "ai", "text": "\nAI:\n"})
+
+            if streaming:
+                completed = await self.wait_stream_observer(page)
+            else:
+                await page.wait_for_timeout(3000)
+                completed = await self.poll_stream_response(page)
+        except asyncio.CancelledError:
+            # キャンセル・移動・リロードのいずれで中断されても、ページ側の監視と生成を止める
+            await asyncio.shield(self.stop_stream(page))
+            raise
+        finally:
+            self.stream_done = None
+            self.stream_page = None
+            if self.send_started is not None:
+                metrics.record("response", (time.perf_counter() - self.send_started) * 1000,
+                               chat_id=self.current_chat_id, completed=completed)
+            self.send_started = None
+
+        if completed:
+            self.stream_signal.emit("\n\n")
+            self.emit_sys_append(" 完了\n")
+            self.emit_sys_line("システム: 回答完了。最新のキャッシュを構築します...")
+            chat_id = self.get_chat_id(page.url)
+            if chat_id != self.current_chat_id:
+                self.current_chat_id = chat_id
+                self.current_turns = []
+            # 送信後の内容は会話JSONとして再取得されないため、古い傍受結果は捨ててDOMから読む
+            self.captured.pop(chat_id, None)
+            if self.current_chat_id != "new_chat":
+                with metrics.span("scrape", chat_id=self.current_chat_id, after_send=True) as span:
+                    updated_data = await self.scrape_current_chat(page, self.current_turns)
+                    span["turns"] = len(updated_data)
+                self.current_turns = updated_data
+                self.persist_turns(self.current_chat_id, updated_data)
+                self.remember_chat(self.current_chat_id)
+
+    async def run_async(self):
+        from playwright.async_api import async_playwright
+        self.wakeup = asyncio.Event()
+        self.page_lock = asyncio.Lock()
+        self.loop = asyncio.get_running_loop()
+        if not self.msg_queue.empty(): self.wakeup.set()
+
+        while self.is_running:
+            browser_context = None
+            self.browser_error = None
+            try:
+                async with async_playwright() as p:
+                    self.emit_sys_line("システム: バックグラウンドブラウザを起動中..." + (" (軽量モード)" if LEAN_MODE else ""))
+                    launch_started = time.perf_counter()
+                    browser_context = await self.launch_browser(p)
+                    page = await self.open_page(reuse=True)
+                    self.page = page
+
+                    self.emit_sys_line("システム: ChatGPTへ接続しています...")
+                    with metrics.span("goto", url=self.start_url):
+                        await page.goto(self.start_url, wait_until="domcontentloaded")
+
+                    self.emit_sys_line("システム: 初期アクセス完了。")
+                    self.report_browser_footprint(time.perf_counter() - launch_started)
+                    # 初期同期もページ操作として扱い、UIからの移動指示で中断できるようにする
+                    self.spawn(self.run_page_command({"type": "STARTUP"}), "初期同期", page_task=True)
+                    await self.command_loop()
+                    await self.cancel_all_tasks()
+
+                    if self.browser_error is not None:
+                        raise self.browser_error
+
+                    if not self.is_running:
+                        self.emit_sys_line("システム: 終了処理を実行中。プロセスの完全終了を待機しています...")
+                        await browser_context.close()
+                        break
+
+            except Exception as e:
+                await self.cancel_all_tasks()
+                if not self.is_running: break
+                self.emit_sys_line(f"【警告】ブラウザとの接続が切断されました。({e})")
+                self.emit_sys_line("システム: 5秒後にブラウザの再起動を試みます...")
+                await asyncio.sleep(5)